@@ -0,0 +1,249 @@
+"""End-to-end sync benchmarks over a simulated WAN.
+
+    python bench/run.py [--rtt MS] [--bandwidth SIZE] [--files N] [--output FILE] [SCENARIO ...]
+
+A local directory is synced with a "remote" one on this machine through the ssh
+stand-in of bench/fakessh, which adds the round-trip time and bandwidth limit of a
+WAN link and logs every ssh invocation. The scenarios run in order on the same
+pair of directories:
+
+    seed        first sync into an empty remote directory
+    noop        sync again, nothing changed
+    small-edit  one file modified
+    big-rename  a directory of many files renamed
+
+For each scenario, the number of ssh invocations (round trips), the bytes that went
+through them, the simulated link time and the wall time are reported, along with the
+current commit. The link time is the sum of the delays added by the ssh stand-in:
+round trips (rtt time) and bandwidth (transfer time). Concurrent invocations overlap,
+so it can exceed the wall time; unlike the wall time, it does not depend on the speed
+of this machine. With --output, results are appended to FILE as JSON lines, to
+compare commits.
+
+rsync must be installed: rsync runs the fake ssh too.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+sys.path.insert(0, ROOT)
+from synecure.utils import parse_size  # noqa: E402
+
+
+def write_file(path, size, seed):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write((str(seed) * (size // len(str(seed)) + 1)).encode()[:size])
+
+
+def setup_tree(local, nfiles):
+    for i in range(nfiles):
+        write_file(
+            os.path.join(local, "src", "d%d" % (i % 10), "f%d.txt" % i), 2000 + i, i
+        )
+    for i in range(nfiles // 10):
+        write_file(os.path.join(local, "assets", "a%d.bin" % i), 50000, i)
+    write_file(os.path.join(local, "notes.txt"), 10000, "notes")
+
+
+def seed(local, nfiles):
+    pass
+
+
+def noop(local, nfiles):
+    pass
+
+
+def small_edit(local, nfiles):
+    path = os.path.join(local, "notes.txt")
+    with open(path, "ab") as f:
+        f.write(b"one more line\n")
+    bump(path)
+
+
+def big_rename(local, nfiles):
+    os.rename(os.path.join(local, "src"), os.path.join(local, "source"))
+
+
+# make sure a modification is seen even if it happens in the same second
+def bump(path):
+    st = os.stat(path)
+    os.utime(path, (st.st_atime, st.st_mtime + 2))
+
+
+SCENARIOS = {
+    "seed": seed,
+    "noop": noop,
+    "small-edit": small_edit,
+    "big-rename": big_rename,
+}
+
+
+def commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, universal_newlines=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def read_log(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def run_scenario(name, env, local, remote, extra):
+    log = env["BENCH_LOG"]
+    if os.path.exists(log):
+        os.remove(log)
+    cmd = [
+        sys.executable,
+        "-c",
+        "from synecure import bsync",
+        "-y",
+        *extra,
+        local,
+        "bench@localhost:" + remote,
+    ]
+    start = time.time()
+    proc = subprocess.run(
+        cmd,
+        env=env,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+    wall = time.time() - start
+    if proc.returncode != 0:
+        sys.exit(
+            "Scenario %s failed:\n%s" % (name, proc.stdout.decode(errors="replace"))
+        )
+
+    entries = read_log(log)
+    commands = [e for e in entries if e["kind"] == "command"]
+    return {
+        "scenario": name,
+        "round_trips": len(commands),
+        "connections": sum(1 for e in entries if e["kind"] == "master")
+        + sum(1 for e in commands if not e["multiplexed"]),
+        "bytes_sent": sum(e.get("bytes_in", 0) for e in commands),
+        "bytes_received": sum(e.get("bytes_out", 0) for e in commands),
+        "rtt_time": round(sum(e.get("latency", 0) for e in entries), 2),
+        "transfer_time": round(sum(e.get("transfer", 0) for e in commands), 2),
+        "wall_time": round(wall, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="End-to-end sync benchmarks over a simulated WAN"
+    )
+    parser.add_argument(
+        "scenarios", nargs="*", help="scenarios to run (default: all, in order)"
+    )
+    parser.add_argument(
+        "--rtt", type=float, default=50, help="round-trip time in milliseconds"
+    )
+    parser.add_argument(
+        "--bandwidth",
+        type=parse_size,
+        default="10M",
+        help="bytes per second, e.g. 10M (0: unlimited)",
+    )
+    parser.add_argument(
+        "--files", type=int, default=1000, help="number of files in the tree"
+    )
+    parser.add_argument("--output", help="append results to this file, as JSON lines")
+    parser.add_argument("--bsync-args", default="", help="extra options for bsync")
+    args = parser.parse_args()
+
+    names = args.scenarios or list(SCENARIOS)
+    for name in names:
+        if name not in SCENARIOS:
+            sys.exit(
+                "Unknown scenario: %s (available: %s)" % (name, ", ".join(SCENARIOS))
+            )
+    if shutil.which("rsync") is None:
+        sys.exit("rsync is not installed")
+
+    tmp = tempfile.mkdtemp(prefix="bsync-bench-")
+    local = os.path.join(tmp, "local")
+    remote = os.path.join(tmp, "remote")
+    home = os.path.join(tmp, "home")
+    for path in (local, remote, home):
+        os.makedirs(path)
+    setup_tree(local, args.files)
+
+    env = dict(
+        os.environ,
+        PATH=os.path.join(HERE, "fakessh") + os.pathsep + os.environ.get("PATH", ""),
+        PYTHONPATH=ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""),
+        HOME=home,
+        BENCH_LOG=os.path.join(tmp, "ssh.log"),
+        BENCH_RTT=str(args.rtt),
+        BENCH_BANDWIDTH=str(args.bandwidth),
+    )
+
+    rev = commit()
+    print(
+        "commit %s, rtt %gms, bandwidth %s B/s, %d files"
+        % (rev, args.rtt, args.bandwidth or "unlimited", args.files)
+    )
+    print(
+        "%-12s %12s %12s %14s %14s %10s %10s %10s"
+        % (
+            "scenario",
+            "round trips",
+            "connections",
+            "bytes sent",
+            "bytes recv",
+            "rtt (s)",
+            "xfer (s)",
+            "wall (s)",
+        )
+    )
+    try:
+        for name in SCENARIOS:
+            SCENARIOS[name](local, args.files)
+            if name not in names:
+                # scenarios build on each other: the skipped ones are still synced
+                run_scenario(name, env, local, remote, args.bsync_args.split())
+                continue
+            result = run_scenario(name, env, local, remote, args.bsync_args.split())
+            print(
+                "%-12s %12d %12d %14d %14d %10.2f %10.2f %10.2f"
+                % (
+                    name,
+                    result["round_trips"],
+                    result["connections"],
+                    result["bytes_sent"],
+                    result["bytes_received"],
+                    result["rtt_time"],
+                    result["transfer_time"],
+                    result["wall_time"],
+                )
+            )
+            if args.output:
+                result.update(
+                    commit=rev, rtt=args.rtt, bandwidth=args.bandwidth, files=args.files
+                )
+                with open(args.output, "a") as f:
+                    f.write(json.dumps(result) + "\n")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -17,9 +17,11 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import os, sys, shutil, subprocess, collections, time, datetime, shlex, getopt, stat
+import os, sys, shutil, subprocess, collections, time, datetime, shlex, getopt, stat, json, threading
+import heapq, tempfile, asyncio, hashlib, random, errno, fcntl, contextlib
+from concurrent.futures import ThreadPoolExecutor
 from .gitignore_parser import parse_gitignore
-from .utils import NoQuote, get_config_path, readlines, quote
+from .utils import NoQuote, get_config, get_config_path, locked_config, readlines, quote, write_config, parse_size, parse_bwlimit, bwlimit_at
 from collections import defaultdict
 
 
@@ -66,42 +68,185 @@ class SshCon():
 		self.sock = None
 		self.port = port
 		self.customargs = shlex.split(customargs)
+		self.findcmd = "find"	# or gfind, set by find_check_command
 
 	def getcmdlist(self):
 		port = ["-p"+self.port] if self.port!=None else []
 		return ["ssh"] + ["-S"+self.sock] + port + self.customargs + [self.userhost]
 
+	# ssh command for another host to connect to this one (the master socket is local)
+	def getremotecmdlist(self):
+		port = ["-p"+self.port] if self.port!=None else []
+		return ["ssh"] + port + self.customargs
+
 	def getcmdstr(self):
 		return joinargs(self.getcmdlist())
 
+	# quoted arguments of a remote command, run with the priority of the resource policy
+	# (arguments starting with "-" are options for ssh itself, e.g. -fNM or -O exit)
+	def remoteargs(self, args):
+		prefix = priority_prefix()
+		if not prefix or str(args[0]).startswith("-"):
+			prefix = []
+		else:
+			prefix = [prefix]
+		return prefix + [quote(arg) for arg in args]
+
 	def popen(self, *args, **kwargs):
-		args = map(quote, args)
-		return Popen(*self.getcmdlist(), *args, **kwargs)
+		args = self.remoteargs(args)
+		return Popen(*self.getcmdlist(), *args, host=self.userhost, **kwargs)
 
 	def run(self, *args, **kwargs):
-		args = map(quote, args)
-		return Run(*self.getcmdlist(), *args, **kwargs)
+		args = self.remoteargs(args)
+		return Run(*self.getcmdlist(), *args, host=self.userhost, **kwargs)
 
 	def call(self, *args, **kwargs):
-		args = map(quote, args)
-		return Call(*self.getcmdlist(), *args, **kwargs)
+		args = self.remoteargs(args)
+		return Call(*self.getcmdlist(), *args, host=self.userhost, **kwargs)
 
 	def check_call(self, *args, **kwargs):
-		args = map(quote, args)
-		return CheckCall(*self.getcmdlist(), *args, **kwargs)
+		args = self.remoteargs(args)
+		return CheckCall(*self.getcmdlist(), *args, host=self.userhost, **kwargs)
 
 	def check_output(self, *args, **kwargs):
-		args = map(quote, args)
-		return CheckOutput(*self.getcmdlist(), *args, **kwargs)
-
+		args = self.remoteargs(args)
+		return CheckOutput(*self.getcmdlist(), *args, host=self.userhost, **kwargs)
+
+
+##### resource policy
+# background syncs on shared hosts should not compete with other jobs: the I/O
+# scheduling class and the niceness apply to this process (and so to its threads
+# and local children) and prefix every remote command. max_scan_threads caps the
+# threads and processes that scan directories, ops_limit the rate of the metadata
+# operations made here (stat, mkdir, rename, unlink, ...) and of remote batches.
+ionice_class = None	# "idle" or "best-effort"
+niceness = None
+max_scan_threads = None
+ops_limit = 0	# per second, 0: unlimited
+
+ionice_classes = {"idle": "3", "best-effort": "2"}
+
+# shell commands lowering the priority of the remote shell, before the command itself
+def priority_prefix():
+	prefix = ""
+	if niceness is not None:
+		prefix += "renice "+str(niceness)+" $$ >/dev/null 2>&1; "
+	if ionice_class is not None:
+		prefix += "ionice -c "+ionice_classes[ionice_class]+" -p $$ >/dev/null 2>&1; "
+	return prefix
+
+# rsync options running the remote rsync with the same priority
+def rsync_path_args():
+	prefix = priority_prefix()
+	return ["--rsync-path="+prefix+"rsync"] if prefix else []
+
+def apply_local_priority():
+	if niceness is not None:
+		current = os.getpriority(os.PRIO_PROCESS, 0)
+		if niceness > current:
+			os.setpriority(os.PRIO_PROCESS, 0, niceness)
+	if ionice_class is not None and shutil.which("ionice") is not None:
+		# threads and children started afterwards inherit the class
+		subprocess.call(["ionice", "-c", ionice_classes[ionice_class], "-p", str(os.getpid())],
+			stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+class RateLimit():
+	def __init__(self, rate):
+		self.rate = rate
+		self.next = time.monotonic()
+		self.lock = threading.Lock()
+
+	# wait until n more operations are allowed (bursts of at most a second)
+	def wait(self, n=1):
+		if self.rate == 0:
+			return
+		with self.lock:
+			now = time.monotonic()
+			self.next = max(self.next, now - 1) + n / self.rate
+			delay = self.next - 1 - now
+		if delay > 0:
+			time.sleep(delay)
+
+ops = RateLimit(0)
+
+##### process layer
+# commands are coroutines, run on an event loop of their own for each .run().
+# Combinators compose them: And/Or run clauses one after the other, Gather runs
+# independent clauses concurrently and cancels the others on the first failure.
+# .run() runs a command (or a combination) to completion from synchronous code,
+# in any thread (child processes are watched by a thread each, Python 3.8+).
+
+# maximum number of processes running at the same time for each host
+# ("local" or user@host), in all threads: ssh multiplexes at most MaxSessions (10)
+# channels. rsync streams (Popen) are not counted, there are at most `lanes` of them
+host_concurrency = 4
+
+_semaphores = {}
+_semaphores_lock = threading.Lock()
+
+def run_async(coro):
+	loop = asyncio.new_event_loop()
+	try:
+		return loop.run_until_complete(coro)
+	finally:
+		loop.close()
+
+def host_semaphore(host):
+	with _semaphores_lock:
+		if host not in _semaphores:
+			_semaphores[host] = threading.BoundedSemaphore(host_concurrency)
+		return _semaphores[host]
+
+# wait for a process slot of a host without blocking the event loop of this thread
+# (its other coroutines may be the ones holding slots)
+async def acquire_host(host):
+	semaphore = host_semaphore(host)
+	delay = 0.001
+	while not semaphore.acquire(blocking=False):
+		await asyncio.sleep(delay)
+		delay = min(delay * 2, 0.05)
+	return semaphore
+
+# run commands concurrently, without cancellation, exceptions are returned as results
+def run_concurrently(*commands):
+	async def gather():
+		return await asyncio.gather(*[command.arun() for command in commands], return_exceptions=True)
+	return run_async(gather())
 
 class Command:
 	def __init__(self, *args, **kwargs):
 		self.args = args
+		self.host = kwargs.pop("host", "local")
 		kwargs.setdefault("stdout", subprocess.DEVNULL)
 		kwargs.setdefault("stderr", subprocess.DEVNULL)
 		self.kwargs = kwargs
 
+	def run(self):
+		return run_async(self.arun())
+
+	# start the process, wait for it and return (returncode, stdout, stderr)
+	# the process is killed if the task is cancelled
+	async def communicate(self, name):
+		args = [str(x) for x in self.args]
+		kwargs = dict(self.kwargs)
+		text = kwargs.pop("universal_newlines", False)
+		semaphore = await acquire_host(self.host)
+		try:
+			prc(name, *args)
+			proc = await asyncio.create_subprocess_exec(*args, **kwargs)
+			try:
+				stdout, stderr = await proc.communicate()
+			except asyncio.CancelledError:
+				proc.kill()
+				await proc.wait()
+				raise
+		finally:
+			semaphore.release()
+		if text:
+			stdout = stdout if stdout is None else stdout.decode()
+			stderr = stderr if stderr is None else stderr.decode()
+		return proc.returncode, stdout, stderr
+
 
 def prc(command, *args):
 	if DEBUG:
@@ -114,43 +259,48 @@ def prc(command, *args):
 				*map(color, map(str, args)))
 
 
+# a live process whose pipes are read and written synchronously (streams)
 class Popen(Command):
 	def run(self):
 		args = [str(x) for x in self.args]
 		prc("popen", *args)
 		return subprocess.Popen(args, **self.kwargs)
 
+	async def arun(self):
+		return self.run()
+
 
 class Run(Command):
-	def run(self):
-		args = [str(x) for x in self.args]
-		prc("run", *args)
-		return subprocess.run(args, **self.kwargs)
+	async def arun(self):
+		returncode, stdout, stderr = await self.communicate("run")
+		return subprocess.CompletedProcess(self.args, returncode, stdout, stderr)
 
 
 class Call(Command):
-	def run(self):
-		args = [str(x) for x in self.args]
-		prc("call", *args)
-		return subprocess.call(args, **self.kwargs)
+	async def arun(self):
+		returncode, stdout, stderr = await self.communicate("call")
+		return returncode
 
 
 class CheckCall(Command):
-	def run(self):
-		args = [str(x) for x in self.args]
-		prc("check_call", *args)
-		return subprocess.check_call(args, **self.kwargs)
+	async def arun(self):
+		returncode, stdout, stderr = await self.communicate("check_call")
+		if returncode != 0:
+			raise subprocess.CalledProcessError(returncode, self.args)
+		return 0
 
 
 class CheckOutput(Command):
 	def __init__(self, *args, **kwargs):
-		self.args = args
-		self.kwargs = kwargs
+		kwargs.setdefault("stdout", subprocess.PIPE)
+		kwargs.setdefault("stderr", None)
+		super().__init__(*args, **kwargs)
 
-	def run(self):
-		args = [str(x) for x in self.args]
-		prc("check_output", *args)
-		return subprocess.check_output(args, **self.kwargs)
+	async def arun(self):
+		returncode, stdout, stderr = await self.communicate("check_output")
+		if returncode != 0:
+			raise subprocess.CalledProcessError(returncode, self.args, stdout, stderr)
+		return stdout
 
 
 class Result:
@@ -159,20 +309,27 @@ class Result:
 		self.returncode = returncode
 
 
+async def run_clause(clause):
+	if clause is True:
+		return Result(returncode=0, stdout="")
+	elif clause is False:
+		return Result(returncode=1, stdout="")
+	else:
+		return await clause.arun()
+
+
 class And:
 	def __init__(self, *clauses):
 		self.clauses = clauses
 
 	def run(self):
+		return run_async(self.arun())
+
+	async def arun(self):
 		for clause in self.clauses:
-			if clause is True:
-				result = Result(returncode=0, stdout="")
-			elif clause is False:
-				return Result(returncode=1, stdout="")
-			else:
-				result = clause.run()
-				if result.returncode != 0:
-					return result
+			result = await run_clause(clause)
+			if result.returncode != 0:
+				return result
 		else:
 			return result
 
@@ -182,19 +339,59 @@ class Or:
 		self.clauses = clauses
 
 	def run(self):
+		return run_async(self.arun())
+
+	async def arun(self):
 		for clause in self.clauses:
-			if clause is True:
-				return Result(returncode=0, stdout="")
-			elif clause is False:
-				result = Result(returncode=1, stdout="")
-			else:
-				result = clause.run()
-				if result.returncode == 0:
-					return result
+			result = await run_clause(clause)
+			if result.returncode == 0:
+				return result
 		else:
 			return result
 
 
+# a python function run in a worker thread, composable like a command
+# it fails (returncode 1) if it raises an OSError
+class Function:
+	def __init__(self, fn, *args):
+		self.fn = fn
+		self.args = args
+
+	def run(self):
+		return run_async(self.arun())
+
+	async def arun(self):
+		try:
+			await asyncio.get_event_loop().run_in_executor(None, self.fn, *self.args)
+			return Result(returncode=0, stdout="")
+		except OSError as exc:
+			printerr("Error: "+str(exc))
+			return Result(returncode=1, stdout="")
+
+
+class Gather:
+	def __init__(self, *clauses):
+		self.clauses = clauses
+
+	def run(self):
+		return run_async(self.arun())
+
+	# the first failure (or exception) cancels the clauses still running
+	# otherwise the result of the last clause is returned, like And
+	async def arun(self):
+		tasks = [asyncio.ensure_future(run_clause(clause)) for clause in self.clauses]
+		try:
+			for future in asyncio.as_completed(tasks):
+				result = await future
+				if result.returncode != 0:
+					return result
+			return tasks[-1].result()
+		finally:
+			for task in tasks:
+				task.cancel()
+			await asyncio.gather(*tasks, return_exceptions=True)
+
+
 def joinargs(arglist):
 	cmd = ""
 	for arg in arglist:
@@ -208,6 +405,23 @@ def samefiles(f1, f2):
 	else:
 		return f1.type==f2.type and f1.date==f2.date and f1.perms==f2.perms
 
+# split a list of paths in batches of at most size paths
+# and at most max_cmd_bytes bytes (the remote shell gets them in a single command)
+max_cmd_bytes = 64 * 1024
+
+def batches(paths, size):
+	batch = []
+	nbytes = 0
+	for path in paths:
+		if batch and (len(batch) >= size or nbytes + len(path) > max_cmd_bytes):
+			yield batch
+			batch = []
+			nbytes = 0
+		batch.append(path)
+		nbytes += len(path) + 3
+	if batch:
+		yield batch
+
 def printv(s):
 	global verbose
 	if verbose: print(s)
@@ -228,6 +442,76 @@ def ssh_master_init(ssh):
 
 	atexit.register(ssh_master_clean, tmpdir, ssh)
 
+# link profiles older than this are measured again
+link_profile_max_age = 7 * 24 * 3600
+
+# measure the round-trip time and a short bandwidth sample over the ssh master connection
+def link_measure(ssh):
+	rtts = []
+	for i in range(3):
+		start = time.time()
+		ssh.call("true").run()
+		rtts.append(time.time() - start)
+	rtt = sorted(rtts)[1]
+
+	# start small so that slow links are not stuck on the sample for long
+	size = 1 << 20
+	while True:
+		start = time.time()
+		out = ssh.check_output("head", "-c", str(size), "/dev/urandom").run()
+		elapsed = max(time.time() - start - rtt, 0.001)
+		if elapsed > 0.5 or size >= 16 << 20:
+			break
+		size *= 4
+
+	return {
+		"rtt": round(rtt * 1000, 2),
+		"bandwidth": int(len(out) / elapsed),
+		"measured": int(time.time()),
+	}
+
+# get the link profile of a named remote from remotes.json, measuring it if needed
+def link_profile(ssh, name, remeasure=False):
+	remotes = get_config("remotes.json")
+	profile = remotes.get(name, {}).get("link")
+	if remeasure or profile is None or time.time() - profile.get("measured", 0) > link_profile_max_age:
+		print("Profiling link to "+ssh.userhost+"...")
+		profile = dict(link_measure(ssh), throughput=(profile or {}).get("throughput", {}))
+		with locked_config("remotes.json"):
+			remotes = get_config("remotes.json")
+			if name in remotes:
+				remotes[name]["link"] = profile
+				write_config("remotes.json", remotes, silent=True)
+	printv("Link: rtt %sms, %.1f MB/s" % (profile["rtt"], profile["bandwidth"] / 1e6))
+	return profile
+
+# remember the throughput of a large enough transfer, for later estimates
+def link_record_throughput(direction, throughput):
+	global link, profile
+	if link is None or profile is None:
+		return
+	link.setdefault("throughput", {})[direction] = int(throughput)
+	with locked_config("remotes.json"):
+		remotes = get_config("remotes.json")
+		if profile in remotes:
+			remotes[profile]["link"] = link
+			write_config("remotes.json", remotes, silent=True)
+
+# transfer settings suited to a link profile
+def link_tune(profile):
+	rtt = profile["rtt"]
+	bandwidth = profile["bandwidth"]
+	return {
+		# parallel rsync streams hide latency and per-connection throughput limits
+		"lanes": 1 if rtt < 2 else 2 if rtt < 20 else 4,
+		# compression only pays off when the network is slower than the CPU
+		"compress": "yes" if bandwidth < 10e6 else "no",
+		# on fast links, reading both ends for delta costs more than resending
+		"whole-file": "yes" if bandwidth > 50e6 else "no",
+		# fewer, larger commands when each one costs a long round trip
+		"batch-size": 500 if rtt < 2 else 2000,
+	}
+
 def ssh_master_clean(tmpdir, ssh):
 	# send exit signal to ssh master, this will remove the socket
 	printv("Cleaning SSH master...")
@@ -247,7 +531,526 @@ def ssh_master_clean(tmpdir, ssh):
 findformat = "%i\\0%P\\0%y\\0%T@\\0%s\\0%#m\\0"
 # find test1/ -printf "%i\t%P\t%y\t%T@\t%s\t%#m\n"
 
-def rsync_init(sshSrc,dirnameSrc, sshDst,dirnameDst):
+# extensions of files that are already compressed (rsync's default skip-compress list)
+# delta transfer and compression are both a waste of CPU on these
+skip_compress = {
+	"3g2", "3gp", "7z", "aac", "ace", "apk", "avi", "bz2", "deb", "dmg", "ear",
+	"f4v", "flac", "flv", "gpg", "gz", "iso", "jar", "jpeg", "jpg", "lrz", "lz",
+	"lz4", "lzma", "lzo", "m1a", "m1v", "m2a", "m2ts", "m2v", "m4a", "m4b", "m4p",
+	"m4r", "m4v", "mka", "mkv", "mov", "mp1", "mp2", "mp3", "mp4", "mpa", "mpeg",
+	"mpg", "mpv", "mts", "odb", "odf", "odg", "odi", "odm", "odp", "ods", "odt",
+	"oga", "ogg", "ogm", "ogv", "ogx", "opus", "otg", "oth", "otp", "ots", "ott",
+	"oxt", "png", "qt", "rar", "rpm", "rz", "rzip", "spx", "squashfs", "sxc",
+	"sxd", "sxg", "sxm", "sxw", "sz", "tbz", "tbz2", "tgz", "tlz", "ts", "txz",
+	"tzo", "vob", "war", "webm", "webp", "xz", "z", "zip", "zst",
+}
+
+# below this size, the delta algorithm costs more round trips than it saves
+delta_min_size = 256 * 1024
+
+# rsync options for each transfer class
+def transfer_class_args(name):
+	args = ["--whole-file"] if name.startswith("whole") else ["--no-whole-file"]
+	if "-sparse" in name:
+		args.append("--sparse")
+	if name.endswith("-z"):
+		args += ["--compress", "--skip-compress="+"/".join(sorted(skip_compress))]
+	return args
+
+# pick the transfer class of a file record: whole-file or delta, sparse or not, compressed or not
+# issync is True when the file already exists on the destination (a basis for delta)
+def transfer_class(f, issync, remote):
+	global compress, whole_file
+
+	issync = issync or f.path in bases
+	if issync and f.path in metaonly:
+		return "meta"
+
+	ext = os.path.splitext(f.path)[1][1:].lower().decode(errors="replace")
+	precompressed = ext in skip_compress
+	size = int(f.size) if f.type == "f" else 0
+
+	# compression costs CPU on both ends: with auto, only when the link profile
+	# reports a slow link (link_tune sets compress to yes), never locally
+	usecompress = compress == "yes"
+	usedelta = remote if whole_file == "auto" else whole_file == "no"
+
+	# new files have no basis, small files are cheaper to resend,
+	# and compressed formats change throughout when edited
+	delta = usedelta and issync and size >= delta_min_size and not precompressed
+	z = usecompress and not precompressed and f.type == "f"
+
+	if not issync and f.path in bulk:
+		return "tar" + ("-z" if z else "")
+	if remote and chunked_size and size >= chunked_size and f.path not in sparse \
+			and (ssh1 is None or ssh2 is None) and current_bwlimit() is None:
+		return "chunked"
+	if not remote and copier == "native" and f.type in ("f", "l", "d") and current_bwlimit() is None:
+		return "local"
+	return ("delta" if delta else "whole") + ("-sparse" if f.path in sparse else "") + ("-z" if z else "")
+
+##### bulk transfers of new small files
+# rsync exchanges a few messages per file: for many new small files, a single tar
+# stream over SSH unpacked on the other side is much faster. Only new files that
+# are not the result of a conflict are sent this way (they cannot overwrite anything).
+# With a bandwidth limit, rsync is used so that the limit holds.
+bulk_min_files = 1000
+bulk_max_size = 256 * 1024
+bulk = set()	# paths sent with tar
+
+# paths of copies sent with tar, all small ones when seeding
+def find_bulk(copy, remote, conflicted, seeding=False):
+	if not remote or bwlimits or (bulk_min_files == 0 and not seeding):
+		return set()
+	candidates = [f.path for f in copy
+		if f.type in ("f", "l") and int(f.size) < bulk_max_size and f.path not in conflicted]
+	if not seeding and len(candidates) < bulk_min_files:
+		return set()
+	return set(candidates)
+
+# send files with one tar process on each side, the unpacking side lists the files for the progress
+# if tar fails, the files are sent with rsync instead
+def tar_lane(sshSrc,dirnameSrc, sshDst,dirnameDst, name, files, background, progress, concurrency):
+	z = ["--gzip"] if name.endswith("-z") else []
+	create = ["tar", "-C", dirnameSrc, "--null", "--no-recursion", "-T", "-", "-cf", "-"] + z
+	extract = ["tar", "-C", dirnameDst, "-xpvf", "-"] + z
+
+	if sshSrc is None:
+		producer = Popen(*create, stdin=subprocess.PIPE, stdout=subprocess.PIPE).run()
+	else:
+		producer = sshSrc.popen(*create, stdin=subprocess.PIPE, stdout=subprocess.PIPE).run()
+	if sshDst is None:
+		consumer = Popen(*extract, stdin=producer.stdout, stdout=subprocess.PIPE).run()
+	else:
+		consumer = sshDst.popen(*extract, stdin=producer.stdout, stdout=subprocess.PIPE).run()
+	producer.stdout.close()
+
+	def follow():
+		for line in consumer.stdout:
+			progress.done(line.rstrip(b"\n"))
+	reader = threading.Thread(target=follow)
+	reader.start()
+	try:
+		for f in files:
+			producer.stdin.write(f.path+b"\0")
+		producer.stdin.close()
+	except BrokenPipeError:
+		pass
+	reader.join()
+	producer.wait()
+	consumer.wait()
+
+	if producer.returncode != 0 or consumer.returncode != 0:
+		printv("tar transfer failed, sending "+str(len(files))+" paths with rsync...")
+		return rsync_lane(sshSrc,dirnameSrc, sshDst,dirnameDst, name.replace("tar", "whole"), files, background, progress, concurrency)
+
+	for f in files:
+		progress.done(f.path)
+	journal.done(progress.direction+":transfers", [f.path for f in files])
+	return 0
+
+##### local copy engine (--copier=native)
+# when both directories are local (file:// remotes), files can be copied in-process
+# by a thread pool instead of a local rsync process pair: a reflink clone when the
+# filesystem supports it (btrfs, XFS), otherwise copy_file_range or sendfile, so
+# that the data does not go through user space. Like rsync -a, each file is written
+# to a temporary file that replaces the destination once complete, with the perms,
+# date (and owner, as root) of the source. Symlinks are copied as symlinks. Other
+# file types (devices, fifos, sockets) and files it cannot copy are sent with rsync.
+copier = "rsync"
+copy_threads = 8
+FICLONE = 0x40049409	# linux/fs.h
+
+# copy length bytes at offset, with the fastest system call that works
+def copy_range(fdSrc, fdDst, offset, length):
+	end = offset + length
+	while offset < end:
+		try:
+			n = os.copy_file_range(fdSrc, fdDst, end - offset, offset, offset)
+		except (AttributeError, OSError):
+			n = None
+		if n is None:
+			try:
+				os.lseek(fdDst, offset, os.SEEK_SET)
+				n = os.sendfile(fdDst, fdSrc, offset, end - offset)
+			except OSError:
+				data = os.pread(fdSrc, min(end - offset, 1 << 20), offset)
+				n = os.pwrite(fdDst, data, offset)
+		if n == 0:
+			break	# source truncated while copying
+		offset += n
+
+# copy the contents of a file, skipping the holes of sparse files
+def copy_data(fdSrc, fdDst, size, holes):
+	try:
+		fcntl.ioctl(fdDst, FICLONE, fdSrc)
+		return
+	except OSError:
+		pass
+	if not holes:
+		copy_range(fdSrc, fdDst, 0, size)
+		return
+	offset = 0
+	while offset < size:
+		try:
+			start = os.lseek(fdSrc, offset, os.SEEK_DATA)
+		except OSError as exc:
+			if exc.errno == errno.ENXIO:
+				break	# only a hole until the end
+			raise
+		end = os.lseek(fdSrc, start, os.SEEK_HOLE)
+		copy_range(fdSrc, fdDst, start, end - start)
+		offset = end
+	os.ftruncate(fdDst, size)
+
+# copy one file, symlink or directory (metadata only), False if it is of another type
+def local_copy(dirnameSrc, dirnameDst, f):
+	src = os.path.join(os.fsencode(dirnameSrc), f.path)
+	dst = os.path.join(os.fsencode(dirnameDst), f.path)
+	ops.wait()
+	st = os.lstat(src)
+	if stat.S_ISDIR(st.st_mode):
+		if not os.path.isdir(dst):
+			os.mkdir(dst)
+		os.chmod(dst, stat.S_IMODE(st.st_mode))
+		os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+		return True
+	if not stat.S_ISREG(st.st_mode) and not stat.S_ISLNK(st.st_mode):
+		return False
+
+	tmp = os.path.join(os.path.dirname(dst), b"."+os.path.basename(dst)+b"."+os.urandom(4).hex().encode())
+	try:
+		if stat.S_ISLNK(st.st_mode):
+			os.symlink(os.readlink(src), tmp)
+		else:
+			fdSrc = os.open(src, os.O_RDONLY)
+			try:
+				fdDst = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+				try:
+					copy_data(fdSrc, fdDst, st.st_size, f.path in sparse)
+					os.fchmod(fdDst, stat.S_IMODE(st.st_mode))
+				finally:
+					os.close(fdDst)
+			finally:
+				os.close(fdSrc)
+		if os.geteuid() == 0:
+			os.chown(tmp, st.st_uid, st.st_gid, follow_symlinks=False)
+		os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+		os.rename(tmp, dst)
+	except BaseException:
+		if os.path.lexists(tmp):
+			os.remove(tmp)
+		raise
+	return True
+
+# copy a list of files in a thread pool, the ones that could not be copied go to rsync
+def local_lane(sshSrc,dirnameSrc, sshDst,dirnameDst, name, files, background, progress, concurrency):
+	def copy(f):
+		try:
+			if local_copy(dirnameSrc, dirnameDst, f):
+				progress.done(f.path)
+				return True
+		except OSError as exc:
+			printv("Local copy of "+tostr(f.path)+" failed ("+exc.strerror+"), sending it with rsync...")
+		return False
+	with ThreadPoolExecutor(max_workers=copy_threads) as pool:
+		copied = list(pool.map(copy, files))
+	journal.done(progress.direction+":transfers", [f.path for f, ok in zip(files, copied) if ok])
+
+	rest = [f for f, ok in zip(files, copied) if not ok]
+	if rest:
+		return rsync_lane(sshSrc,dirnameSrc, sshDst,dirnameDst, "whole", rest, background, progress, concurrency)
+	return 0
+
+##### chunked transfers of very large files
+# a single rsync stream is limited to what one SSH channel sustains: files of at
+# least chunked_size bytes are split in chunks, sent by chunk_streams concurrent
+# dd processes, each over its own SSH connection. Those connections cannot ask for
+# a password (BatchMode): one is tried first, and files are sent with rsync if it
+# fails. Chunks are compared by sha1 first, so that only the ones that changed are
+# sent (new files are sent whole, without reading the destination). They are
+# written in a copy of the destination in the partial dir (kept if interrupted, so
+# that --resume only sends the missing chunks), which is checked chunk by chunk
+# before replacing it.
+chunked_size = 1 << 30
+chunk_size = 64 << 20
+chunk_streams = 4
+
+def chunk_ranges(size):
+	return [(offset, min(chunk_size, size - offset)) for offset in range(0, size, chunk_size)]
+
+# path of a file on one side: bytes for local paths, str for remote ones
+def side_path(ssh, dirname, path):
+	if ssh is None:
+		return os.path.join(os.fsencode(dirname), path)
+	return os.path.join(dirname, path.decode("utf8"))
+
+# remote command string on its own SSH connection (not through the master)
+def remote_connection(ssh, script):
+	return ssh.getremotecmdlist() + ["-oBatchMode=yes", ssh.userhost, priority_prefix()+script]
+
+# whether connections of their own can be opened to a host without prompting
+connections_ok = {}
+connections_lock = threading.Lock()
+
+def check_connections(ssh):
+	with connections_lock:
+		if ssh.userhost not in connections_ok:
+			connections_ok[ssh.userhost] = Call(*remote_connection(ssh, "true")).run() == 0
+			if not connections_ok[ssh.userhost]:
+				printv("Cannot open SSH connections to "+ssh.userhost+" without a prompt, no chunked transfers")
+		return connections_ok[ssh.userhost]
+
+def dd_read(path, offset, length):
+	return "dd if="+quote(path)+" bs=1M iflag=skip_bytes,count_bytes skip="+str(offset)+" count="+str(length)+" 2>/dev/null"
+
+def dd_write(path, offset):
+	return "dd of="+quote(path)+" bs=1M oflag=seek_bytes conv=notrunc seek="+str(offset)+" 2>/dev/null"
+
+def hash_range(path, offset, length):
+	h = hashlib.sha1()
+	with open(path, "rb") as fd:
+		fd.seek(offset)
+		while length > 0:
+			data = fd.read(min(length, 1 << 20))
+			if not data:
+				break
+			h.update(data)
+			length -= len(data)
+	return h.hexdigest()
+
+# sha1 of some ranges of a file, None where it could not be read
+def hash_chunks(ssh, path, ranges):
+	if ssh is None:
+		def digest(r):
+			try:
+				return hash_range(path, *r)
+			except OSError:
+				return None
+		with ThreadPoolExecutor(max_workers=chunk_streams) as pool:
+			return list(pool.map(digest, ranges))
+
+	# the ranges are hashed by chunk_streams remote loops
+	def digests(group):
+		script = "for r in "+" ".join("%d:%d" % r for r in group)+"; do "
+		script += dd_read(path, "${r%:*}", "${r#*:}")+" | sha1sum; done"
+		out = ssh.check_output(NoQuote(script), universal_newlines=True, stderr=subprocess.DEVNULL).run()
+		return [line.split()[0] for line in out.splitlines()]
+	groups = [ranges[i::chunk_streams] for i in range(chunk_streams)]
+	sums = [None] * len(ranges)
+	with ThreadPoolExecutor(max_workers=chunk_streams) as pool:
+		for i, result in enumerate(pool.map(digests, groups)):
+			sums[i::chunk_streams] = result
+	return sums
+
+# send a range of a file, returns the sha1 of what was sent from a local source
+def send_chunk(sshSrc, src, sshDst, tmp, offset, length):
+	h = hashlib.sha1()
+	if sshSrc is None:
+		proc = Popen(*remote_connection(sshDst, dd_write(tmp, offset)), stdin=subprocess.PIPE).run()
+		with open(src, "rb") as fd:
+			fd.seek(offset)
+			while length > 0:
+				data = fd.read(min(length, 1 << 20))
+				if not data:
+					break
+				h.update(data)
+				proc.stdin.write(data)
+				length -= len(data)
+		proc.stdin.close()
+	else:
+		proc = Popen(*remote_connection(sshSrc, dd_read(src, offset, length)), stdout=subprocess.PIPE).run()
+		fd = os.open(tmp, os.O_WRONLY)
+		try:
+			for data in iter(lambda: proc.stdout.read(1 << 20), b""):
+				os.pwrite(fd, data, offset)
+				offset += len(data)
+				length -= len(data)
+		finally:
+			os.close(fd)
+	proc.wait()
+	if proc.returncode != 0 or length != 0:
+		raise OSError(errno.EIO, "chunk transfer failed")
+	return h.hexdigest()
+
+# the copy of the destination file that receives the chunks, at its final size
+# returns False if it starts empty (no destination, nor partial file)
+def prepare_chunked(ssh, dst, tmp, size):
+	if ssh is None:
+		os.makedirs(os.path.dirname(tmp), exist_ok=True)
+		existing = os.path.exists(tmp) or os.path.exists(dst)
+		if not os.path.exists(tmp) and os.path.exists(dst):
+			with open(dst, "rb") as src, open(tmp, "wb") as out:
+				copy_data(src.fileno(), out.fileno(), os.fstat(src.fileno()).st_size, False)
+		with open(tmp, "ab") as out:
+			out.truncate(size)
+	else:
+		script = "mkdir -p "+quote(os.path.dirname(tmp))
+		script += " && if [ -e "+quote(tmp)+" ] || [ -e "+quote(dst)+" ]; then echo existing; fi"
+		script += " && { [ -e "+quote(tmp)+" ] || [ ! -e "+quote(dst)+" ] || cp --reflink=auto "+quote(dst)+" "+quote(tmp)+"; }"
+		script += " && truncate -s "+str(size)+" "+quote(tmp)
+		existing = ssh.check_output(NoQuote(script), universal_newlines=True).run().strip() == "existing"
+	return existing
+
+# set perms and date of the received file, and replace the destination
+def finish_chunked(ssh, dst, tmp, f):
+	if ssh is None:
+		if f.perms != "":
+			os.chmod(tmp, int(f.perms, 8))
+		os.utime(tmp, (int(f.date), int(f.date)))
+		os.rename(tmp, dst)
+		try:
+			os.rmdir(os.path.dirname(tmp))
+		except OSError:
+			pass	# other partial files
+	else:
+		script = "chmod "+f.perms+" "+quote(tmp)+" && " if f.perms != "" else ""
+		script += "touch -m -d @"+f.date+" "+quote(tmp)+" && mv -f "+quote(tmp)+" "+quote(dst)
+		script += " && { rmdir "+quote(os.path.dirname(tmp))+" 2>/dev/null || true; }"
+		ssh.check_call(NoQuote(script)).run()
+
+# send one file in chunks, False if the received file does not match
+def chunked_transfer(sshSrc,dirnameSrc, sshDst,dirnameDst, f):
+	src = side_path(sshSrc, dirnameSrc, f.path)
+	dst = side_path(sshDst, dirnameDst, f.path)
+	tmp = os.path.join(os.path.dirname(dst), partial_dir if sshDst is None else partial_dir.decode(), os.path.basename(dst))
+	ranges = chunk_ranges(int(f.size))
+
+	if prepare_chunked(sshDst, dst, tmp, int(f.size)):
+		with ThreadPoolExecutor(max_workers=2) as pool:
+			srcsums = pool.submit(hash_chunks, sshSrc, src, ranges)
+			dstsums = pool.submit(hash_chunks, sshDst, tmp, ranges)
+			srcsums, dstsums = srcsums.result(), dstsums.result()
+		todo = [i for i in range(len(ranges)) if srcsums[i] is None or srcsums[i] != dstsums[i]]
+	else:
+		# nothing to compare: a local source is hashed while it is sent,
+		# a remote one while the chunks are received
+		srcsums = None
+		todo = list(range(len(ranges)))
+	printv("Sending "+str(len(todo))+"/"+str(len(ranges))+" chunks of "+tostr(f.path)+"...")
+
+	with ThreadPoolExecutor(max_workers=chunk_streams + 1) as pool:
+		remotesums = pool.submit(hash_chunks, sshSrc, src, ranges) if srcsums is None and sshSrc is not None else None
+		sent = list(pool.map(lambda i: send_chunk(sshSrc, src, sshDst, tmp, *ranges[i]), todo))
+		if srcsums is None:
+			srcsums = remotesums.result() if remotesums is not None else dict(zip(todo, sent))
+
+	# the other chunks already matched
+	received = hash_chunks(sshDst, tmp, [ranges[i] for i in todo])
+	if any(digest != srcsums[i] for i, digest in zip(todo, received)):
+		return False
+	finish_chunked(sshDst, dst, tmp, f)
+	return True
+
+def chunked_lane(sshSrc,dirnameSrc, sshDst,dirnameDst, name, files, background, progress, concurrency):
+	if not check_connections(sshSrc or sshDst):
+		return rsync_lane(sshSrc,dirnameSrc, sshDst,dirnameDst, "delta", files, background, progress, concurrency)
+	failed = []
+	for f in files:
+		try:
+			ok = chunked_transfer(sshSrc,dirnameSrc, sshDst,dirnameDst, f)
+		except (OSError, subprocess.CalledProcessError):
+			ok = False
+		if ok:
+			progress.done(f.path)
+			journal.done(progress.direction+":transfers", [f.path])
+		else:
+			printv("Chunked transfer of "+tostr(f.path)+" failed, sending it with rsync...")
+			failed.append(f)
+	if failed:
+		return rsync_lane(sshSrc,dirnameSrc, sshDst,dirnameDst, "delta", failed, background, progress, concurrency)
+	return 0
+
+##### hard links and sparse files
+# hard links are found from the inodes of the scan: files of one side with the same
+# inode (and size and date, in case the tree spans several filesystems) are the same
+# file. Only one of them is transferred, the others are hard linked to it.
+# sparse files (at least sparse_min_size bytes of holes) are sent with rsync --sparse.
+sparse_min_size = 1 << 20
+sparse = {}	# path --> bytes of holes
+
+def link_key(f):
+	return (f.i, f.size, f.date)
+
+# remove hard links from copies and syncs: (path with the content on the destination, path to link)
+def plan_links(copy, sync, moves):
+	present = {link_key(targetfile): targetfile.path for fromfile, targetfile in moves if targetfile.type == "f"}
+	links = []
+	transfers = []
+	for files in (sync, copy):
+		kept = []
+		for f in files:
+			if f.type == "f" and link_key(f) in present:
+				links.append((present[link_key(f)], f))
+			else:
+				if f.type == "f":
+					present[link_key(f)] = f.path
+				kept.append(f)
+		transfers.append(kept)
+	sync, copy = transfers
+	return copy, sync, links
+
+# bytes of holes of the large files to transfer from one side, if at least sparse_min_size
+def find_sparse(ssh, dirname, files):
+	candidates = [f for f in files if f.type == "f" and int(f.size) >= sparse_min_size]
+	if not candidates:
+		return {}
+	allocated = {}
+	if ssh is None:
+		for f in candidates:
+			try:
+				allocated[f.path] = os.lstat(os.path.join(os.fsencode(dirname), f.path)).st_blocks * 512
+			except OSError:
+				pass
+	else:
+		# (file names that are not UTF-8 are passed as they are)
+		paths = [os.path.join(dirname, os.fsdecode(f.path)) for f in candidates]
+		for batch in batches(paths, batch_size):
+			# files that vanished or cannot be read are left out (not sparse)
+			out = ssh.run(ssh.findcmd, *batch, "-maxdepth", "0", "-printf", "%b\\0%p\\0",
+				stdout=subprocess.PIPE).run().stdout or b""
+			fields = out.split(b"\0")
+			for blocks, path in zip(fields[0::2], fields[1::2]):
+				if blocks.isdigit():
+					allocated[os.path.relpath(path, os.fsencode(dirname))] = int(blocks) * 512
+	holes = {f.path: int(f.size) - allocated[f.path] for f in candidates if f.path in allocated}
+	return {path: n for path, n in holes.items() if n >= sparse_min_size}
+
+# hard links to files already transferred
+def apply_links(ssh, dirname, links, direction):
+	if not links:
+		return
+	finish_pipelines()
+	pairs = [(os.path.join(dirname, target.decode("utf8")), os.path.join(dirname, f.path.decode("utf8")), f)
+			 for target, f in links]
+	if ssh is None:
+		for src, dst, f in pairs:
+			# replace the destination atomically
+			tmp = dst+".bsync-link"
+			if f.path in clones:
+				with open(src, "rb") as fdSrc, open(tmp, "wb") as fdDst:
+					copy_data(fdSrc.fileno(), fdDst.fileno(), os.fstat(fdSrc.fileno()).st_size, False)
+				if f.perms != "":
+					os.chmod(tmp, int(f.perms, 8))
+				os.utime(tmp, (int(f.date), int(f.date)))
+			else:
+				os.link(src, tmp)
+			os.replace(tmp, dst)
+	else:
+		cmds = []
+		for src, dst, f in pairs:
+			if f.path in clones:
+				cmd = "cp --reflink=auto "+quote(src)+" "+quote(dst)
+				if f.perms != "":
+					cmd += " && chmod "+f.perms+" "+quote(dst)
+				cmds.append(cmd+" && touch -m -d @"+f.date+" "+quote(dst))
+			else:
+				cmds.append("ln -f "+quote(src)+" "+quote(dst))
+		for batch in batches(cmds, batch_size):
+			ssh.run(NoQuote(" ; ".join(batch))).run()
+	journal.done(direction+":links")
+
+def rsync_init(sshSrc,dirnameSrc, sshDst,dirnameDst, extraargs=[]):
 	#rsync ssh/dir1 --> local/dir2
 	#rsync local/dir1 --> ssh/dir2
 	#
@@ -257,47 +1060,64 @@ def rsync_init(sshSrc,dirnameSrc, sshDst,dirnameDst):
 	rsyncdst = getdirstr(sshDst, dirnameDst)+"/"
 
 	args = [ "-a", "--files-from=-", "--from0", "--no-implied-dirs", "--out-format=rsync: %n%L" ]
-	if ssh != None:
-		cmdlist = ssh.getcmdlist()
-		cmdlist.remove(ssh.userhost)
+	args += extraargs
+
+	if sshSrc is not None and sshDst is not None:
+		# remote to remote: rsync runs on the source host and connects to the destination
+		# itself, only the file list and the progress lines go through this host
+		args.append("-e "+joinargs(sshDst.getremotecmdlist()))
+		args += rsync_path_args()
+		return sshSrc.popen("rsync", *args, dirnameSrc+"/", sshDst.userhost+":"+dirnameDst+"/",
+			stdin=subprocess.PIPE, stdout=subprocess.PIPE).run()
+
+	remote = sshSrc or sshDst
+	if remote != None:
+		cmdlist = remote.getcmdlist()
+		cmdlist.remove(remote.userhost)
 		args.append("-e "+joinargs(cmdlist))
+		args += rsync_path_args()
 
-	return Popen("rsync", *args, rsyncsrc, rsyncdst, stdin=subprocess.PIPE).run()
+	return Popen("rsync", *args, rsyncsrc, rsyncdst, stdin=subprocess.PIPE, stdout=subprocess.PIPE).run()
 
-def rsync_check_install(ssh):
-	cmd = And(
+def rsync_check_install(ssh1, ssh2):
+	cmd = Gather(
 		Run("rsync", "--version"),
-		ssh.run("rsync", "--version") if ssh is not None else True,
+		ssh1.run("rsync", "--version") if ssh1 is not None else True,
+		ssh2.run("rsync", "--version") if ssh2 is not None else True,
 	)
 	ret = cmd.run().returncode
 	if ret != 0:
 		sys.exit("Error: please check that rsync is installed (both local and remote sides)")
 
-# check if find supports printf option, and also remote find if ssh needed
-def find_check_command(ssh):
-	localfind = remotefind = None
+# check if find supports printf option, and also remote finds (stored in ssh.findcmd)
+def find_check_command(*sshs):
+	localfind = None
 	findhelp = "(On OSX, you can download it with 'brew install findutils')"
 	findargs = ["-maxdepth", "0" ,"-printf", "OK"]
+	sshs = [ssh for ssh in sshs if ssh is not None]
 
-	try:
-		CheckCall("find", *findargs).run()
+	# probe all candidates at once, a missing command returns an exception
+	probes = [Call("find", *findargs), Call("gfind", *findargs)]
+	for ssh in sshs:
+		probes += [ssh.call("find", *findargs), ssh.call("gfind", *findargs)]
+	results = run_concurrently(*probes)
+
+	if results[0] == 0:
 		localfind = "find"
-	except:
-		try:
-			CheckCall("gfind", *findargs).run()
-			localfind = "gfind"
-		except:
-			sys.exit("Error: local GNU find not found. "+findhelp)
+	elif results[1] == 0:
+		localfind = "gfind"
+	else:
+		sys.exit("Error: local GNU find not found. "+findhelp)
 
-	if ssh != None:
-		if ssh.call("find", *findargs).run() == 0:
-			remotefind = "find"
-		elif ssh.call("gfind", *findargs).run() == 0:
-			remotefind = "gfind"
+	for i, ssh in enumerate(sshs):
+		if results[2+2*i] == 0:
+			ssh.findcmd = "find"
+		elif results[3+2*i] == 0:
+			ssh.findcmd = "gfind"
 		else:
-			sys.exit("Error: remote GNU find not found. "+findhelp)
+			sys.exit("Error: remote GNU find not found on "+ssh.userhost+". "+findhelp)
 
-	return localfind, remotefind
+	return localfind
 
 # TODO
 # # check if the filesystem supports permissions
@@ -330,12 +1150,20 @@ def rsync_check(sshSrc,dirnameSrc, sshDst,dirnameDst):
 	rsyncdst = getdirstr(sshDst, dirnameDst)+"/"
 
 	args = [ "-anO", "--delete", "--out-format=%n%L", "--exclude=/.bsync-snap-*" ]
-	if ssh != None:
-		args.append("-e "+ssh.getcmdstr())
-
-	diff = CheckOutput(
-		"rsync", *args, rsyncsrc, rsyncdst, universal_newlines=True
-	).run().split("\n")
+	if sshSrc is not None and sshDst is not None:
+		args.append("-e "+joinargs(sshDst.getremotecmdlist()))
+		args += rsync_path_args()
+		diff = sshSrc.check_output(
+			"rsync", *args, dirnameSrc+"/", sshDst.userhost+":"+dirnameDst+"/", universal_newlines=True
+		).run().split("\n")
+	else:
+		remote = sshSrc or sshDst
+		if remote != None:
+			args.append("-e "+remote.getcmdstr())
+			args += rsync_path_args()
+		diff = CheckOutput(
+			"rsync", *args, rsyncsrc, rsyncdst, universal_newlines=True
+		).run().split("\n")
 
 	diff.remove("")
 	diff.remove("./")
@@ -343,19 +1171,390 @@ def rsync_check(sshSrc,dirnameSrc, sshDst,dirnameDst):
 	if len(diff) != 0:
 		sys.exit("Error: rsync_check differences:\n"+str(diff))
 
+##### incremental verification (-c)
+# instead of comparing both whole trees (--full-check), only the paths touched by
+# this run and a random sample of the unchanged ones are checked: same metadata
+# on both sides and, for files, same content hash where both sides have one in
+# their hash cache. Hashes are kept in a local cache per directory, valid as long
+# as the inode, size, date and change time of the file do not change. Files are
+# not read to check them (a large transfer would be read again on both ends),
+# unless --verify-hash is given: then missing hashes are computed and cached.
+verify_sample = 100
+verify_hash = False
+sample = []	# reservoir sample of the unchanged paths seen while classifying
+sampled = 0
+
+def sample_path(path):
+	global sampled
+	sampled += 1
+	if len(sample) < verify_sample:
+		sample.append(path)
+	else:
+		i = random.randrange(sampled)
+		if i < verify_sample:
+			sample[i] = path
+
+# current records of some paths (missing paths are not in the result)
+# records also get the change time of the file, which cannot be set back like
+# the date, so that the hash cache notices files rewritten in place
+def stat_paths(ssh, dirname, paths):
+	records = {}
+	if ssh is None:
+		for path in paths:
+			try:
+				st = os.lstat(os.path.join(os.fsencode(dirname), path))
+			except FileNotFoundError:
+				continue
+			i,p,t,d,sz,perms = normalize_record(*stat_record(st, path))
+			records[path] = DirFile(i,p,t,d,sz,perms)
+			records[path].ctime = str(st.st_ctime_ns)
+	else:
+		fmt = findformat.replace("%P", "%p") + "%C@\\0"
+		for batch in batches([os.path.join(dirname, path.decode("utf8")) for path in paths], batch_size):
+			out = ssh.popen(ssh.findcmd, *batch, "-maxdepth", "0", "-printf", fmt,
+				stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).run()
+			gen = fileLineIter(out.stdout)
+			record = read_file_record(gen)
+			while record is not None:
+				i,p,t,d,sz,perms = record
+				path = os.path.relpath(p, os.fsencode(dirname))
+				records[path] = DirFile(i,path,t,d,sz,perms)
+				records[path].ctime = next(gen).decode()
+				record = read_file_record(gen)
+			out.wait()
+	return records
+
+# sha1 of the content of some files
+def hash_paths(ssh, dirname, paths):
+	sums = {}
+	if ssh is None:
+		for path in paths:
+			h = hashlib.sha1()
+			try:
+				with open(os.path.join(os.fsencode(dirname), path), "rb") as fd:
+					for chunk in iter(lambda: fd.read(1 << 20), b""):
+						h.update(chunk)
+			except OSError:
+				continue
+			sums[path] = h.hexdigest()
+	else:
+		for batch in batches([os.path.join(dirname, path.decode("utf8")) for path in paths], batch_size):
+			out = ssh.check_output("sha1sum", "-z", "--", *batch, stderr=subprocess.DEVNULL).run()
+			for line in out.split(b"\0"):
+				if line:
+					digest, path = line.split(b"  ", 1)
+					sums[os.path.relpath(path, os.fsencode(dirname))] = digest.decode()
+	return sums
+
+class SumCache():
+	def __init__(self, ssh, dirname):
+		key = hashlib.sha1(getdirstr(ssh, dirname).encode(errors="surrogateescape")).hexdigest()[:16]
+		self.name = os.path.join("sums", key+".json")
+		self.sums = {os.fsencode(path): entry for path, entry in get_config(self.name).items()}
+		self.changed = {}	# path --> entry, or None if removed
+
+	# cached hash of a file, if its record did not change since
+	def get(self, f):
+		entry = self.sums.get(f.path)
+		if entry is not None and entry[:4] == [f.i, f.size, f.date, f.ctime]:
+			return entry[4]
+		return None
+
+	def set(self, f, digest):
+		self.sums[f.path] = self.changed[f.path] = [f.i, f.size, f.date, f.ctime, digest]
+
+	def remove(self, path):
+		self.sums.pop(path, None)
+		self.changed[path] = None
+
+	# only the changes are written: other syncs of the directory may have saved theirs
+	def save(self):
+		if not self.changed:
+			return
+		with locked_config(self.name):
+			sums = get_config(self.name)
+			for path, entry in self.changed.items():
+				if entry is None:
+					sums.pop(os.fsdecode(path), None)
+				else:
+					sums[os.fsdecode(path)] = entry
+			write_config(self.name, sums, silent=True)
+		self.changed = {}
+
+# hashes of files on one side, from the cache or computed (and then cached)
+# with compute=False, files without a cached hash are left out
+def file_hashes(ssh, dirname, files, cache, compute=True):
+	hashes = {}
+	missing = []
+	for f in files:
+		digest = cache.get(f)
+		if digest is None:
+			missing.append(f)
+		else:
+			hashes[f.path] = digest
+	if not compute:
+		return hashes
+	computed = hash_paths(ssh, dirname, [f.path for f in missing])
+	for f in missing:
+		if f.path in computed:
+			cache.set(f, computed[f.path])
+			hashes[f.path] = computed[f.path]
+	return hashes
+
+# check that touched paths and a sample of the others are the same on both sides,
+# and that removed paths are gone from both
+def verify(touched, removed):
+	paths = sorted(set(touched) | set(sample))
+	removed = sorted(set(removed) - set(touched))
+	printv("Verifying "+str(len(paths))+" paths ("+str(len(set(sample)-set(touched)))+" sampled)...")
+
+	records1 = stat_paths(ssh1, dir1name, paths + removed)
+	records2 = stat_paths(ssh2, dir2name, paths + removed)
+	cache1 = SumCache(ssh1, dir1name)
+	cache2 = SumCache(ssh2, dir2name)
+
+	diff = []
+	files = []
+	for path in paths:
+		f1 = records1.get(path)
+		f2 = records2.get(path)
+		if f1 is None or f2 is None or not samefiles(f1, f2):
+			diff.append(path)
+		elif f1.type == "f":
+			files.append((f1, f2))
+	for path in removed:
+		if path in records1 or path in records2:
+			diff.append(path)
+		cache1.remove(path)
+		cache2.remove(path)
+
+	hashes1 = file_hashes(ssh1, dir1name, [f1 for f1, f2 in files], cache1, verify_hash)
+	hashes2 = file_hashes(ssh2, dir2name, [f2 for f1, f2 in files], cache2, verify_hash)
+	for f1, f2 in files:
+		if verify_hash and hashes1.get(f1.path) is None:
+			diff.append(f1.path)
+		elif f1.path in hashes1 and f2.path in hashes2 and hashes1[f1.path] != hashes2[f2.path]:
+			# without --verify-hash, files with a hash on one side only are checked by metadata
+			diff.append(f1.path)
+
+	cache1.save()
+	cache2.save()
+	if len(diff) != 0:
+		sys.exit("Error: verification differences:\n"+"\n".join(tostr(path) for path in sorted(diff)))
+
+# paths touched (written or created) and removed by the planned actions
+def touched_paths():
+	touched = []
+	removed = []
+	for mkdirs, moves, rm, rmdirs, copy, sync, links, direction in (
+		(mkdir1,moves1,rm1,rmdirs1, copy21,sync21, links1, "21"),
+		(mkdir2,moves2,rm2,rmdirs2, copy12,sync12, links2, "12"),
+	):
+		touched += [f.path for f in mkdirs + copy + sync + pipelined_files(direction)]
+		touched += [targetfile.path for fromfile, targetfile in moves]
+		touched += [f.path for target, f in links]
+		removed += [fromfile.path for fromfile, targetfile in moves]
+		removed += [f.path for f in rm.values()]
+		removed += rmdirs
+	return touched, removed
+
+# -c: incremental verification, or the full rsync comparison of both trees
+def check_dirs():
+	if full_check:
+		rsync_check(ssh1,dir1name, ssh2,dir2name)
+	else:
+		verify(*touched_paths())
+
+##### destination-side deduplication
+# a new file may already be on the destination under another path (vendored
+# libraries, copied datasets, copy-then-edit). New files of at least dedup_min_size
+# bytes with the size of a destination file are hashed on both sides, with the hash
+# caches of -c: identical ones are copied on the destination instead of being sent
+# (a reflink where supported), after the transfers like hard links. Other large new
+# files are sent as a delta from a destination file with the same name and a close
+# size, copied to the new path first. Only files that this sync leaves untouched on
+# the destination are used. Not done with --stream: the indexes would hold the
+# large files of both sides in memory.
+dedup = True
+dedup_min_size = 64 * 1024
+clones = set()	# paths of links that are copies of identical content
+bases = {}	# path --> destination file copied to path, as a delta basis
+index1 = defaultdict(list)	# size --> files of dir1
+index2 = defaultdict(list)
+names1 = defaultdict(list)	# file name --> large files of dir1
+names2 = defaultdict(list)
+
+def index_file(f, index, names):
+	if f.type != "f":
+		return
+	size = int(f.size)
+	if size >= dedup_min_size:
+		index[size].append(f)
+	if size >= delta_min_size:
+		names[os.path.basename(f.path)].append(f)
+
+# sha1 of the content of files, from the hash cache where they did not change
+# (with compute=False, only the cached ones)
+def content_hashes(ssh, dirname, paths, compute=True):
+	records = stat_paths(ssh, dirname, paths)
+	cache = SumCache(ssh, dirname)
+	hashes = file_hashes(ssh, dirname, [f for f in records.values() if f.type == "f"], cache, compute)
+	cache.save()
+	return hashes
+
+# copies found on the destination become links (in clones), bases are set for others
+def plan_dedup(sshSrc,dirnameSrc, sshDst,dirnameDst, copy, sync, moves, rm, links, index, names):
+	busy = set(f.path for f in sync) | set(f.path for f in rm.values())
+	busy |= set(fromfile.path for fromfile, targetfile in moves)
+	def present(files):
+		return [g for g in files if g.path not in busy]
+
+	candidates = [f for f in copy if f.type == "f" and int(f.size) >= dedup_min_size and present(index.get(int(f.size), []))]
+	identical = {}
+	if candidates:
+		others = [g for size in set(int(f.size) for f in candidates) for g in present(index[size])]
+		printv("Looking for "+str(len(candidates))+" new files among "+str(len(others))+" destination files...")
+		srcsums = content_hashes(sshSrc, dirnameSrc, [f.path for f in candidates])
+		dstsums = content_hashes(sshDst, dirnameDst, [g.path for g in others])
+		bysum = {}
+		for g in others:
+			if g.path in dstsums:
+				bysum.setdefault((g.size, dstsums[g.path]), g.path)
+		for f in candidates:
+			if f.path in srcsums and (f.size, srcsums[f.path]) in bysum:
+				identical[f.path] = bysum[(f.size, srcsums[f.path])]
+
+	kept = []
+	for f in copy:
+		if f.path in identical:
+			links.append((identical[f.path], f))
+			clones.add(f.path)
+			continue
+		kept.append(f)
+		size = int(f.size)
+		if f.type == "f" and size >= delta_min_size:
+			similar = [g for g in present(names.get(os.path.basename(f.path), []))
+					   if size <= 2 * int(g.size) and int(g.size) <= 2 * size]
+			if similar:
+				bases[f.path] = min(similar, key=lambda g: abs(int(g.size) - size)).path
+	return kept, links
+
+# copy the delta bases of new files to their paths, before the transfers
+# (through a temporary file: an interrupted copy must not leave a partial file
+# that the next scan would take for a new one)
+def copy_bases(ssh, dirname, files):
+	pairs = [(os.path.join(dirname, bases[f.path].decode("utf8")), os.path.join(dirname, f.path.decode("utf8")))
+			 for f in files]
+	if ssh is None:
+		for src, dst in pairs:
+			tmp = dst+".bsync-basis"
+			try:
+				with open(src, "rb") as fdSrc, open(tmp, "wb") as fdDst:
+					copy_data(fdSrc.fileno(), fdDst.fileno(), os.fstat(fdSrc.fileno()).st_size, False)
+				os.replace(tmp, dst)
+			except OSError:
+				# then sent whole
+				try:
+					os.unlink(tmp)
+				except OSError:
+					pass
+	else:
+		cmds = ["{ cp --reflink=auto "+quote(src)+" "+quote(dst+".bsync-basis")+" && mv -f "+quote(dst+".bsync-basis")+" "+quote(dst)
+				+" || rm -f "+quote(dst+".bsync-basis")+"; } 2>/dev/null" for src, dst in pairs]
+		for batch in batches(cmds, batch_size):
+			ssh.run(NoQuote(" ; ".join(batch))).run()
+
+##### metadata-only changes
+# after a chmod -R, or a restore that keeps contents but not dates, every file is
+# a sync, and rsync reads each one on both ends to find nothing to send. A sync to
+# a file of the same size is only a chmod and a date change when the dates are the
+# same (the quick check of rsync: only the permissions differ), or when the content
+# is confirmed: by the sha1 of both files, or by the user (size: a same size is
+# enough, for restores known to keep contents). By default (cached), only hashes
+# already in the caches of -c are compared: an in-place edit of a large image keeps
+# its size, and hashing it would read it in full on both ends before the transfer.
+# With hash, missing hashes are computed.
+meta_only = "cached"
+metaonly = set()	# paths of syncs applied with chmod and touch, without a transfer
+peers = {}	# path --> (f1, f2) of files of the same size that differ
+
+def note_peers(path, f1, f2):
+	if f1 is not None and f2 is not None and f1.type == "f" and f2.type == "f" \
+			and f1.size == f2.size and not samefiles(f1, f2):
+		peers[path] = (f1, f2)
+
+# mark the syncs that do not need a transfer (in metaonly)
+def plan_metaonly(sshSrc,dirnameSrc, sshDst,dirnameDst, sync, direction):
+	candidates = []
+	for f in sync:
+		if f.path not in peers:
+			continue
+		f1, f2 = peers[f.path]
+		g = f2 if direction == "12" else f1
+		if g.date == f.date or meta_only == "size":
+			metaonly.add(f.path)
+		else:
+			candidates.append(f.path)
+	if candidates:
+		printv("Comparing "+str(len(candidates))+" files that changed dates only...")
+		srcsums = content_hashes(sshSrc, dirnameSrc, candidates, meta_only == "hash")
+		dstsums = content_hashes(sshDst, dirnameDst, candidates, meta_only == "hash")
+		metaonly.update(path for path in candidates if path in srcsums and srcsums[path] == dstsums.get(path))
+
+# set permissions and dates on the destination, instead of a transfer
+def meta_lane(sshSrc,dirnameSrc, sshDst,dirnameDst, name, files, background, progress, concurrency):
+	failed = []
+	if sshDst is None:
+		for f in files:
+			ops.wait()
+			path = os.path.join(os.fsencode(dirnameDst), f.path)
+			try:
+				if f.perms != "":
+					os.chmod(path, int(f.perms, 8))
+				os.utime(path, (int(f.date), int(f.date)))
+			except OSError:
+				failed.append(f)
+				continue
+			progress.done(f.path)
+	else:
+		cmds = []
+		for f in files:
+			dst = quote(os.path.join(dirnameDst, f.path.decode("utf8")))
+			cmd = "chmod "+f.perms+" "+dst+" && " if f.perms != "" else ""
+			cmds.append(cmd+"touch -c -m -d @"+f.date+" "+dst)
+		start = 0
+		for batch in batches(cmds, batch_size):
+			group = files[start:start+len(batch)]
+			start += len(batch)
+			ops.wait(len(batch))
+			try:
+				sshDst.check_call(NoQuote(" && ".join(batch))).run()
+			except subprocess.CalledProcessError:
+				failed += group
+				continue
+			for f in group:
+				progress.done(f.path)
+	journal.done(progress.direction+":transfers", [f.path for f in files if f not in failed])
+
+	if failed:
+		printv("Setting metadata of "+str(len(failed))+" paths failed, sending them with rsync...")
+		return rsync_lane(sshSrc,dirnameSrc, sshDst,dirnameDst, "delta", failed, background, progress, concurrency)
+	return 0
+
 # take a snapshot of files states from dir, using find. store it in .bsync-snap-XXXX
 # snap format: inode, path, type, date...
-def make_snapshot(ssh,dirname, oldsnapname, newsnapname):
-	global findformat, findcmdlocal, findcmdremote
+def snapshot_command(ssh,dirname, oldsnapname, newsnapname):
+	global findformat, findcmdlocal
 
-	findcmd = [dirname, "-fprintf", os.path.join(dirname, newsnapname), f"'{findformat}'"]
+	findcmd = [dirname, "-fprintf", os.path.join(dirname, newsnapname), findformat]
 	oldsnap = oldsnapname and os.path.join(dirname, oldsnapname)
 	newsnap = os.path.join(dirname, newsnapname)
 
 	if ssh is None:
 		cmd = Or(
 			And(
-				Run(findcmdlocal, *findcmd),
+				Function(write_native_snapshot, dirname, newsnap, ignores) if scanner == "native"
+				else Run(findcmdlocal, *findcmd),
 				True if oldsnapname is None else Run("rm", "-f", oldsnap)
 			),
 			And(
@@ -367,7 +1566,8 @@ def make_snapshot(ssh,dirname, oldsnapname, newsnapname):
 	else:
 		cmd = Or(
 			And(
-				ssh.run(findcmdremote, *findcmd),
+				ssh.run(NoQuote(parallel_find_script(ssh.findcmd, dirname, newsnap))) if walkers > 1
+				else ssh.run(ssh.findcmd, *findcmd),
 				True if oldsnapname is None else ssh.run("rm", "-f", oldsnap)
 			),
 			And(
@@ -376,23 +1576,187 @@ def make_snapshot(ssh,dirname, oldsnapname, newsnapname):
 			)
 		)
 
-	ret = cmd.run().returncode
-	if ret != 0: sys.exit("Error making a snapshot.")
+	return cmd
 
+# both snapshots are taken at the same time
 def make_snapshots(ssh1,dir1name, ssh2,dir2name, oldsnapname):
 	newsnapname = ".bsync-snap-"+datetime.datetime.now().strftime("%Y%m%d%H%M%S.%f")
 	print("Updating filelists...")
 	printv("Updating snap files: "+newsnapname+"...")
-	make_snapshot(ssh1,dir1name, oldsnapname,newsnapname)
-	make_snapshot(ssh2,dir2name, oldsnapname,newsnapname)
+	ret = Gather(
+		snapshot_command(ssh1,dir1name, oldsnapname,newsnapname),
+		snapshot_command(ssh2,dir2name, oldsnapname,newsnapname),
+	).run().returncode
+	if ret != 0: sys.exit("Error making a snapshot.")
+	return newsnapname
+
+##### subtree syncs: reuse the snapshot of an already synced parent root
+# the snapshot of the root is read and updated only for the slice of the subtree
+
+# find a synced parent root common to both sides: the same number of levels up,
+# with the same directory names in between
+# returns (root1, root2, prefix, snapname) or None
+def find_snap_root(ssh1,dir1name, ssh2,dir2name):
+	parts1 = dir1name.rstrip("/").split("/")
+	parts2 = dir2name.rstrip("/").split("/")
+	candidates = []
+	for k in range(1, min(len(parts1), len(parts2)) + 1):
+		if parts1[-k] != parts2[-k] or parts1[-k] == "":
+			break
+		root1 = "/".join(parts1[:-k]) or ("/" if dir1name.startswith("/") else ".")
+		root2 = "/".join(parts2[:-k]) or ("/" if dir2name.startswith("/") else ".")
+		candidates.append((root1, root2, "/".join(parts1[-k:])))
+	if not candidates:
+		return None
+
+	snaps1 = list_snaps(ssh1, [c[0] for c in candidates])
+	snaps2 = list_snaps(ssh2, [c[1] for c in candidates])
+	for root1, root2, prefix in candidates: # nearest parent first
+		common = snaps1.get(root1, set()) & snaps2.get(root2, set())
+		if common:
+			return root1, root2, prefix.encode(), max(common)
+	return None
+
+# .bsync-snap-* filenames in each of dirnames, in one round trip for a remote
+def list_snaps(ssh, dirnames):
+	snaps = defaultdict(set)
+	if ssh is None:
+		for dirname in dirnames:
+			try:
+				snaps[dirname] = {f for f in os.listdir(dirname) if f.startswith(".bsync-snap-")}
+			except OSError:
+				pass
+	else:
+		script = "for d in "+" ".join(quote(d) for d in dirnames)+"; do ls -1d \"$d\"/.bsync-snap-*; done 2>/dev/null; true"
+		out = ssh.check_output(NoQuote(script), universal_newlines=True).run()
+		for line in out.split("\n"):
+			if line:
+				dirname, name = line.rsplit("/", 1)
+				snaps[dirname].add(name)
+	return snaps
+
+# ignore patterns of a root apply to root-relative paths: check prefix/path
+def subtree_ignores(ignores, rootignores, prefix):
+	prefix = prefix.decode("utf-8")+"/"
+	return lambda path: ignores(path) or rootignores(prefix+path)
+
+# remove the records of a slice (prefix and everything below it) from a snapshot
+# raw records are kept as they are, without the conversions of read_file_record
+snap_filter_script = r"""
+import os, sys
+old, new, prefix = sys.argv[1], sys.argv[2], os.fsencode(sys.argv[3])
+fin = sys.stdin.buffer if old == "-" else open(old, "rb")
+fout = sys.stdout.buffer if new == "-" else open(new, "wb")
+fields, partial = [], b""
+while True:
+	chunk = fin.read(1 << 20)
+	if not chunk: break
+	parts = (partial + chunk).split(b"\0")
+	partial = parts.pop()
+	for part in parts:
+		fields.append(part)
+		if len(fields) == 6:
+			if fields[1] != prefix and not fields[1].startswith(prefix + b"/"):
+				fout.write(b"\0".join(fields) + b"\0")
+			fields = []
+fout.close()
+"""
+
+# write the snapshot of a root with the slice of a subtree updated, in tmpname
+# the root is not scanned: only the subtree is, its records are prefixed with the subtree path
+def snapshot_slice_command(ssh, root, prefix, oldsnapname, tmpname):
+	global findformat, findcmdlocal
+
+	oldsnap = os.path.join(root, oldsnapname)
+	tmpsnap = os.path.join(root, tmpname)
+	prefix = prefix.decode("utf8")
+	# %p is relative to the root when find starts from prefix in the root
+	# (and so is tmpname, root may be relative to the current directory)
+	slicefind = "cd "+quote(root)+" && {} "+quote(prefix)+" -printf "+quote(findformat.replace("%P", "%p"))+" >> "+quote(tmpname)
+
+	if ssh is None:
+		cmd = And(
+			Run(sys.executable, "-c", snap_filter_script, oldsnap, tmpsnap, prefix),
+			Run("sh", "-c", slicefind.format(findcmdlocal)),
+		)
+
+	else:
+		cmd = And(
+			Or(
+				ssh.run("python3", "-c", snap_filter_script, oldsnap, tmpsnap, prefix),
+				# no python on the remote: filter locally and send the slice back
+				And(
+					ssh.run("rm", "-f", tmpsnap),
+					Run("sh", "-c", ssh.getcmdstr()+" "+quote("cat "+quote(oldsnap))
+						+" | "+quote(sys.executable)+" -c "+quote(snap_filter_script)
+						+" - - "+quote(prefix)
+						+" | "+ssh.getcmdstr()+" "+quote("cat > "+quote(tmpsnap)))
+				)
+			),
+			ssh.run(NoQuote(slicefind.format(ssh.findcmd))),
+		)
+
+	return cmd
+
+def root_command(ssh, *args):
+	return Run(*args) if ssh is None else ssh.run(*args)
+
+# the new snapshots replace the old ones only once both sides are written: if
+# one side fails, both roots keep their common snapshot
+def make_snapshot_slices(ssh1,root1, ssh2,root2, prefix, oldsnapname):
+	stamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S.%f")
+	newsnapname = ".bsync-snap-"+stamp
+	tmpname = ".bsync-slice-"+stamp
+	print("Updating filelists...")
+	printv("Updating "+tostr(prefix)+" in snap files: "+newsnapname+"...")
+	sides = ((ssh1, root1), (ssh2, root2))
+	ret = Gather(*(snapshot_slice_command(ssh,root, prefix, oldsnapname,tmpname) for ssh, root in sides)).run().returncode
+	if ret != 0:
+		Gather(*(root_command(ssh, "rm", "-f", os.path.join(root, tmpname)) for ssh, root in sides)).run()
+		sys.exit("Error updating the snapshot of the parent root")
+	ret = Gather(*(root_command(ssh, "mv", os.path.join(root, tmpname), os.path.join(root, newsnapname))
+		for ssh, root in sides)).run().returncode
+	if ret != 0:
+		sys.exit("Error updating the snapshot of the parent root")
+	Gather(*(root_command(ssh, "rm", "-f", os.path.join(root, oldsnapname)) for ssh, root in sides)).run()
+
+##### parallel remote scan (--walkers=N)
+# on network filesystems one find is bound by the latency of each stat call:
+# the top level is listed by one find, then each of its subdirectories is walked by
+# one of N concurrent find processes into its own file, and those outputs are
+# concatenated in (C locale) sorted order of the subdirectory names, so that the
+# listing does not depend on which walker finishes first.
+# directories starting with "-" cannot be given to find and stay with the top level find.
+def parallel_find_script(findcmd, dirname, output=None):
+	global findformat, walkers
+
+	fmt = quote(findformat)
+	subfmt = quote(findformat.replace("%P", "%p")) # walkers start from a path relative to dirname
+	walked = "-type d -path './[!-]*' ! -path './*/*'"
+	script = [
+		"cd "+quote(dirname)+" && tmp=$(mktemp -d) && mkdir \"$tmp/out\" || exit 1",
+		"trap 'rm -rf \"$tmp\"' EXIT",
+		"export LC_ALL=C",
+		"st=0",
+		findcmd+" . -mindepth 1 -maxdepth 1 -type d -name '[!-]*' -printf '%P\\0' | sort -z > \"$tmp/dirs\" || exit 1",
+		"{",
+		findcmd+" . "+walked+" -printf "+fmt+" -prune -o -printf "+fmt+" || st=1",
+		"xargs -0 -P "+str(walkers)+" -I{} "+findcmd+" {} -mindepth 1 -fprintf \"$tmp/out/{}\" "+subfmt+" < \"$tmp/dirs\" || st=1",
+		"(cd \"$tmp/out\" && xargs -0 cat) < \"$tmp/dirs\" || st=1",
+		"}" + ("" if output is None else " > "+quote(output)+" || st=1"),
+		"exit $st",
+	]
+	return "\n".join(script)
 
 # run find in a directory to dump its content
 def get_find_proc(ssh, dirname):
-	global findformat, findcmdlocal, findcmdremote
+	global findformat, findcmdlocal
 	if ssh==None:
 		return Popen(findcmdlocal, dirname, "-printf", findformat, stdout=subprocess.PIPE).run()
+	elif walkers > 1:
+		return ssh.popen(NoQuote(parallel_find_script(ssh.findcmd, dirname)), stdout=subprocess.PIPE).run()
 	else:
-		return ssh.popen(findcmdremote, dirname, "-printf", f"'{findformat}'", stdout=subprocess.PIPE).run()
+		return ssh.popen(ssh.findcmd, dirname, "-printf", findformat, stdout=subprocess.PIPE).run()
 
 # get a file descriptor to read the snapshot file
 def get_snap_fd(ssh, dirname, snapname):
@@ -470,6 +1834,8 @@ def get_ignores(ignorefile, ssh,dirname):
 def ignorepath(path, ignoreset):
 	if path == b"" or path.startswith(b".bsync-"):
 		return True
+	elif b"/"+partial_dir+b"/" in b"/"+path+b"/":
+		return True
 	else:
 		pp = path.decode("utf-8")
 		return ignoreset(path.decode("utf-8"))
@@ -518,14 +1884,213 @@ def read_file_record(gen):
 		else:
 			sys.exit("Error: snap filelists not coherent.")
 
+	return normalize_record(i,p,t,d,s,perms)
+
+def normalize_record(i,p,t,d,s,perms):
+	global ignoreperms
+
 	d = d.split(".")[0]	# truncate date to seconds
 	if t=="d": d=s="0"	# ignore dates/size for dirs (set to zero)
 	if ignoreperms: perms = ""
 
 	return i,p,t,d,s,perms
 
-# load original file records from snapshots, and ignore entries
-def load_orig(ssh1,dir1name, ssh2,dir2name):
+##### native local scanner (--scanner=native)
+# in-process replacement for find on local directories: a thread pool lists and
+# stats several directories at once, and ignored directories are not descended into
+# records are the same as find's findformat output
+
+def filetype(mode):
+	if stat.S_ISREG(mode): return "f"
+	if stat.S_ISDIR(mode): return "d"
+	if stat.S_ISLNK(mode): return "l"
+	if stat.S_ISBLK(mode): return "b"
+	if stat.S_ISCHR(mode): return "c"
+	if stat.S_ISFIFO(mode): return "p"
+	if stat.S_ISSOCK(mode): return "s"
+	return "U"
+
+# raw record of a stat result, like find prints it (date in whole seconds)
+def stat_record(st, path):
+	perms = stat.S_IMODE(st.st_mode)
+	secs = abs(st.st_mtime_ns) // 1000000000
+	date = str(secs if st.st_mtime_ns >= 0 else -secs)
+	return str(st.st_ino), path, filetype(st.st_mode), date, str(st.st_size), "0%o" % perms if perms else "0"
+
+# list one directory: records of its entries, and subdirectories to scan next
+def scan_dir(root, rel, ignores):
+	records = []
+	subdirs = []
+	with os.scandir(os.path.join(root, rel)) as it:
+		entries = list(it)
+	ops.wait(len(entries) + 1)
+	if inode_order:
+		# on spinning disks, stat calls in inode order avoid seeking back and forth
+		entries.sort(key=lambda entry: entry.inode())
+	for entry in entries:
+		path = os.path.join(rel, entry.name) if rel else entry.name
+		if ignorepath(path, ignores):
+			continue
+		try:
+			st = entry.stat(follow_symlinks=False)
+		except FileNotFoundError: # removed while scanning
+			continue
+		records.append(stat_record(st, path))
+		if stat.S_ISDIR(st.st_mode):
+			subdirs.append(path)
+	return records, subdirs
+
+# iterate on the raw records of a local directory, directories are scanned concurrently
+def scan_local(dirname, ignores):
+	root = os.fsencode(dirname)
+	yield stat_record(os.lstat(root), b"")
+	with ThreadPoolExecutor(max_workers=scan_threads) as pool:
+		pending = collections.deque([pool.submit(scan_dir, root, b"", ignores)])
+		while pending:
+			records, subdirs = pending.popleft().result()
+			yield from records
+			for path in subdirs:
+				pending.append(pool.submit(scan_dir, root, path, ignores))
+
+# write a snapshot of a local directory without find
+def write_native_snapshot(dirname, snappath, ignores):
+	with open(snappath, "wb") as fd:
+		write_records(fd, scan_local(dirname, ignores))
+
+##### git-aware scan (--git-scan)
+# a git working tree does not need to be walked: git status (fast with an fsmonitor
+# or the untracked cache) gives the paths that differ from HEAD, and the state saved
+# at the last sync gives the commit and the paths that differed then. Only those
+# paths, the commits in between and the paths git ignores are looked at, the rest
+# comes from the last snapshot. Changes of perms (other than the executable bit)
+# or dates alone, and new empty directories, are not seen in this mode: the
+# snapshots of both sides can then disagree on a path, which is looked at again
+# as a path without history.
+git_scan = False
+git_states = {}	# side --> (ssh, dirname, HEAD, paths that differ from HEAD)
+unsettled = set()	# paths on which the snapshots disagree
+
+def git_state_name(ssh, dirname):
+	key = hashlib.sha1(getdirstr(ssh, dirname).encode(errors="surrogateescape")).hexdigest()[:16]
+	return os.path.join("git", key+".json")
+
+# git status would otherwise refresh the index, a change to sync next time
+def git_output(ssh, dirname, *args):
+	cmd = ["git", "--no-optional-locks", "-C", dirname, *args]
+	if ssh is None:
+		return CheckOutput(*cmd, stderr=subprocess.DEVNULL).run()
+	return ssh.check_output(*cmd, stderr=subprocess.DEVNULL).run()
+
+# (HEAD, changed paths, ignored directories) of the root of a working tree, or None
+def git_status(ssh, dirname):
+	try:
+		if git_output(ssh, dirname, "rev-parse", "--show-prefix").strip() != b"":
+			return None	# not the root of the working tree
+		head = git_output(ssh, dirname, "rev-parse", "HEAD").strip().decode()
+		out = git_output(ssh, dirname, "status", "--porcelain", "-z", "--no-renames",
+			"--untracked-files=all", "--ignored=matching")
+	except (OSError, subprocess.CalledProcessError):
+		return None
+	changed = []
+	walk = []
+	for entry in out.split(b"\0"):
+		if entry:
+			path = entry[3:]
+			if path.endswith(b"/"):
+				walk.append(path.rstrip(b"/"))
+			else:
+				changed.append(path)
+	return head, changed, walk
+
+# records of whole subtrees
+def walk_records(ssh, dirname, subdirs):
+	records = {}
+	if not subdirs:
+		return records
+	cmd = [os.path.join(dirname, path.decode("utf8")) for path in subdirs] + ["-printf", findformat.replace("%P", "%p")]
+	if ssh is None:
+		proc = Popen(findcmdlocal, *cmd, stdout=subprocess.PIPE).run()
+	else:
+		proc = ssh.popen(ssh.findcmd, *cmd, stdout=subprocess.PIPE).run()
+	for i,p,t,d,sz,perms in file_records(fileLineIter(proc.stdout)):
+		path = os.path.relpath(p, os.fsencode(dirname))
+		records[path] = DirFile(i,path,t,d,sz,perms)
+	proc.wait()
+	return records
+
+# records of one side from git and the last snapshot, or None to scan it
+def git_dir(ssh, dirname, ignores, orig, side):
+	status = git_status(ssh, dirname)
+	if status is None:
+		return None
+	head, changed, walk = status
+	git_states[side] = (ssh, dirname, head, changed)
+
+	state = get_config(git_state_name(ssh, dirname))
+	if snapname is None or state.get("snapshot") != snapname:
+		return None
+	candidates = set(changed) | set(os.fsencode(path) for path in state["dirty"]) | unsettled
+	if state["head"] != head:
+		try:
+			out = git_output(ssh, dirname, "diff", "--name-only", "-z", "--no-renames", state["head"], head)
+		except (OSError, subprocess.CalledProcessError):
+			return None	# previous commit gone
+		candidates.update(path for path in out.split(b"\0") if path)
+	if not ignorepath(b".git", ignores):
+		walk.append(b".git")	# git does not report its own files
+	walk = [path for path in walk if not ignorepath(path, ignores)]
+
+	# new or removed parent directories
+	parents = set()
+	for path in candidates:
+		parent = os.path.dirname(path)
+		while parent and parent not in parents:
+			parents.add(parent)
+			parent = os.path.dirname(parent)
+	paths = sorted(path for path in candidates | parents if not ignorepath(path, ignores))
+	printv("git: checking "+str(len(paths))+" paths and "+str(len(walk))+" directories in "+getdirstr(ssh, dirname))
+	records = stat_paths(ssh, dirname, paths)
+	records.update(walk_records(ssh, dirname, walk))
+
+	outdated = set(walk) | set(path for path in parents if path not in records)
+	def current(path):
+		if path in candidates:
+			return False
+		while path:
+			if path in outdated:
+				return False
+			path = os.path.dirname(path)
+		return True
+
+	dir = collections.OrderedDict()
+	for path, fo in orig.items():
+		inode = fo.i1 if side == 1 else fo.i2
+		if inode is not None and path not in records and current(path):
+			dir[path] = DirFile(inode, path, fo.type, fo.date, fo.size, fo.perms)
+	for path, f in records.items():
+		if not ignorepath(path, ignores):
+			dir[path] = f
+	return dir
+
+# paths that the actions of a side changed
+def side_paths(mkdirs,moves,rm,rmdirs, copy,sync, links):
+	paths = [f.path for f in mkdirs + copy + sync] + list(rmdirs)
+	paths += [f.path for f in rm.values()] + [f.path for target, f in links]
+	paths += [fromfile.path for fromfile, targetfile in moves] + [targetfile.path for fromfile, targetfile in moves]
+	return paths
+
+# after a new snapshot: what differs from HEAD is what did at the scan, and what was changed
+def save_git_states(newsnapname):
+	for side, (ssh, dirname, head, changed) in git_states.items():
+		if side == 1:
+			paths = side_paths(mkdir1,moves1,rm1,rmdirs1, copy21+pipelined_files("21"),sync21, links1)
+		else:
+			paths = side_paths(mkdir2,moves2,rm2,rmdirs2, copy12+pipelined_files("12"),sync12, links2)
+		dirty = sorted(os.fsdecode(path) for path in set(changed) | set(paths))
+		write_config(git_state_name(ssh, dirname), {"snapshot": newsnapname, "head": head, "dirty": dirty}, silent=True)
+
+# find the most recent common snapshot, and load ignore entries
+def load_snapinfo(ssh1,dir1name, ssh2,dir2name):
 	global ignoreperms
 
 	snaps1, ignorefile1 = get_bsync_files(ssh1,dir1name)
@@ -554,81 +2119,231 @@ def load_orig(ssh1,dir1name, ssh2,dir2name):
 	ignores = parse_gitignore(all_ignores)
 
 	common_snaps = snaps1.intersection(snaps2)
-	orig = collections.OrderedDict()
 	if len(common_snaps) == 0:
-		print("Old filelist not found. Starting with empty history.")
-		return (None, orig, ignores) #empty snap and orig
+		return None, ignores
 
 	snapname = max(common_snaps) #the most recent snapshot
+	return snapname, ignores
 
-	printv("Loading "+snapname+"...")
-
-	fd1 = get_snap_fd(ssh1, dir1name, snapname)
-	fd2 = get_snap_fd(ssh2, dir2name, snapname)
-	gen1 = fileLineIter(fd1)
-	gen2 = fileLineIter(fd2)
-
-	# iterate on gen1 to fill orig
-	# first fill with 1st snap, then with 2nd snap, because the order can be different (in find output)
-	record = read_file_record(gen1)
-	if record==None: sys.exit("Error reading files from dir1 filelist") #should be at least one record (dir root)
-	while record != None:
-		inode,path,type,date,size,perms = record
-
-		if not ignorepath(path, ignores):
-			orig[path] = OrigFile(inode,None, path,type,date,size,perms)
-		
-		record = read_file_record(gen1)
-
-	# iterate on gen2, fill inodes for dir2 and check for consistency
-	record = read_file_record(gen2)
-	if record==None: sys.exit("Error reading files from dir2 filelist")
+# iterate on the file records of a find output or snapshot
+def file_records(gen):
+	record = read_file_record(gen)
 	while record != None:
-		inode,path,type,date,size,perms = record
+		yield record
+		record = read_file_record(gen)
 
-		if not ignorepath(path, ignores):
-			#path not in orig: can happen if using ignore, then removing ignore, path will be considered as new
-			if path in orig:
-				origfile = orig[path]
-				if origfile.type != type or origfile.date != date or origfile.size != size or origfile.perms != perms:
-					sys.exit("Error: difference in snaps for path: "+tostr(path)) 
+# iterate on the records of one side's snapshot, without ignored paths
+# with a prefix, only the slice of that subtree is read, with paths relative to it
+def snap_records(ssh, dirname, snapname, ignores, prefix=None):
+	fd = get_snap_fd(ssh, dirname, snapname)
+	first = True
+	for record in file_records(fileLineIter(fd)):
+		first = False
+		if prefix is not None:
+			path = record[1]
+			if path == prefix:
+				path = b""
+			elif path.startswith(prefix + b"/"):
+				path = path[len(prefix)+1:]
+			else:
+				continue
+			record = (record[0], path) + record[2:]
+		if not ignorepath(record[1], ignores):
+			yield record
+	fd.close()
+	if first: #should be at least one record (dir root)
+		sys.exit("Error reading files from "+getdirstr(ssh,dirname)+" filelist")
 
-				origfile.i2 = inode #set the second inode
-		
-		record = read_file_record(gen2)
+# load original file records from snapshots
+def load_orig(ssh1,dir1name, ssh2,dir2name, snapname, ignores, prefix=None):
+	orig = collections.OrderedDict()
+	if snapname is None:
+		return orig #empty orig
 
-	fd1.close()
-	fd2.close()
+	printv("Loading "+snapname+"...")
 
-	return snapname, orig, ignores
+	# iterate on the 1st snap to fill orig
+	# first fill with 1st snap, then with 2nd snap, because the order can be different (in find output)
+	for inode,path,type,date,size,perms in snap_records(ssh1, dir1name, snapname, ignores, prefix):
+		orig[path] = OrigFile(inode,None, path,type,date,size,perms)
+
+	# iterate on the 2nd snap, fill inodes for dir2 and check for consistency
+	for inode,path,type,date,size,perms in snap_records(ssh2, dir2name, snapname, ignores, prefix):
+		#path not in orig: can happen if using ignore, then removing ignore, path will be considered as new
+		if path in orig:
+			origfile = orig[path]
+			if origfile.type != type or origfile.date != date or origfile.size != size or origfile.perms != perms:
+				if git_scan:
+					# a change git does not report was missed, the path has no history
+					printv("Warning: difference in snaps for path: "+tostr(path))
+					unsettled.add(path)
+					del orig[path]
+					continue
+				sys.exit("Error: difference in snaps for path: "+tostr(path)) 
+
+			origfile.i2 = inode #set the second inode
+
+	return orig
 
 def getdirstr(ssh,dirname):
 	return dirname if ssh==None else ssh.userhost+":"+dirname
 
-# load actual directory content
-def load_dir(ssh, dirname, ignores):
-	dir = collections.OrderedDict()
+# iterate on the records of actual directory content, without ignored paths
+def dir_records(ssh, dirname, ignores):
+	if ssh is None and listing is not None and dirname == dir1name:
+		# shared listing of a fan-out (--listing), scanned once for all remotes
+		with open(listing, "rb") as fd:
+			for record in file_records(fileLineIter(fd)):
+				if not ignorepath(record[1], ignores):
+					yield record
+		return
+
+	if ssh is None and scanner == "native":
+		try:
+			for record in scan_local(dirname, ignores):
+				if not ignorepath(record[1], ignores):
+					yield normalize_record(*record)
+		except OSError as exc:
+			sys.exit("Scan Error in "+dirname+": "+str(exc))
+		return
 
 	proc = get_find_proc(ssh, dirname)
 	fd = proc.stdout
-	gen = fileLineIter(fd)
 
-	record = read_file_record(gen)
-	while record != None:
-		inode,path,type,date,size,perms = record
-
-		if not ignorepath(path, ignores):
-			dir[path] = DirFile(inode, path, type, date, size, perms)
-		
-		record = read_file_record(gen)
+	for record in file_records(fileLineIter(fd)):
+		if not ignorepath(record[1], ignores):
+			yield record
 
 	fd.close()
 	proc.wait()
 	if proc.returncode != 0:
 		sys.exit("Find Error in "+getdirstr(ssh,dirname))
-	
+
+# True if a directory has nothing but bsync files
+def is_empty(ssh, dirname):
+	if ssh is None:
+		with os.scandir(dirname) as it:
+			return all(entry.name.startswith(".bsync-") for entry in it)
+	else:
+		out = ssh.check_output(ssh.findcmd, dirname, "-mindepth", "1", "-maxdepth", "1",
+			"!", "-name", ".bsync-*", "-print", "-quit").run()
+		return out == b""
+
+# seed mode: (path, record) of the source only, the destination is not scanned
+def seed_records(ssh, dirname, ignores):
+	for inode,path,type,date,size,perms in dir_records(ssh, dirname, ignores):
+		yield path, DirFile(inode, path, type, date, size, perms)
+
+# load actual directory content
+def load_dir(ssh, dirname, ignores):
+	dir = collections.OrderedDict()
+	for inode,path,type,date,size,perms in dir_records(ssh, dirname, ignores):
+		dir[path] = DirFile(inode, path, type, date, size, perms)
 	return dir
 
+# all paths with their original and current records: (path, fo, f1, f2)
+# original paths first, then new paths in dir1, then remaining new paths in dir2
+def dict_entries(orig, dir1, dir2):
+	for path, fo in orig.items():
+		yield path, fo, dir1.get(path), dir2.get(path)
+	for path, f1 in dir1.items():
+		if path not in orig:
+			yield path, None, f1, dir2.get(path)
+	for path, f2 in dir2.items():
+		if path not in orig and path not in dir1:
+			yield path, None, None, f2
+
+##### bounded-memory reconciliation (--stream)
+# listings are sorted by path with an external sort, then joined in a single pass
+
+# number of records sorted in memory before being spilled to a temporary file
+sort_chunk = 200000
+
+def write_records(fd, records):
+	for record in records:
+		fd.write(b"\0".join(x if type(x) is bytes else x.encode() for x in record) + b"\0")
+
+# sort records by path: sorted runs of sort_chunk records are written to
+# temporary files in tmpdir, and merged back while reading
+def sorted_records(records, tmpdir):
+	key = lambda record: record[1]
+	runs = []
+	chunk = []
+	for record in records:
+		chunk.append(record)
+		if len(chunk) >= sort_chunk:
+			chunk.sort(key=key)
+			fd = tempfile.TemporaryFile(dir=tmpdir)
+			write_records(fd, chunk)
+			fd.seek(0)
+			runs.append(fd)
+			chunk = []
+	chunk.sort(key=key)
+
+	# read_file_record is idempotent, spilled records come back unchanged
+	streams = [file_records(fileLineIter(fd)) for fd in runs]
+	yield from heapq.merge(*streams, iter(chunk), key=key)
+	for fd in runs:
+		fd.close()
+
+def tag_stream(stream, i):
+	for f in stream:
+		yield f.path, i, f
+
+# join streams of file records sorted by path
+# yields (path, records) with one record (or None) per stream
+def merge_join(*streams):
+	current = None
+	group = None
+	for path, i, f in heapq.merge(*[tag_stream(stream, i) for i, stream in enumerate(streams)]):
+		if path != current:
+			if current is not None:
+				yield current, group
+			current = path
+			group = [None] * len(streams)
+		group[i] = f
+	if current is not None:
+		yield current, group
+
+# original file records from both snapshots, sorted by path
+def stream_orig(ssh1,dir1name, ssh2,dir2name, snapname, ignores, tmpdir, prefix=None):
+	if snapname is None:
+		return
+
+	printv("Sorting "+snapname+"...")
+	orig1 = (OrigFile(inode,None, path,type,date,size,perms) for inode,path,type,date,size,perms
+			 in sorted_records(snap_records(ssh1, dir1name, snapname, ignores, prefix), tmpdir))
+	orig2 = (OrigFile(None,inode, path,type,date,size,perms) for inode,path,type,date,size,perms
+			 in sorted_records(snap_records(ssh2, dir2name, snapname, ignores, prefix), tmpdir))
+
+	for path, (origfile, other) in merge_join(orig1, orig2):
+		#path not in orig: can happen if using ignore, then removing ignore, path will be considered as new
+		if origfile is None:
+			continue
+		if other is not None:
+			if origfile.type != other.type or origfile.date != other.date or origfile.size != other.size or origfile.perms != other.perms:
+				sys.exit("Error: difference in snaps for path: "+tostr(path))
+			origfile.i2 = other.i2 #set the second inode
+		yield origfile
+
+# actual directory content, sorted by path
+def stream_dir(ssh, dirname, ignores, tmpdir):
+	for inode,path,type,date,size,perms in sorted_records(dir_records(ssh, dirname, ignores), tmpdir):
+		yield DirFile(inode, path, type, date, size, perms)
+
+# all paths with their original and current records, in path order: (path, fo, f1, f2)
+# snapshots are read from snaproot (root1, root2, prefix) for a subtree sync
+def stream_entries(ssh1,dir1name, ssh2,dir2name, snapname, ignores, tmpdir, snaproot=None):
+	if snaproot is None:
+		orig = stream_orig(ssh1,dir1name, ssh2,dir2name, snapname, ignores, tmpdir)
+	else:
+		root1, root2, prefix = snaproot
+		orig = stream_orig(ssh1,root1, ssh2,root2, snapname, ignores, tmpdir, prefix)
+	dir1 = stream_dir(ssh1, dir1name, ignores, tmpdir)
+	dir2 = stream_dir(ssh2, dir2name, ignores, tmpdir)
+	for path, (fo, f1, f2) in merge_join(orig, dir1, dir2):
+		yield path, fo, f1, f2
+
 def getdatestr(f):
 	return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime( int(f.date.split(".")[0]) ))
 
@@ -703,6 +2418,110 @@ def ask_conflict(f1, f2, path, tokeep):
 		elif resp == "q" or resp == "Q" or resp == "Quit":
 			sys.exit(0)
 
+# write an event as a JSON line in the events stream (--events, --events-fd)
+def emit(event, **data):
+	global events
+	if events is None:
+		return
+	data = dict(event=event, time=round(time.time(), 3), **data)
+	with events_lock:
+		events.write(json.dumps(data)+"\n")
+		events.flush()
+
+def formatsize(n):
+	for unit in ("B", "kB", "MB", "GB", "TB"):
+		if n < 1000 or unit == "TB":
+			return ("%d" if unit == "B" else "%.1f") % n + unit
+		n /= 1000
+
+def formatduration(secs):
+	secs = int(secs)
+	if secs >= 3600:
+		return "%dh%02dm" % (secs // 3600, secs % 3600 // 60)
+	return "%dm%02ds" % (secs // 60, secs % 60)
+
+# progress of the transfers in one direction, fed by the rsync output of all lanes
+# known sizes come from the plan, so bytes, throughput and ETA need no extra scan
+class Progress():
+	def __init__(self, direction, files):
+		self.direction = direction
+		self.sizes = {f.path: int(f.size) if f.type == "f" and f.path not in metaonly else 0 for f in files}
+		self.files = len(self.sizes)
+		self.bytes = sum(self.sizes.values())
+		self.files_done = 0
+		self.bytes_done = 0
+		self.start = time.time()
+		self.shown = 0
+		self.lock = threading.Lock()
+		self.display = console_width != 0 and sys.stderr.isatty()
+		emit("start", direction=direction, files=self.files, bytes=self.bytes)
+
+	def status(self):
+		elapsed = max(time.time() - self.start, 0.001)
+		throughput = self.bytes_done / elapsed
+		eta = (self.bytes - self.bytes_done) / throughput if throughput > 0 else None
+		return dict(
+			direction=self.direction,
+			files_done=self.files_done, files=self.files,
+			bytes_done=self.bytes_done, bytes=self.bytes,
+			throughput=int(throughput),
+			eta=None if eta is None else round(eta, 1),
+		)
+
+	def show(self, status, force=False):
+		if not self.display or (not force and time.time() - self.shown < 0.5):
+			return
+		self.shown = time.time()
+		line = "%s %d/%d files, %s/%s, %s/s" % (
+			"-->" if self.direction == "12" else "<--",
+			status["files_done"], status["files"],
+			formatsize(status["bytes_done"]), formatsize(status["bytes"]),
+			formatsize(status["throughput"]),
+		)
+		if status["eta"] is not None:
+			line += ", ETA "+formatduration(status["eta"])
+		print("\r"+line.ljust(console_width - 1)[:console_width - 1], end="", file=sys.stderr, flush=True)
+
+	# a path was reported by rsync, or a lane ended without reporting it (already up to date)
+	def done(self, path):
+		with self.lock:
+			if path not in self.sizes:
+				return
+			size = self.sizes.pop(path)
+			self.files_done += 1
+			self.bytes_done += size
+			status = self.status()
+			self.show(status)
+		emit("file", path=tostr(path), size=size, **status)
+
+	# files planned while transferring (--pipeline)
+	def add(self, files):
+		with self.lock:
+			for f in files:
+				self.sizes[f.path] = int(f.size) if f.type == "f" else 0
+				self.files += 1
+				self.bytes += self.sizes[f.path]
+
+	def finish(self):
+		with self.lock:
+			status = self.status()
+			self.show(status, force=True)
+		if self.display:
+			print(file=sys.stderr)
+		emit("end", **status)
+		if status["bytes_done"] > 8e6 and time.time() - self.start > 1:
+			link_record_throughput(self.direction, status["throughput"])
+
+	# parse the --out-format lines of an rsync process
+	def follow(self, fd):
+		for line in fd:
+			if not line.startswith(b"rsync: "):
+				continue
+			path = line[7:].rstrip(b"\n").rstrip(b"/")
+			if path not in self.sizes and b" -> " in path:
+				path = path.split(b" -> ")[0] # %L of a symlink
+			self.done(path)
+
 # just write a path in rsync process stdin
 def rsync(rsyncproc, path):
 	rsyncproc.stdin.write(path+b"\0")
@@ -718,7 +2537,7 @@ def print_action(action, path1, arrow, path2):
 
 	print( tostr(path1).ljust(w) +" "+arrow+"  "+ tostr(path2).ljust(w) +" "+action )
 
-def get_dir_summary(mkdir,moves,rm,rmdirs,copy,sync):
+def get_dir_summary(mkdir,moves,rm,rmdirs,copy,sync,links=[]):
 	actions = []
 	if len(mkdir)>0:  actions.append("mkdir:"+str(len(mkdir)))
 	if len(moves)>0:  actions.append("mv:"+str(len(moves)))
@@ -726,6 +2545,7 @@ def get_dir_summary(mkdir,moves,rm,rmdirs,copy,sync):
 	if len(rmdirs)>0: actions.append("rmdir"+str(len(rmdirs)))
 	if len(copy)>0:   actions.append("cp:"+str(len(copy)))
 	if len(sync)>0:   actions.append("sync:"+str(len(sync)))
+	if len(links)>0:  actions.append("ln:"+str(len(links)))
 	return " ".join(actions)
 
 def print_files(fo, f1, f2):
@@ -739,7 +2559,7 @@ def print_files12(path, f1, f2):
 	print("%s: %s | %s" % (path, f1str, f2str))
 
 # print actions before asking user validation
-def print_actions(dirnum, mkdirs,moves,rm,rmdirs, copy,sync):
+def print_actions(dirnum, mkdirs,moves,rm,rmdirs, copy,sync, links):
 
 	# mkdirss must be done before
 	for f in mkdirs:
@@ -770,22 +2590,170 @@ def print_actions(dirnum, mkdirs,moves,rm,rmdirs, copy,sync):
 			print_action("rmdir", path, "<--", "")
 
 	##### actions involving a transfer
-	# finish with copy and sync
-	for path in copy:
+	# finish with copy and sync, labelled with their transfer class
+	remote = ssh1 is not None or ssh2 is not None
+	for f in copy:
+		action = "copy/"+transfer_class(f, False, remote)
+		basis = "basis:"+tostr(bases[f.path]) if f.path in bases else ""
+		if dirnum==2:
+			print_action(action, f.path, "-->", basis)
+		else:
+			print_action(action, basis, "<--", f.path)
+	for f in sync:
+		action = "sync/"+transfer_class(f, True, remote)
 		if dirnum==2:
-			print_action("copy", path, "-->", "")
+			print_action(action, f.path, "-->", f.path)
 		else:
-			print_action("copy", "", "<--", path)
-	for path in sync:
+			print_action(action, f.path, "<--", f.path)
+
+	# hard links, once their content is transferred, and copies of identical files
+	for target, f in links:
+		action = "clone" if f.path in clones else "link"
 		if dirnum==2:
-			print_action("sync", path, "-->", path)
+			print_action(action, f.path, "-->", "to:"+tostr(target))
 		else:
-			print_action("sync", path, "<--", path)
+			print_action(action, "to:"+tostr(target), "<--", f.path)
 # end print_actions
 
 # apply small actions: mkdirs, moves, rm, rmdirs
 # quick actions, via local python or remote ssh shell
-def apply_small_actions(ssh,dirname, mkdirs,moves,rm,rmdirs):
+# each kind of action is a step of the journal. When resuming, the step that was
+# interrupted runs again: remote commands already ignore errors, local ones skip
+# what was already done
+##### parallel local actions
+# on network filesystems (NFS homes), each mkdir, rename or unlink is a round trip
+# to the server: independent actions run concurrently in a thread pool. mkdirs run
+# depth by depth, parents first, and rmdirs children first. Moves go from paths to
+# remove to paths to create, so they are independent too. System calls are made
+# relative to a descriptor of the parent directory, kept open for the next actions
+# in the same directory. At most max_dir_fds of them are kept (least recently used
+# ones are closed), and full paths are used when no descriptor can be opened.
+max_dir_fds = 64
+
+class DirFds():
+	def __init__(self, dirname):
+		self.root = os.fsencode(dirname)
+		self.fds = collections.OrderedDict()	# parent --> [descriptor, number of users]
+		self.lock = threading.Lock()
+
+	# (descriptor of the parent directory, name) of a relative path, for a with block
+	# (None, full path) if there are too many open files
+	@contextlib.contextmanager
+	def split(self, path):
+		parent, name = os.path.split(path)
+		entry = self.acquire(parent)
+		if entry is None:
+			yield None, os.path.join(self.root, path)
+			return
+		try:
+			yield entry[0], name
+		finally:
+			with self.lock:
+				entry[1] -= 1
+				self.evict()
+
+	def acquire(self, parent):
+		with self.lock:
+			entry = self.fds.get(parent)
+			if entry is None:
+				try:
+					fd = os.open(os.path.join(self.root, parent), os.O_RDONLY | os.O_DIRECTORY)
+				except OSError as exc:
+					if exc.errno in (errno.EMFILE, errno.ENFILE):
+						return None
+					raise
+				entry = self.fds[parent] = [fd, 0]
+			self.fds.move_to_end(parent)
+			entry[1] += 1
+			self.evict()
+			return entry
+
+	# close the least recently used descriptors over max_dir_fds, that are not in use
+	def evict(self):
+		for parent in list(self.fds):
+			if len(self.fds) <= max_dir_fds:
+				break
+			if self.fds[parent][1] == 0:
+				os.close(self.fds.pop(parent)[0])
+
+	def close(self):
+		for fd, users in self.fds.values():
+			os.close(fd)
+
+# paths grouped by depth, in increasing depth
+def by_depth(paths):
+	depths = defaultdict(list)
+	for path in paths:
+		depths[path.count(b"/")].append(path)
+	return [depths[depth] for depth in sorted(depths)]
+
+def apply_local_actions(dirname, mkdirs,moves,rm,rmdirs, direction):
+	os.umask(0000) #disable umask to allow for any mkdirs
+	fds = DirFds(dirname)
+	perms = {f.path: f.perms for f in mkdirs}
+
+	def mkdir(path):
+		ops.wait()
+		with fds.split(path) as (fd, name):
+			try:
+				os.mkdir(name, 0o777 if perms[path] == "" else int(perms[path], 8), dir_fd=fd)
+			except FileExistsError:
+				if not resume:
+					raise
+
+	def move(pair):
+		fromfile, targetfile = pair
+		ops.wait()
+		with fds.split(fromfile.path) as (fdSrc, src), fds.split(targetfile.path) as (fdDst, dst):
+			try:
+				os.rename(src, dst, src_dir_fd=fdSrc, dst_dir_fd=fdDst)
+			except FileNotFoundError:
+				if not resume:
+					raise
+				os.stat(dst, dir_fd=fdDst, follow_symlinks=False)	# already moved, unless missing too
+			if fromfile.perms != targetfile.perms:
+				os.chmod(dst, int(targetfile.perms, 8), dir_fd=fdDst)
+
+	def remove(path):
+		ops.wait()
+		with fds.split(path) as (fd, name):
+			try:
+				os.unlink(name, dir_fd=fd)
+			except FileNotFoundError:
+				if not resume:
+					raise
+
+	def rmdir(path):
+		ops.wait()
+		with fds.split(path) as (fd, name):
+			try:
+				os.rmdir(name, dir_fd=fd)
+			except FileNotFoundError:
+				if not resume:
+					raise
+
+	try:
+		with ThreadPoolExecutor(max_workers=copy_threads) as pool:
+			# mkdirs must be done before
+			for paths in by_depth([f.path for f in mkdirs]):
+				list(pool.map(mkdir, paths))
+			journal.done(direction+":mkdirs")
+
+			list(pool.map(move, moves))
+			journal.done(direction+":moves")
+
+			# removes, after the check moves step
+			list(pool.map(remove, [f.path for f in rm.values()]))
+			journal.done(direction+":rm")
+
+			# rmdirs must be done after
+			for paths in reversed(by_depth(rmdirs)):
+				list(pool.map(rmdir, paths))
+			journal.done(direction+":rmdirs")
+	finally:
+		fds.close()
+
+def apply_small_actions(ssh,dirname, mkdirs,moves,rm,rmdirs, direction):
 	if mkdirs==[] and moves==[] and len(rm)==0 and rmdirs==[]:
 		return
 
@@ -797,71 +2765,644 @@ def apply_small_actions(ssh,dirname, mkdirs,moves,rm,rmdirs):
 			)
 
 		for perms, paths in mkdir_lists.items():
-			if perms == "":
-				ssh.run("mkdir", *paths).run()
-			else:
-				ssh.run("mkdir", "-m", perms, *paths).run()
+			for batch in batches(paths, batch_size):
+				ops.wait(len(batch))
+				if perms == "":
+					ssh.run("mkdir", *batch).run()
+				else:
+					ssh.run("mkdir", "-m", perms, *batch).run()
+		journal.done(direction+":mkdirs")
 
 		for fromfile, targetfile in moves:
 			src = os.path.join(dirname, fromfile.path.decode("utf8"))
 			dst = os.path.join(dirname, targetfile.path.decode("utf8"))
+			ops.wait()
 			ssh.run("mv", src, dst).run()
 			if fromfile.perms != targetfile.perms:
 				ssh.run("chmod", targetfile.perms, dst).run()
+		journal.done(direction+":moves")
 
 		if rm:
 			# removes, after the check moves step
 			rms = [os.path.join(dirname, f.path.decode("utf8"))
 				   for f in rm.values()]
-			ssh.run("rm", *rms).run()
+			if ops.rate == 0:
+				# independent: the batches run concurrently, bounded per host
+				run_concurrently(*[ssh.run("rm", *batch) for batch in batches(rms, batch_size)])
+			else:
+				for batch in batches(rms, batch_size):
+					ops.wait(len(batch))
+					ssh.run("rm", *batch).run()
+		journal.done(direction+":rm")
 
 		if rmdirs:
 			rmdirs = [os.path.join(dirname, path.decode("utf8"))
 					  for path in rmdirs]
-			ssh.run("rmdir", *rmdirs).run()
+			# rmdirs is sorted children first, so batches keep that order
+			for batch in batches(rmdirs, batch_size):
+				ops.wait(len(batch))
+				ssh.run("rmdir", *batch).run()
+		journal.done(direction+":rmdirs")
 
 	else:
-		# mkdirss must be done before
-		os.umask(0000) #disable umask to allow for any mkdirs
-		for f in mkdirs:
-			path = os.path.join(dirname, f.path.decode("utf8"))
-			if f.perms=="":
-				os.mkdir(path)
-			else:
-				os.mkdir(path, int(f.perms, 8) )
-
-		# moves
-		for fromfile, targetfile in moves:
-			src = os.path.join(dirname, fromfile.path.decode("utf8"))
-			dst = os.path.join(dirname, targetfile.path.decode("utf8"))
-			os.rename(src, dst)
-			if fromfile.perms != targetfile.perms:
-				os.chmod(dst, int(targetfile.perms, 8))
+		apply_local_actions(dirname, mkdirs,moves,rm,rmdirs, direction)
+
+# group copies and syncs by transfer class, keeping the original order within a class
+def group_transfers(copy, sync, remote):
+	classes = collections.OrderedDict()
+	for f in copy:
+		classes.setdefault(transfer_class(f, False, remote), []).append(f)
+	for f in sync:
+		classes.setdefault(transfer_class(f, True, remote), []).append(f)
+	return classes
+
+# split the files of a transfer class in at most n lanes of similar byte sizes
+def split_lanes(files, n):
+	lanes = [[] for i in range(min(n, len(files)))]
+	sizes = [0] * len(lanes)
+	for f in sorted(files, key=lambda f: -int(f.size)):
+		i = sizes.index(min(sizes))
+		lanes[i].append(f)
+		sizes[i] += int(f.size)
+	return lanes
+
+##### transfer scheduling
+# small and recently modified files are sent first: they are usually the ones
+# someone is waiting for. Files of at least background_size bytes are sent by a
+# separate background lane, so that they do not hold back the other lanes.
+# rsync sorts the files it is given, so priorities are tiers sent by separate processes
+background_size = 256 << 20
+urgent_size = 1 << 20
+urgent_age = 24 * 3600
+
+# 0: small or recently modified, 1: other files, 2: large files (background lane)
+def transfer_tier(f, now):
+	if background_size and int(f.size) >= background_size:
+		return 2
+	if int(f.size) < urgent_size or now - int(f.date) < urgent_age:
+		return 0
+	return 1
+
+# bandwidth limit in bytes per second at this time of day (None if unlimited)
+# every --bwlimit applies, the lowest active one wins
+def current_bwlimit():
+	now = time.localtime()
+	rates = [bwlimit_at(rules, now.tm_hour * 60 + now.tm_min) for rules in bwlimits]
+	rates = [rate for rate in rates if rate > 0]
+	return min(rates) if rates else None
+
+# rsync --bwlimit option for one of `concurrency` rsync processes sharing the limit
+# it is computed when the process starts, so that long syncs follow time-of-day limits
+def bwlimit_args(concurrency):
+	rate = current_bwlimit()
+	if rate is None:
+		return []
+	return ["--bwlimit="+str(max(1, rate // concurrency // 1024))]
+
+# run one rsync process over a list of files
+def rsync_lane(sshSrc,dirnameSrc, sshDst,dirnameDst, name, files, background, progress, concurrency):
+	args = transfer_class_args(name) + bwlimit_args(concurrency)
+	if background:
+		# keep what was received of large files if interrupted, --resume starts from there
+		args.append("--partial-dir="+partial_dir.decode())
+	rsyncproc = rsync_init(sshSrc,dirnameSrc, sshDst,dirnameDst, args)
+	reader = threading.Thread(target=progress.follow, args=(rsyncproc.stdout,))
+	reader.start()
 
-		# removes, after the check moves step
-		for f in rm.values():
-			os.remove(os.path.join(dirname, f.path.decode("utf8")))
+	for f in files:
+		rsync(rsyncproc, f.path)
 
-		# rmdirs must be done after
-		for path in rmdirs:
-			os.rmdir(os.path.join(dirname, path))
+	# clean rsyncproc
+	rsyncproc.stdin.close()
+	reader.join()
+	rsyncproc.wait()
+	if rsyncproc.returncode == 0:
+		# rsync does not report files that were already up to date
+		for f in files:
+			progress.done(f.path)
+		journal.done(progress.direction+":transfers", [f.path for f in files])
+	return rsyncproc.returncode
+
+# (transfer class, files, background) for each rsync process to run, in priority order
+def transfer_jobs(copy, sync, remote):
+	now = time.time()
+	tiers = [[], [], []]
+	for name, files in group_transfers(copy, sync, remote).items():
+		byTier = defaultdict(list)
+		for f in files:
+			byTier[transfer_tier(f, now)].append(f)
+		for tier in (0, 1):
+			for lane in split_lanes(byTier[tier], lanes):
+				tiers[tier].append((name, lane, False))
+		if byTier[2]:
+			tiers[2].append((name, byTier[2], True))
+	return tiers[0] + tiers[1] + tiers[2]
 
 ##### actions involving an rsync transfer
-def apply_rsync_actions(sshSrc,dirnameSrc, sshDst,dirnameDst, pathlist):
-	if len(pathlist) == 0:
+# each transfer class gets its own rsync options, and is split in lanes
+# at most `lanes` rsync processes run at the same time, plus one for large files
+def apply_rsync_actions(sshSrc,dirnameSrc, sshDst,dirnameDst, copy, sync, direction):
+	if len(copy) == 0 and len(sync) == 0:
 		return
 
-	rsyncproc = rsync_init(sshSrc,dirnameSrc, sshDst,dirnameDst)
+	progress = Progress(direction, copy + sync)
+	remote = sshSrc is not None or sshDst is not None
+	if any(f.path in bases for f in copy):
+		finish_pipelines()
+		copy_bases(sshDst, dirnameDst, [f for f in copy if f.path in bases])
+	jobs = transfer_jobs(copy, sync, remote)
+	for name, files, background in jobs:
+		printv("Transferring "+str(len(files))+" paths ("+name+(", background" if background else "")+")...")
+
+	foreground = [job for job in jobs if not job[2]]
+	background = [job for job in jobs if job[2]]
+	concurrency = min(lanes, len(foreground)) + (1 if background else 0)
+	def run(job):
+		lane = {"local": local_lane, "chunked": chunked_lane, "meta": meta_lane}.get(job[0], rsync_lane)
+		if job[0].startswith("tar"):
+			lane = tar_lane
+		return lane(sshSrc,dirnameSrc, sshDst,dirnameDst, *job, progress, concurrency)
+	with ThreadPoolExecutor(max_workers=1) as bgpool, ThreadPoolExecutor(max_workers=lanes) as pool:
+		bgresults = bgpool.map(run, background)
+		results = list(pool.map(run, foreground)) + list(bgresults)
+
+	progress.finish()
+	if any(ret != 0 for ret in results):
+		sys.exit("Error in rsync process.")
 
-	# finish with copies and sync
-	for path in pathlist:
-		rsync(rsyncproc, path)
+##### pipelined apply (--pipeline)
+# with -y, clear-cut copies and syncs are sent while the rest of the plan is made
+# and conflicts are answered. Only actions that the rest of the plan cannot change
+# are streamed: syncs, and copies of inodes that were not in the snapshot (they
+# cannot be moves) into a directory that exists on the destination, for files with
+# no hard link. They are sent in batches: rsync reads its whole list of files first.
+# Each batch is written to the journal as it is dispatched, so that --resume
+# finishes it if the sync is interrupted
+pipeline = False
+pipeline_batch = 1000
+pipelines = {}
+
+class Pipeline():
+	def __init__(self, sshSrc,dirnameSrc, sshDst,dirnameDst, direction, src, dst, known):
+		self.sshSrc, self.dirnameSrc = sshSrc, dirnameSrc
+		self.sshDst, self.dirnameDst = sshDst, dirnameDst
+		self.direction = direction
+		self.dst = dst
+		self.known = known
+		self.links = collections.Counter(f.i for f in src.values() if f.type == "f")
+		self.remote = sshSrc is not None or sshDst is not None
+		self.copy = []
+		self.sync = []
+		self.since = None
+		self.copied = []	# dispatched so far
+		self.synced = []
+		self.progress = None
+		self.pool = ThreadPoolExecutor(max_workers=lanes)
+		self.results = []
+		self.ok = None	# once finished
+
+	# take a copy or sync that was just planned, if nothing else in the plan can change it
+	def offer(self, f, issync):
+		if f.type not in ("f", "l") or self.links[f.i] > 1 or f.path in peers:
+			return False
+		if not issync:
+			parent = os.path.dirname(f.path)
+			if f.i in self.known or parent and (parent not in self.dst or self.dst[parent].type != "d"):
+				return False
+		(self.sync if issync else self.copy).append(f)
+		if self.since is None:
+			self.since = time.time()
+		if len(self.copy) + len(self.sync) >= pipeline_batch or time.time() - self.since >= 1:
+			self.flush()
+		return True
 
-	# clean rsyncproc
-	rsyncproc.stdin.close()
-	rsyncproc.wait()
-	if rsyncproc.returncode != 0:
-		sys.exit("Error in rsync process.")
+	# send the files taken so far to the lanes
+	def flush(self):
+		if not self.copy and not self.sync:
+			return
+		copy, sync = self.copy, self.sync
+		self.copy, self.sync, self.since = [], [], None
+		sparse.update(find_sparse(self.sshSrc, self.dirnameSrc, copy + sync))
+		self.copied += copy
+		self.synced += sync
+		journal.dispatched(self.direction, copy, sync)
+		if self.progress is None:
+			self.progress = Progress(self.direction, [])
+		self.progress.add(copy + sync)
+		for name, files in group_transfers(copy, sync, self.remote).items():
+			printv("Transferring "+str(len(files))+" paths ("+name+", pipelined)...")
+			self.results.append(self.pool.submit(self.run, name, files))
+
+	def run(self, name, files):
+		lane = {"local": local_lane, "chunked": chunked_lane}.get(name, rsync_lane)
+		return lane(self.sshSrc,self.dirnameSrc, self.sshDst,self.dirnameDst, name, files, False, self.progress, lanes)
+
+	# wait for all the transfers, False if one of them failed
+	def finish(self):
+		if self.ok is None:
+			self.flush()
+			results = [future.result() for future in self.results]
+			self.pool.shutdown()
+			if self.progress is not None:
+				self.progress.finish()
+			self.ok = all(ret == 0 for ret in results)
+		return self.ok
+
+# stream the copy or sync just planned for path, if any
+def pipeline_path(path):
+	for files, issync, direction in ((copy12, False, "12"), (sync12, True, "12"), (copy21, False, "21"), (sync21, True, "21")):
+		if files and files[-1].path == path and pipelines[direction].offer(files[-1], issync):
+			files.pop()
+
+# files streamed in a direction
+def pipelined_files(direction):
+	return pipelines[direction].copied + pipelines[direction].synced if direction in pipelines else []
+
+# number of transfer jobs dispatched in a direction
+def pipelined_jobs(direction):
+	return len(pipelines[direction].results) if direction in pipelines else 0
+
+# streamed transfers must be done before the snapshots are made, and before
+# destination files are copied (delta bases, clones): they may be syncs of them
+def finish_pipelines():
+	for direction in sorted(pipelines):
+		if not pipelines[direction].finish():
+			sys.exit("Error in rsync process.")
+
+# bytes available to a (non root) user in dirname, or None if unknown
+def free_space(ssh, dirname):
+	try:
+		if ssh is None:
+			st = os.statvfs(dirname)
+			return st.f_bavail * st.f_frsize
+		else:
+			out = ssh.check_output("df", "-Pk", dirname, universal_newlines=True, stderr=subprocess.DEVNULL).run()
+			return int(out.split("\n")[1].split()[3]) * 1024
+	except (OSError, subprocess.CalledProcessError, IndexError, ValueError):
+		return None
+
+# number of ssh commands apply_small_actions will run on a remote side
+def small_actions_round_trips(ssh, mkdirs, moves, rm, rmdirs):
+	if ssh is None:
+		return 0
+	perms = defaultdict(list)
+	for f in mkdirs:
+		perms[f.perms].append(f.path)
+	n = sum(len(list(batches(paths, batch_size))) for paths in perms.values())
+	n += sum(2 if fromfile.perms != targetfile.perms else 1 for fromfile, targetfile in moves)
+	n += len(list(batches([f.path for f in rm.values()], batch_size)))
+	n += len(list(batches(rmdirs, batch_size)))
+	return n
+
+# all actions of one direction, as JSON-serializable dicts
+def plan_actions(direction, mkdirs,moves,rm,rmdirs, copy,sync, links, remote):
+	actions = []
+	for f in mkdirs:
+		actions.append(dict(action="mkdir", path=tostr(f.path), size=0))
+	for fromfile, targetfile in moves:
+		actions.append(dict(action="move", path=tostr(targetfile.path), source=tostr(fromfile.path), size=0))
+	for f in rm.values():
+		actions.append(dict(action="rm", path=tostr(f.path), size=int(f.size)))
+	for path in rmdirs:
+		actions.append(dict(action="rmdir", path=tostr(path), size=0))
+	for f in copy:
+		actions.append(dict(action="copy", path=tostr(f.path), size=int(f.size), transfer=transfer_class(f, False, remote)))
+		if f.path in bases:
+			actions[-1]["basis"] = tostr(bases[f.path])
+	for f in sync:
+		actions.append(dict(action="sync", path=tostr(f.path), size=int(f.size), transfer=transfer_class(f, True, remote)))
+	for target, f in links:
+		actions.append(dict(action="clone" if f.path in clones else "link", path=tostr(f.path), source=tostr(target), size=0))
+	for action in actions:
+		action["direction"] = direction
+	return actions
+
+# estimated seconds to apply a plan, from the measured throughput to the remote
+def estimate_duration(nbytes, round_trips):
+	if link is None:
+		return None
+	secs = round_trips * link["rtt"] / 1000
+	rate = current_bwlimit()
+	for direction, n in nbytes.items():
+		secs += n / min(link.get("throughput", {}).get(direction) or link["bandwidth"], rate or float("inf"))
+	return round(secs, 1)
+
+# structured plan: every action with its size, bytes per direction, round trips and estimated duration
+def make_plan():
+	remote = ssh1 is not None or ssh2 is not None
+	actions = plan_actions("12", mkdir2,moves2,rm2,rmdirs2, copy12,sync12, links2, remote) \
+		+ plan_actions("21", mkdir1,moves1,rm1,rmdirs1, copy21,sync21, links1, remote)
+	# transfers already dispatched while planning (--pipeline)
+	for direction, p in sorted(pipelines.items()):
+		for action in plan_actions(direction, [],[],{},[], p.copied,p.synced, [], remote):
+			action["pipelined"] = True
+			actions.append(action)
+	pipelined = {direction: sum(int(f.size) for f in pipelined_files(direction)) for direction in ("12", "21")}
+	nbytes = {
+		"12": sum(int(f.size) for f in copy12 + sync12 if f.path not in metaonly) + pipelined["12"],
+		"21": sum(int(f.size) for f in copy21 + sync21 if f.path not in metaonly) + pipelined["21"],
+	}
+
+	# not sent: the content of hard links, and holes of sparse files are not written
+	saved = {
+		"12": {"links": sum(int(f.size) for target, f in links2), "sparse": sum(sparse.get(f.path, 0) for f in copy12 + sync12 + pipelined_files("12"))},
+		"21": {"links": sum(int(f.size) for target, f in links1), "sparse": sum(sparse.get(f.path, 0) for f in copy21 + sync21 + pipelined_files("21"))},
+	}
+
+	round_trips = small_actions_round_trips(ssh2, mkdir2,moves2,rm2,rmdirs2) \
+		+ small_actions_round_trips(ssh1, mkdir1,moves1,rm1,rmdirs1)
+	for ssh, links in ((ssh2, links2), (ssh1, links1)):
+		if ssh is not None:
+			round_trips += len(list(batches([f.path for target, f in links], batch_size)))
+	if remote:
+		round_trips += len(transfer_jobs(copy12, sync12, remote)) + len(transfer_jobs(copy21, sync21, remote))
+		round_trips += pipelined_jobs("12") + pipelined_jobs("21")
+		# snapshots are only made when something is applied, or on a first sync
+		sides = len([ssh for ssh in (ssh1, ssh2) if ssh is not None])
+		if actions or snapname is None:
+			round_trips += sides * (1 if snapname is None else 2) # snapshot, rm old snapshot
+		if check: round_trips += 1 if full_check else (2 if verify_hash else 1) * sides # stat, hash
+
+	return {
+		"dir1": args[0],
+		"dir2": args[1],
+		"actions": actions,
+		"conflicts": [tostr(path) for fo, f1, f2, path in conflicts],
+		"bytes": nbytes,
+		"pipelined": pipelined,
+		"saved": saved,
+		"round_trips": round_trips,
+		"estimated_duration": estimate_duration(nbytes, round_trips),
+	}
+
+# warn if a destination does not have enough free space for the incoming bytes
+# (the pipelined transfers are already under way)
+def check_free_space(plan):
+	for direction, ssh, dirname in (("12", ssh2, dir2name), ("21", ssh1, dir1name)):
+		needed = plan["bytes"][direction] - plan["pipelined"][direction]
+		if needed == 0:
+			continue
+		available = free_space(ssh, dirname)
+		plan.setdefault("free_space", {})[direction] = available
+		if available is not None and available < needed:
+			print("WARNING: "+getdirstr(ssh, dirname)+" needs "+formatsize(needed)
+				+" but only "+formatsize(available)+" is free")
+
+##### action journal (--resume)
+# the planned actions are written to a local journal before being applied, then
+# one line is appended for each completed step: small actions of one kind, or the
+# files of one rsync process. Pipelined batches are written as they are dispatched,
+# before the plan. An interrupted sync is finished with --resume, without scanning
+# and planning again, and the journal is removed once the snapshots are updated.
+partial_dir = b".bsync-partial"
+
+def journal_path(dir1, dir2):
+	key = hashlib.sha1((dir1+"\0"+dir2).encode(errors="surrogateescape")).hexdigest()[:16]
+	return get_config_path(os.path.join("journals", key+".jsonl"))
+
+def record_json(f):
+	return [getattr(f, "i", None), os.fsdecode(f.path), f.type, f.date, f.size, f.perms]
+
+def json_record(r):
+	i, path, type, date, size, perms = r
+	return DirFile(i, os.fsencode(path), type, date, size, perms)
+
+class Journal():
+	def __init__(self, path):
+		self.path = path
+		self.fd = None
+		self.lock = threading.Lock()
+
+	def exists(self):
+		return os.path.exists(self.path)
+
+	def write(self, entry):
+		with self.lock:
+			self.fd.write(json.dumps(entry)+"\n")
+			self.fd.flush()
+			os.fsync(self.fd.fileno())
+
+	# a new journal, replacing the one of an earlier sync
+	def create(self):
+		os.makedirs(os.path.dirname(self.path), exist_ok=True)
+		self.fd = open(self.path, "w")
+
+	# a pipelined batch, written when it is dispatched
+	def dispatched(self, direction, copy, sync):
+		if self.fd is None:
+			self.create()
+		self.write({
+			"dispatched": direction,
+			"copy": [record_json(f) for f in copy],
+			"sync": [record_json(f) for f in sync],
+			"sparse": {os.fsdecode(f.path): sparse[f.path] for f in copy + sync if f.path in sparse},
+		})
+
+	# the plan, written before applying anything
+	def start(self, plan):
+		if self.fd is None:
+			self.create()
+		self.write(plan)
+
+	# a completed step, with the paths it covers
+	def done(self, step, paths=()):
+		if self.fd is not None:
+			self.write({"done": step, "paths": [os.fsdecode(path) for path in paths]})
+
+	# the plan with the pipelined batches, and the completed steps with their paths
+	# (no plan if the sync was interrupted while planning)
+	def load(self):
+		with open(self.path) as fd:
+			lines = [json.loads(line) for line in fd if line.endswith("\n")]
+		plan = None
+		batches = []
+		done = defaultdict(set)
+		for entry in lines:
+			if "done" in entry:
+				done[entry["done"]].update(os.fsencode(path) for path in entry["paths"])
+			elif "dispatched" in entry:
+				batches.append(entry)
+			else:
+				plan = entry
+		if plan is not None:
+			for batch in batches:
+				actions = plan[batch["dispatched"]]
+				actions["copy"] += batch["copy"]
+				actions["sync"] += batch["sync"]
+				actions["sparse"].update(batch["sparse"])
+		self.fd = open(self.path, "a")
+		return plan, done
+
+	# the journal of an interrupted sync, once it was planned again
+	def discard(self):
+		if self.fd is None and self.exists():
+			os.remove(self.path)
+
+	def remove(self):
+		if self.fd is not None:
+			self.fd.close()
+			self.fd = None
+		os.remove(self.path)
+
+def journal_actions(mkdirs,moves,rm,rmdirs, copy,sync, links):
+	return {
+		"mkdirs": [record_json(f) for f in mkdirs],
+		"moves": [[record_json(f1), record_json(f2)] for f1, f2 in moves],
+		"rm": [record_json(f) for f in rm.values()],
+		"rmdirs": [os.fsdecode(path) for path in rmdirs],
+		"copy": [record_json(f) for f in copy],
+		"sync": [record_json(f) for f in sync],
+		"links": [[os.fsdecode(target), record_json(f)] for target, f in links],
+		"sparse": {os.fsdecode(f.path): sparse[f.path] for f in copy + sync if f.path in sparse},
+		"bulk": [os.fsdecode(f.path) for f in copy if f.path in bulk],
+		"metaonly": [os.fsdecode(f.path) for f in sync if f.path in metaonly],
+		"clones": [os.fsdecode(f.path) for target, f in links if f.path in clones],
+		"bases": {os.fsdecode(f.path): os.fsdecode(bases[f.path]) for f in copy if f.path in bases},
+	}
+
+# actions of one direction that are still to do: steps that were not completed,
+# and files that were not transferred yet
+def pending_actions(actions, done, direction):
+	def step(name, items):
+		return [] if direction+":"+name in done else items
+	transferred = done.get(direction+":transfers", set())
+	rm = collections.OrderedDict()
+	for r in step("rm", actions["rm"]):
+		f = json_record(r)
+		rm[f.path] = f
+	sparse.update((os.fsencode(path), n) for path, n in actions["sparse"].items())
+	bulk.update(os.fsencode(path) for path in actions["bulk"])
+	metaonly.update(os.fsencode(path) for path in actions["metaonly"])
+	clones.update(os.fsencode(path) for path in actions["clones"])
+	bases.update((os.fsencode(path), os.fsencode(basis)) for path, basis in actions["bases"].items())
+	return (
+		step("mkdirs", [json_record(r) for r in actions["mkdirs"]]),
+		step("moves", [(json_record(r1), json_record(r2)) for r1, r2 in actions["moves"]]),
+		rm,
+		step("rmdirs", [os.fsencode(path) for path in actions["rmdirs"]]),
+		[f for f in map(json_record, actions["copy"]) if f.path not in transferred],
+		[f for f in map(json_record, actions["sync"]) if f.path not in transferred],
+		step("links", [(os.fsencode(target), json_record(r)) for target, r in actions["links"]]),
+	)
+
+# apply all actions, then check and update the snapshots
+def apply_actions():
+	print("Applying actions...")
+
+	printv("Applying actions in dir2...")
+	apply_small_actions(ssh2,dir2name, mkdir2,moves2,rm2,rmdirs2, "12")
+	apply_rsync_actions(ssh1,dir1name,ssh2,dir2name, copy12, sync12, "12")
+	apply_links(ssh2,dir2name, links2, "12")
+
+	printv("Applying actions in dir1...")
+	apply_small_actions(ssh1,dir1name, mkdir1,moves1,rm1,rmdirs1, "21")
+	apply_rsync_actions(ssh2,dir2name,ssh1,dir1name, copy21, sync21, "21")
+	apply_links(ssh1,dir1name, links1, "21")
+
+	finish_pipelines()
+	if check: check_dirs()
+
+	if snaproot is not None:
+		make_snapshot_slices(ssh1,root1, ssh2,root2, prefix, snapname)
+	else:
+		save_git_states(make_snapshots(ssh1,dir1name, ssh2,dir2name, snapname))
+
+	journal.remove()
+	print("Done!")
+
+# classify one path from its original (snapshot) record and its current records
+# conflicts are kept aside, to be resolved once all paths are classified
+def classify(path, fo, f1, f2):
+	# f1==None f2==None				deleted both sides
+	# f1==None f2=!None f2.d==fo.d			f1 chg only
+	# f1==None f2=!None f2.d!=fo.d			conflict
+	# f1!=None f2==None f1.d==fo.d			f2 chg only
+	# f1!=None f2==None f1.d!=fo.d			conflict
+	# f1!=None f2!=None f1.d==fo.d f2.d==fo.d	no change
+	# f1!=None f2!=None f1.d==fo.d f2.d!=fo.d	f2 chg only
+	# f1!=None f2!=None f1.d!=fo.d f2.d==fo.d	f1 chg only
+	# f1!=None f2!=None f1.d!=fo.d f2.d!=fo.d	conflict
+
+	if f1 == None and f2 == None:
+		# deleted both sides --> nothing to do
+		pass
+	elif f1 != None and f2 != None and samefiles(f1,f2):
+		# same file contents --> nothing to do
+		pass
+	elif fo == None:
+		# new path
+		if f2 == None:
+			# adding in d2
+			if f1.type == "d":
+				mkdir2.append(f1)
+			else:
+				copy12.append(f1)
+		elif f1 == None:
+			# adding in d1
+			if f2.type == "d":
+				mkdir1.append(f2)
+			else:
+				copy21.append(f2)
+		else:
+			# f2!=None and f2.date != f1.date --> conflict
+			conflicts.append( (fo, f1, f2, path) )
+	elif f2 != None and samefiles(f2,fo):
+		# no f2 change --> f1 change only
+		if f1 == None:
+			# f1 deleted --> delete f2
+			if f2.type == "d": # f2 isdir
+				rmdirs2.append(path)
+			else:
+				rm2[fo.i1] = f2
+		else:
+			# f1 != None and f1 != fo.date --> f1 mod --> mod f2
+			sync12.append(f1)
+	elif f1 != None and samefiles(f1,fo):
+		# no f1 change --> f2 change only
+		if f2 == None:
+			if f1.type == "d": #f1 isdir
+				rmdirs1.append(path)
+			else:
+				rm1[fo.i2] = f1
+		else:
+			sync21.append(f2)
+	else:
+		# f1 change and f2 change --> confict
+		# f1 != None and f2 != None --> f1.date != f2.date (!= fo.date)
+		# f1 == None and f2 != None
+		# f1 != None and f2 == None
+		conflicts.append( (fo, f1, f2, path) )
+
+# apply the version to keep (tokeep: 1, 2, 1a, 2a) on a conflicting path
+def resolve_conflict(fo, f1, f2, path, tokeep):
+	if tokeep[0] == "1": #1 or 1a
+		if f1 == None:
+			if f2.type == "d": # f2 isdir
+				rmdirs2.append(path)
+			else:
+				rm2[fo.i1] = f2
+		else:
+			if f2 == None:
+				if f1.type == "d":
+					mkdir2.append(f1)
+				else:
+					copy12.append(f1)
+			else:
+				sync12.append(f1)
+	else: # tokeep == 2
+		if f2 == None:
+			if f1.type == "d": # f1 isdir
+				rmdirs1.append(path)
+			else:
+				rm1[fo.i2] = f1
+		else:
+			if f1 == None:
+				if f2.type == "d":
+					mkdir1.append(f2)
+				else:
+					copy21.append(f2)
+			else:
+				sync21.append(f2)
 
 def check_moves(copy, rm):
 	# check if we can move instead of rm+copy
@@ -879,7 +3420,7 @@ def check_moves(copy, rm):
 			moves.append( (fcandidate, fsrc) )
 			rm.pop(fsrc.i)
 		else:	
-			copyreal.append(fsrc.path)
+			copyreal.append(fsrc)
 
 	return copyreal, rm, moves
 
@@ -892,11 +3433,12 @@ def myinput(prompt):
 
 def usage():
 	usage = "Usage: bsync [options] DIR1 DIR2\n\n"
-	usage+= "	DIR can be user@sshserver:DIR\n"
+	usage+= "	DIR can be user@sshserver:DIR (both can be remote, then files are sent\n"
+	usage+= "	directly from one host to the other)\n"
 	usage+= "	-v		Verbose\n"
 	usage+= "	-i		Ignore permissions\n"
 	usage+= "	-b		Batch mode (exit on conflict)\n"
-	usage+= "	-c		Check that dirs are identical in the end\n"
+	usage+= "	-c		Check the touched paths and a sample of the others in the end\n"
 	usage+= "	-d		Make the dirs if they do not exist\n"
 	usage+= "	-n		Dry run: report changes without applying them\n"
 	usage+= "	-y		Apply the changes when no conflict\n"
@@ -904,13 +3446,65 @@ def usage():
 	usage+= "	-2		Keep remote version of changes on conflict\n"
 	usage+= "	-p PORT		Port for SSH\n"
 	usage+= "	-o SSHARGS	Custom options for SSH\n"
+	usage+= "	--compress=yes|no|auto		Compress transfers (auto: only on slow links, from --profile)\n"
+	usage+= "	--whole-file=yes|no|auto	Disable delta transfers (auto: only locally)\n"
+	usage+= "	--skip-compress=EXT,...		More extensions that are never compressed\n"
+	usage+= "	--lanes=N		Number of concurrent rsync processes\n"
+	usage+= "	--batch-size=N		Maximum number of paths per remote command\n"
+	usage+= "	--profile=NAME		Auto-tune from the link profile of remote NAME (remotes.json)\n"
+	usage+= "	--reprofile		Measure the link profile again\n"
+	usage+= "	--events=FILE		Write progress events to FILE as JSON lines\n"
+	usage+= "	--events-fd=FD		Write progress events to file descriptor FD\n"
+	usage+= "	--json-plan=FILE	Write the plan to FILE as JSON (- for stdout)\n"
+	usage+= "	--stream		Bounded memory: sort listings on disk and join them in one pass\n"
+	usage+= "	--no-subtree		Do not reuse the history of a synced parent directory\n"
+	usage+= "	--scanner=find|native	Scan local directories with find, or in-process with threads\n"
+	usage+= "	--scan-threads=N	Number of threads of the native scanner\n"
+	usage+= "	--inode-order		Native scanner: stat files in inode order (spinning disks)\n"
+	usage+= "	--git-scan		Git working trees: only look at the paths git reports\n"
+	usage+= "	--walkers=N		Scan remote directories with N concurrent find processes\n"
+	usage+= "	--ionice=CLASS		I/O scheduling class, local and remote: idle or best-effort\n"
+	usage+= "	--nice=N		Niceness, local and remote\n"
+	usage+= "	--max-scan-threads=N	Cap on scanner threads and walkers\n"
+	usage+= "	--ops-limit=N		Metadata operations per second (stat, mkdir, rm...)\n"
+	usage+= "	--copier=rsync|native	Copy between local directories with rsync, or in-process\n"
+	usage+= "	--copy-threads=N	Number of threads for local copies and actions\n"
+	usage+= "	--bwlimit=LIMIT		Bandwidth limit (bytes/s, e.g. 5M or 08:00-18:00=1M,10M), can be repeated\n"
+	usage+= "	--background-size=SIZE	Send files of at least SIZE in a background lane (0: never)\n"
+	usage+= "	--chunked-size=SIZE	Send files of at least SIZE in chunks over several connections (0: never)\n"
+	usage+= "	--chunk-streams=N	Number of connections of chunked transfers\n"
+	usage+= "	--pipeline		With -y: send clear-cut changes while planning and resolving conflicts\n"
+	usage+= "	--resume		Finish an interrupted sync, without planning again\n"
+	usage+= "	--check			Same as -c\n"
+	usage+= "	--verify-sample=N	Number of unchanged paths checked by -c (default: 100)\n"
+	usage+= "	--verify-hash		-c reads files without a cached hash to compare their contents\n"
+	usage+= "	--full-check		-c compares both whole trees with rsync\n"
+	usage+= "	--bulk-files=N		Send new small files with tar when there are at least N (0: never)\n"
+	usage+= "	--no-dedup		Always send new files, even if they are on the destination\n"
+	usage+= "	--dedup-size=SIZE	Look for new files of at least SIZE on the destination\n"
+	usage+= "	--meta-only=cached|hash|size|no	Same size, other date or permissions: only set them when the\n"
+	usage+= "				contents have the same cached hash (or hash them, or always, or never)\n"
+	usage+= "	--no-seed		Reconcile path by path even when the destination is empty\n"
+	usage+= "	--listing=FILE		Use FILE (from --scan-to) as the listing of DIR1, exit with\n"
+	usage+= "				status 3 instead of changing DIR1 (fan-out to several remotes)\n"
+	usage+= "\n"
+	usage+= "       bsync --scan-to=FILE DIR\n"
+	usage+= "	Write the listing of local directory DIR to FILE\n"
 	printerr(usage)
 
 #####################################################
 
 #### process commandline args
 try:
-	opts, args = getopt.gnu_getopt(sys.argv[1:], "vcibdny12p:o:")
+	opts, args = getopt.gnu_getopt(
+		sys.argv[1:], "vcibdny12p:o:",
+		["compress=", "whole-file=", "skip-compress=", "lanes=", "batch-size=",
+		 "profile=", "reprofile", "events=", "events-fd=", "json-plan=", "stream", "no-subtree",
+		 "scanner=", "scan-threads=", "inode-order", "git-scan", "walkers=", "copier=", "copy-threads=",
+		 "ionice=", "nice=", "max-scan-threads=", "ops-limit=",
+		 "bwlimit=", "background-size=", "chunked-size=", "chunk-streams=", "pipeline", "resume", "bulk-files=", "no-seed", "no-dedup", "dedup-size=", "meta-only=",
+		 "listing=", "scan-to=", "check", "verify-sample=", "verify-hash", "full-check"]
+	)
 except getopt.GetoptError as err:
 	printerr(err)
 	usage()
@@ -920,12 +3514,31 @@ verbose = check = ignoreperms = batch = mkdirp = dry_run = yes = False
 sshport = None
 sshargs = ""
 tokeep = None
+compress = whole_file = "auto"
+lanes = batch_size = None
+profile = None
+reprofile = False
+events = None
+events_lock = threading.Lock()
+jsonplan = None
+link = None
+stream = False
+subtree = True
+scanner = "find"
+scan_threads = 8
+inode_order = False
+walkers = 1
+bwlimits = []
+resume = False
+seed = True
+listing = scanto = None
+full_check = False
 for o, a in opts:
 	if o == "-v":
 		verbose = True
 	elif o == "-i":
 		ignoreperms = True
-	elif o == "-c":
+	elif o == "-c" or o == "--check":
 		check = True
 	elif o == "-p":
 		sshport = a
@@ -943,9 +3556,159 @@ for o, a in opts:
 		tokeep = "1a"
 	elif o == "-2":
 		tokeep = "2a"
+	elif o == "--compress" or o == "--whole-file":
+		if a not in ("yes", "no", "auto"):
+			sys.exit("Error: "+o+" must be yes, no or auto")
+		if o == "--compress": compress = a
+		else: whole_file = a
+	elif o == "--skip-compress":
+		skip_compress.update(ext.strip(".").lower() for ext in a.split(",") if ext)
+	elif o == "--lanes" or o == "--batch-size":
+		try:
+			n = int(a)
+			assert n > 0
+		except (ValueError, AssertionError):
+			sys.exit("Error: "+o+" must be a positive integer")
+		if o == "--lanes": lanes = n
+		else: batch_size = n
+	elif o == "--profile":
+		profile = a
+	elif o == "--reprofile":
+		reprofile = True
+	elif o == "--events":
+		events = open(a, "a")
+	elif o == "--events-fd":
+		try:
+			events = os.fdopen(int(a), "w")
+		except (ValueError, OSError):
+			sys.exit("Error: invalid file descriptor for --events-fd: "+a)
+	elif o == "--stream":
+		stream = True
+	elif o == "--no-subtree":
+		subtree = False
+	elif o == "--scanner":
+		if a not in ("find", "native"):
+			sys.exit("Error: --scanner must be find or native")
+		scanner = a
+	elif o == "--scan-threads":
+		if not a.isdigit() or int(a) == 0:
+			sys.exit("Error: --scan-threads must be a positive integer")
+		scan_threads = int(a)
+	elif o == "--inode-order":
+		inode_order = True
+	elif o == "--git-scan":
+		git_scan = True
+	elif o == "--walkers":
+		if not a.isdigit() or int(a) == 0:
+			sys.exit("Error: --walkers must be a positive integer")
+		walkers = int(a)
+	elif o == "--ionice":
+		if a not in ionice_classes:
+			sys.exit("Error: --ionice must be idle or best-effort")
+		ionice_class = a
+	elif o == "--nice":
+		if not a.isdigit() or int(a) > 19:
+			sys.exit("Error: --nice must be a number between 0 and 19")
+		niceness = int(a)
+	elif o == "--max-scan-threads":
+		if not a.isdigit() or int(a) == 0:
+			sys.exit("Error: --max-scan-threads must be a positive integer")
+		max_scan_threads = int(a)
+	elif o == "--ops-limit":
+		if not a.isdigit():
+			sys.exit("Error: --ops-limit must be a number")
+		ops_limit = int(a)
+	elif o == "--copier":
+		if a not in ("native", "rsync"):
+			sys.exit("Error: --copier must be native or rsync")
+		copier = a
+	elif o == "--copy-threads":
+		if not a.isdigit() or int(a) == 0:
+			sys.exit("Error: --copy-threads must be a positive integer")
+		copy_threads = int(a)
+	elif o == "--bwlimit":
+		try:
+			bwlimits.append(parse_bwlimit(a))
+		except ValueError as exc:
+			sys.exit("Error: --bwlimit: "+str(exc))
+	elif o == "--background-size":
+		try:
+			background_size = parse_size(a)
+		except ValueError as exc:
+			sys.exit("Error: --background-size: "+str(exc))
+	elif o == "--chunked-size":
+		try:
+			chunked_size = parse_size(a)
+		except ValueError as exc:
+			sys.exit("Error: --chunked-size: "+str(exc))
+	elif o == "--chunk-streams":
+		if not a.isdigit() or int(a) == 0:
+			sys.exit("Error: --chunk-streams must be a positive integer")
+		chunk_streams = int(a)
+	elif o == "--pipeline":
+		pipeline = True
+	elif o == "--resume":
+		resume = True
+	elif o == "--bulk-files":
+		if not a.isdigit():
+			sys.exit("Error: --bulk-files must be a number")
+		bulk_min_files = int(a)
+	elif o == "--no-seed":
+		seed = False
+	elif o == "--meta-only":
+		if a not in ("cached", "hash", "size", "no"):
+			sys.exit("Error: --meta-only must be cached, hash, size or no")
+		meta_only = a
+	elif o == "--no-dedup":
+		dedup = False
+	elif o == "--dedup-size":
+		try:
+			dedup_min_size = parse_size(a)
+		except ValueError as exc:
+			sys.exit("Error: --dedup-size: "+str(exc))
+	elif o == "--verify-sample":
+		if not a.isdigit():
+			sys.exit("Error: --verify-sample must be a number")
+		verify_sample = int(a)
+	elif o == "--verify-hash":
+		verify_hash = True
+	elif o == "--full-check":
+		full_check = True
+	elif o == "--listing":
+		listing = a
+	elif o == "--scan-to":
+		scanto = a
+	elif o == "--json-plan":
+		if a == "-":
+			# keep stdout for the plan, everything else goes to stderr
+			jsonplan = sys.stdout
+			sys.stdout = sys.stderr
+		else:
+			jsonplan = open(a, "w")
 	else:
 		assert False, "unhandled option"
 
+# resource policy
+apply_local_priority()
+if stream:
+	dedup = False	# its indexes are not bounded
+ops = RateLimit(ops_limit)
+if max_scan_threads is not None:
+	scan_threads = min(scan_threads, max_scan_threads)
+	walkers = min(walkers, max_scan_threads)
+
+# scan a local directory once for several syncs (fan-out)
+if scanto is not None:
+	if len(args) != 1:
+		usage()
+		sys.exit(2)
+	if scanner == "native":
+		ret = Function(write_native_snapshot, args[0], scanto, lambda path: False).run().returncode
+	else:
+		findcmdlocal = find_check_command()
+		ret = Run(findcmdlocal, args[0], "-fprintf", scanto, findformat).run().returncode
+	sys.exit(0 if ret == 0 else "Error scanning "+args[0])
+
 if len(args) != 2:
 	usage()
 	sys.exit(2)
@@ -961,15 +3724,26 @@ if ':' in dir1name:
 if ':' in dir2name:
 	sshuserhost, dir2name = dir2name.split(':', 1)
 	ssh = ssh2 = SshCon(sshuserhost, sshport, sshargs)
-if ssh1!=None and ssh2!=None:
-	sys.exit("Error: only one remote directory supported.")
-
-if ssh != None:
-	ssh_master_init(ssh)
+# both remote: transfers go directly from one remote to the other
+for con in (ssh1, ssh2):
+	if con != None:
+		ssh_master_init(con)
+
+# auto-tune what was not set explicitly from the link profile
+# (not for remote to remote syncs: the profile is of the link to this host)
+tuned = {"lanes": 1, "batch-size": 1000}
+if ssh != None and profile is not None and (ssh1 is None or ssh2 is None):
+	link = link_profile(ssh, profile, reprofile)
+	tuned = link_tune(link)
+if lanes is None: lanes = tuned["lanes"]
+if batch_size is None: batch_size = tuned["batch-size"]
+if compress == "auto": compress = tuned.get("compress", "auto")
+if whole_file == "auto": whole_file = tuned.get("whole-file", "auto")
+printv("Transfer settings: lanes=%s batch-size=%s compress=%s whole-file=%s" % (lanes, batch_size, compress, whole_file))
 
 # check rsync and find installs
-rsync_check_install(ssh)
-findcmdlocal, findcmdremote = find_check_command(ssh)
+rsync_check_install(ssh1, ssh2)
+findcmdlocal = find_check_command(ssh1, ssh2)
 
 # add trailing slashes (to avoid problems with symlinked dirs)
 dir1name = os.path.join(dir1name, '')
@@ -984,62 +3758,88 @@ try:
 except:
 	console_width = 0
 
+journal = Journal(journal_path(getdirstr(ssh1,dir1name), getdirstr(ssh2,dir2name)))
+if resume:
+	# finish an interrupted sync: no scan, no plan, only what is left to do
+	if not journal.exists():
+		sys.exit("Nothing to resume for these directories.")
+	state, done = journal.load()
+	if state is None:
+		sys.exit("The interrupted sync was still being planned, run it again without --resume.")
+	snapname = state["snapname"]
+	# the snapshots made in the end leave out ignored paths
+	ignores = load_snapinfo(ssh1,dir1name, ssh2,dir2name)[1]
+	snaproot = state["snaproot"]
+	if snaproot is not None:
+		root1, root2, prefix = snaproot
+		prefix = os.fsencode(prefix)
+	mkdir2,moves2,rm2,rmdirs2, copy12,sync12, links2 = pending_actions(state["12"], done, "12")
+	mkdir1,moves1,rm1,rmdirs1, copy21,sync21, links1 = pending_actions(state["21"], done, "21")
+	print("Resuming. Left to do in "+args[0]+": "+(get_dir_summary(mkdir1,moves1,rm1,rmdirs1, copy21,sync21, links1) or "nothing"))
+	print("Left to do in "+args[1]+": "+(get_dir_summary(mkdir2,moves2,rm2,rmdirs2, copy12,sync12, links2) or "nothing"))
+	if not dry_run:
+		apply_actions()
+	sys.exit()
+elif journal.exists():
+	print("WARNING: a previous sync of these directories was interrupted, "
+		+"use --resume to finish it. Planning again instead.")
+
 print("Loading filelists...")
 
 printv("Loading original filelist from snap files...")
-snapname, origlist, ignores = load_orig(ssh1,dir1name, ssh2,dir2name)
-
-printv("Loading dir1 filelist...")
-dir1 = load_dir(ssh1, dir1name, ignores)
-printv("Loading dir2 filelist...")
-dir2 = load_dir(ssh2, dir2name, ignores)
-
-dir1tmp = dir1.copy()
-dir2tmp = dir2.copy()
-# just show conflicts
-conflicts = []
-for path, fo in origlist.items():
-	f1 = dir1tmp[path] if path in dir1tmp else None
-	f2 = dir2tmp[path] if path in dir2tmp else None
-
-	if f1 == None and f2 == None:
-		pass
-	elif f1 != None and f2 != None and samefiles(f1,f2):
-		pass
-	elif f2 != None and samefiles(f2,fo):
-		# no f2 change --> f1 change only
-		pass
-	elif f1 != None and samefiles(f1,fo):
-		# no f1 change --> f2 change only
-		pass
+snapname, ignores = load_snapinfo(ssh1,dir1name, ssh2,dir2name)
+
+# no history for these directories: maybe they are inside an already synced root
+snaproot = None
+if snapname is None and subtree:
+	found = find_snap_root(ssh1,dir1name, ssh2,dir2name)
+	if found is not None:
+		root1, root2, prefix, snapname = found
+		snaproot = root1, root2, prefix
+		print("Using history of parent root: "+getdirstr(ssh1, root1)+" "+getdirstr(ssh2, root2))
+		# the ignores of the root apply too
+		snaps1, ignorefile1 = get_bsync_files(ssh1, root1)
+		snaps2, ignorefile2 = get_bsync_files(ssh2, root2)
+		rootignores = get_ignores(ignorefile1, ssh1,root1) | get_ignores(ignorefile2, ssh2,root2)
+		if rootignores:
+			ignores = subtree_ignores(ignores, parse_gitignore(rootignores), prefix)
+if snapname is None:
+	print("Old filelist not found. Starting with empty history.")
+
+# first sync into an empty directory: nothing to reconcile
+seeding = None
+if snapname is None and seed:
+	if is_empty(ssh2, dir2name) and not is_empty(ssh1, dir1name):
+		seeding = "12"
+	elif is_empty(ssh1, dir1name) and not is_empty(ssh2, dir2name):
+		seeding = "21"
+
+if seeding is not None:
+	print("Empty destination: copying everything.")
+	if seeding == "12":
+		entries = ((path, None, f, None) for path, f in seed_records(ssh1, dir1name, ignores))
 	else:
-		# f1 change and f2 change --> confict
-		conflicts.append( (f1, f2, path) )
-
-	dir1tmp.pop(path, None)
-	dir2tmp.pop(path, None)
-
-for path, f1 in dir1tmp.items():
-	f2 = dir2tmp[path] if path in dir2tmp else None
-
-	if f2 != None and samefiles(f2,f1):
-		# f1 and f2 added but same files --> nothing to do
-		pass
-	elif f2 == None:
-		# adding in d2
-		pass
-	else:
-		# f2!=None and f2.date != f1.date --> conflict
-		conflicts.append( (f1, f2, path) )
-
-	dir2tmp.pop(path, None)
+		entries = ((path, None, None, f) for path, f in seed_records(ssh2, dir2name, ignores))
+elif stream:
+	# bounded memory: sorted listings are joined while reading them
+	sorttmpdir = tempfile.TemporaryDirectory(prefix="bsync-sort-")
+	entries = stream_entries(ssh1,dir1name, ssh2,dir2name, snapname, ignores, sorttmpdir.name, snaproot)
+elif snaproot is not None:
+	origlist = load_orig(ssh1,root1, ssh2,root2, snapname, ignores, prefix)
+else:
+	origlist = load_orig(ssh1,dir1name, ssh2,dir2name, snapname, ignores)
+if not stream and seeding is None:
+	gitscan = git_scan and snaproot is None
+	printv("Loading dir1 filelist...")
+	dir1 = git_dir(ssh1, dir1name, ignores, origlist, 1) if gitscan and listing is None else None
+	if dir1 is None:
+		dir1 = load_dir(ssh1, dir1name, ignores)
+	printv("Loading dir2 filelist...")
+	dir2 = git_dir(ssh2, dir2name, ignores, origlist, 2) if gitscan else None
+	if dir2 is None:
+		dir2 = load_dir(ssh2, dir2name, ignores)
+	entries = dict_entries(origlist, dir1, dir2)
 
-if len(conflicts) > 0:
-	print()
-	for f1, f2, path in conflicts:
-		show_conflict(f1, f2, path)
-
-printv("Analysing original paths...")
 mkdir1 = []
 mkdir2 = []
 rmdirs1 = []
@@ -1050,154 +3850,123 @@ copy12 = []
 copy21 = []
 sync12 = []
 sync21 = []
-# process all original paths (from snapshot)
-for path, fo in origlist.items():
-	# f1==None f2==None				deleted both sides
-	# f1==None f2=!None f2.d==fo.d			f1 chg only
-	# f1==None f2=!None f2.d!=fo.d			conflict
-	# f1!=None f2==None f1.d==fo.d			f2 chg only
-	# f1!=None f2==None f1.d!=fo.d			conflict
-	# f1!=None f2!=None f1.d==fo.d f2.d==fo.d	no change
-	# f1!=None f2!=None f1.d==fo.d f2.d!=fo.d	f2 chg only
-	# f1!=None f2!=None f1.d!=fo.d f2.d==fo.d	f1 chg only
-	# f1!=None f2!=None f1.d!=fo.d f2.d!=fo.d	conflict
-
-	f1 = dir1[path] if path in dir1 else None
-	f2 = dir2[path] if path in dir2 else None
+conflicts = []
 
-	if f1 == None and f2 == None:
-		# deleted both sides --> nothing to do
-		pass
-	elif f1 != None and f2 != None and samefiles(f1,f2):
-		# same file contents --> nothing to do
-		pass
-	elif f2 != None and samefiles(f2,fo):
-		# no f2 change --> f1 change only
-		if f1 == None:
-			# f1 deleted --> delete f2
-			if f2.type == "d": # f2 isdir
-				rmdirs2.append(path)
-			else:
-				rm2[fo.i1] = f2
-		else:
-			# f1 != None and f1 != fo.date --> f1 mod --> mod f2
-			sync12.append(path)
-	elif f1 != None and samefiles(f1,fo):
-		# no f1 change --> f2 change only
-		if f2 == None:
-			if f1.type == "d": #f1 isdir
-				rmdirs1.append(path)
-			else:
-				rm1[fo.i2] = f1
-		else:
-			sync21.append(path)
-	elif dry_run:
+# --pipeline: only unattended, and when both listings are in memory
+if pipeline and yes and not dry_run and not stream and seeding is None and listing is None:
+	pipelines["12"] = Pipeline(ssh1,dir1name, ssh2,dir2name, "12", dir1, dir2, set(fo.i1 for fo in origlist.values()))
+	pipelines["21"] = Pipeline(ssh2,dir2name, ssh1,dir1name, "21", dir2, dir1, set(fo.i2 for fo in origlist.values()))
+
+printv("Analysing paths...")
+for path, fo, f1, f2 in entries:
+	if meta_only != "no":
+		note_peers(path, f1, f2)
+	classify(path, fo, f1, f2)
+	if pipelines:
+		pipeline_path(path)
+	if dedup and (ssh1 is not None or ssh2 is not None):
+		if f1 is not None: index_file(f1, index1, names1)
+		if f2 is not None: index_file(f2, index2, names2)
+	if check and f1 is not None and f2 is not None and f1.type != "d" and samefiles(f1, f2):
+		sample_path(path)
+
+for p in pipelines.values():
+	p.flush()
+
+# show all conflicts first, then resolve them one by one
+if len(conflicts) > 0:
+	print()
+	for fo, f1, f2, path in conflicts:
 		show_conflict(f1, f2, path)
-	else:
-		# f1 change and f2 change --> confict
-		# f1 != None and f2 != None --> f1.date != f2.date (!= fo.date)
-		# f1 == None and f2 != None
-		# f1 != None and f2 == None
-		#print_files(fo,f1,f2)
-
-		tokeep = ask_conflict(f1, f2, path, tokeep);
-		if tokeep[0] == "1": #1 or 1a
-			if f1 == None:
-				if f2.type == "d": # f2 isdir
-					rmdirs2.append(path)
-				else:
-					rm2[fo.i1] = f2
-			else:
-				if f2 == None:
-					if f1.type == "d":
-						mkdir2.append(f1)
-					else:
-						copy12.append(f1)
-				else:
-					sync12.append(path)
-		else: # tokeep == 2
-			if f2 == None:
-				if f1.type == "d": # f1 isdir
-					rmdirs1.append(path)
-				else:
-					rm1[fo.i2] = f1
-			else:
-				if f1 == None:
-					if f2.type == "d":
-						mkdir1.append(f2)
-					else:
-						copy21.append(f2)
-				else:
-					sync21.append(path)
-	#ifend
 
-	dir1.pop(path, None)
-	dir2.pop(path, None)
-#forend
+# fan-out: the shared listing may be stale once another remote changed dir1,
+# so changes to dir1 are left to a run of their own, after the others
+if listing is not None and not dry_run and len(conflicts) > 0:
+	print("Conflicts: deferred until the other remotes are synced.")
+	sys.exit(3)
 
-printv("Analysing remaining new paths in dir1...")
-# process new paths in dir1
-for path, f1 in dir1.items():
-	f2 = dir2[path] if path in dir2 else None
-
-	if f2 != None and samefiles(f2,f1):
-		# f1 and f2 added but same files --> nothing to do
-		pass
-	elif f2 == None:
-		# adding in d2
-		if f1.type == "d":
-			mkdir2.append(f1)
-		else:
-			copy12.append(f1)
-	else:
-		# f2!=None and f2.date != f1.date --> conflict
+if not dry_run:
+	for fo, f1, f2, path in conflicts:
 		tokeep = ask_conflict(f1, f2, path, tokeep);
-		if tokeep[0] == "1":
-			sync12.append(path)
-		else: # tokeep == 2
-			sync21.append(path)
-
-	dir2.pop(path, None)
-
-# remaining in dir2: new paths not in orig nor in dir1 --> no conflict
-printv("Analysing remaining new paths in dir2...")
-# process remaining new paths in dir2
-for path, f2 in dir2.items():
-	if f2.type == "d":
-		mkdir1.append(f2)
-	else:
-		copy21.append(f2)
+		resolve_conflict(fo, f1, f2, path, tokeep)
+
+# conflicts are resolved last: make sure parents are created before children
+mkdir1.sort(key=lambda f: f.path)
+mkdir2.sort(key=lambda f: f.path)
 
 # moves detection
 copy12, rm2, moves2 = check_moves(copy12, rm2)
 copy21, rm1, moves1 = check_moves(copy21, rm1)
 
+# syncs that are only a chmod and a date change
+if meta_only != "no":
+	plan_metaonly(ssh1,dir1name, ssh2,dir2name, sync12, "12")
+	plan_metaonly(ssh2,dir2name, ssh1,dir1name, sync21, "21")
+
+# hard links: one transfer per group, then links
+copy12, sync12, links2 = plan_links(copy12, sync12, moves2)
+copy21, sync21, links1 = plan_links(copy21, sync21, moves1)
+if dedup and (ssh1 is not None or ssh2 is not None):
+	# pipelined syncs are still overwriting their destination files
+	copy12, links2 = plan_dedup(ssh1,dir1name, ssh2,dir2name, copy12, sync12 + pipelined_files("12"), moves2, rm2, links2, index2, names2)
+	copy21, links1 = plan_dedup(ssh2,dir2name, ssh1,dir1name, copy21, sync21 + pipelined_files("21"), moves1, rm1, links1, index1, names1)
+sparse.update(find_sparse(ssh1, dir1name, copy12 + sync12))
+sparse.update(find_sparse(ssh2, dir2name, copy21 + sync21))
+
+# many new small files: tar streams
+conflicted = set(path for fo, f1, f2, path in conflicts)
+# (only between this host and a remote: tar streams would go through this host)
+onlyone = (ssh1 is None) != (ssh2 is None)
+bulk.update(find_bulk(copy12, onlyone, conflicted, seeding == "12"))
+bulk.update(find_bulk(copy21, onlyone, conflicted, seeding == "21"))
+
 rmdirs1.sort(reverse=True) # TODO someth cleaner than sort?
 rmdirs2.sort(reverse=True) # TODO someth cleaner than sort?
 
 # ACTIONS in dir2 -->
 # ACTIONS in dir1 <--
 
+if listing is not None and not dry_run and \
+   (mkdir1 or moves1 or rm1 or rmdirs1 or copy21 or sync21 or links1):
+	print("Changes to "+args[0]+": deferred until the other remotes are synced.")
+	sys.exit(3)
+
+plan = make_plan()
+check_free_space(plan)
+if jsonplan is not None:
+	jsonplan.write(json.dumps(plan)+"\n")
+	jsonplan.flush()
+
 # if no action to do
-if len(mkdir1)==0 and len(moves1)==0 and len(rm1)==0 and len(rmdirs1)==0 and len(copy21)==0 and len(sync21)==0 and \
-   len(mkdir2)==0 and len(moves2)==0 and len(rm2)==0 and len(rmdirs2)==0 and len(copy12)==0 and len(sync12)==0:
-	if check: rsync_check(ssh1,dir1name, ssh2,dir2name)
+if len(mkdir1)==0 and len(moves1)==0 and len(rm1)==0 and len(rmdirs1)==0 and len(copy21)==0 and len(sync21)==0 and len(links1)==0 and \
+   len(mkdir2)==0 and len(moves2)==0 and len(rm2)==0 and len(rmdirs2)==0 and len(copy12)==0 and len(sync12)==0 and len(links2)==0 and \
+   not pipelined_files("12") and not pipelined_files("21"):
+	if check: check_dirs()
 	if not dry_run:
 		print("Identical directories. Nothing to do.")
+		journal.discard()
 	if snapname == None:
-		make_snapshots(ssh1,dir1name, ssh2,dir2name, snapname)
+		save_git_states(make_snapshots(ssh1,dir1name, ssh2,dir2name, snapname))
 	sys.exit()
 
 if len(conflicts) > 0: print_line()
 print()
 print_action("ACTION", "(LOCAL CONTENT)", "   ", "(REMOTE CONTENT)")
 print()
-print_actions(2, mkdir2,moves2,rm2,rmdirs2, copy12,sync12)
-print_actions(1, mkdir1,moves1,rm1,rmdirs1, copy21,sync21)
+print_actions(2, mkdir2,moves2,rm2,rmdirs2, copy12,sync12, links2)
+print_actions(1, mkdir1,moves1,rm1,rmdirs1, copy21,sync21, links1)
 
 print()
-print("Todo in "+args[0]+": "+get_dir_summary(mkdir1,moves1,rm1,rmdirs1, copy21,sync21))
-print("Todo in "+args[1]+": "+get_dir_summary(mkdir2,moves2,rm2,rmdirs2, copy12,sync12))
+print("Todo in "+args[0]+": "+get_dir_summary(mkdir1,moves1,rm1,rmdirs1, copy21,sync21, links1))
+print("Todo in "+args[1]+": "+get_dir_summary(mkdir2,moves2,rm2,rmdirs2, copy12,sync12, links2))
+print("Transfers: "+formatsize(plan["bytes"]["12"])+" -->, "+formatsize(plan["bytes"]["21"])+" <--"
+	+ ("" if plan["estimated_duration"] is None else ", estimated "+formatduration(plan["estimated_duration"])))
+savedlinks = plan["saved"]["12"]["links"] + plan["saved"]["21"]["links"]
+savedsparse = plan["saved"]["12"]["sparse"] + plan["saved"]["21"]["sparse"]
+if savedlinks or savedsparse:
+	print("Saved: "+formatsize(savedlinks)+" not sent (links and copies on the destination), "+formatsize(savedsparse)+" not written (sparse files)")
+if pipelines:
+	print("Sent while planning: "+str(len(pipelined_files("12")))+" paths -->, "+str(len(pipelined_files("21")))+" paths <--")
 
 resp = "none"
 if batch or yes: resp = "y"
@@ -1209,20 +3978,16 @@ while resp != "y" and resp != "n":
 print()
 if resp == "n":
 	print("Leaving files in place.")
+	if not dry_run:
+		journal.discard()
 	sys.exit()
 
-print("Applying actions...")
-
-printv("Applying actions in dir2...")
-apply_small_actions(ssh2,dir2name, mkdir2,moves2,rm2,rmdirs2)
-apply_rsync_actions(ssh1,dir1name,ssh2,dir2name, copy12 + sync12)
-
-printv("Applying actions in dir1...")
-apply_small_actions(ssh1,dir1name, mkdir1,moves1,rm1,rmdirs1)
-apply_rsync_actions(ssh2,dir2name,ssh1,dir1name, copy21 + sync21)
-
-if check: rsync_check(ssh1,dir1name, ssh2,dir2name)
-
-make_snapshots(ssh1,dir1name, ssh2,dir2name, snapname)
-
-print("Done!")
+journal.start({
+	"dir1": dir1name,
+	"dir2": dir2name,
+	"snapname": snapname,
+	"snaproot": None if snaproot is None else [root1, root2, os.fsdecode(prefix)],
+	"12": journal_actions(mkdir2,moves2,rm2,rmdirs2, copy12,sync12, links2),
+	"21": journal_actions(mkdir1,moves1,rm1,rmdirs1, copy21,sync21, links1),
+})
+apply_actions()
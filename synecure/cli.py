@@ -3,6 +3,8 @@ import sys
 import json
 import subprocess
 import shlex
+import tempfile
+import threading
 from coleo import Option, default, run_cli
 
 from .utils import (
@@ -13,6 +15,8 @@ from .utils import (
     readlines,
     writelines,
     quote,
+    parse_size,
+    parse_bwlimit,
 )
 from .version import version as sy_version
 
@@ -60,6 +64,91 @@ def _sort_paths(remote):
     return sorted(remote["paths"].items(), key=lambda kv: -len(kv[0]))
 
 
+def _check_size(value):
+    parse_size(value)
+    return value
+
+
+def _check_count(value):
+    if not value.isdigit():
+        raise ValueError("must be a number")
+    return int(value)
+
+
+def _check_bwlimit(value):
+    parse_bwlimit(value)
+    return value
+
+
+# Settings that can be set per remote with `sy-config set`, or for all
+# remotes with `sy-config set-global`, and their validators. They override
+# what is auto-tuned from the link profile.
+_settings = {
+    "lanes": int,
+    "batch-size": int,
+    "compress": ("yes", "no", "auto"),
+    "whole-file": ("yes", "no", "auto"),
+    "stream": bool,
+    "scanner": ("find", "native"),
+    "scan-threads": int,
+    "inode-order": bool,
+    "git-scan": bool,
+    "walkers": int,
+    "ionice": ("idle", "best-effort"),
+    "nice": _check_count,
+    "max-scan-threads": int,
+    "ops-limit": _check_count,
+    "copier": ("native", "rsync"),
+    "copy-threads": int,
+    "bwlimit": _check_bwlimit,
+    "background-size": _check_size,
+    "chunked-size": _check_size,
+    "chunk-streams": int,
+    "pipeline": bool,
+    "bulk-files": _check_count,
+    "no-seed": bool,
+    "no-dedup": bool,
+    "dedup-size": _check_size,
+    "meta-only": ("cached", "hash", "size", "no"),
+    "check": bool,
+    "verify-sample": _check_count,
+    "verify-hash": bool,
+    "full-check": bool,
+}
+
+
+def _check_setting(key, value):
+    if key not in _settings:
+        q(f"Unknown setting '{key}'. Available settings: {', '.join(_settings)}")
+    check = _settings[key]
+    if check is bool:
+        if value not in ("yes", "no"):
+            q(f"Setting '{key}' must be yes or no")
+        return value == "yes"
+    elif check is int:
+        if not value.isdigit() or int(value) == 0:
+            q(f"Setting '{key}' must be a positive integer")
+        return int(value)
+    elif callable(check):
+        try:
+            return check(value)
+        except ValueError as exc:
+            q(f"Setting '{key}': {exc}")
+    elif value not in check:
+        q(f"Setting '{key}' must be one of: {', '.join(check)}")
+    return value
+
+
+def _settings_options(settings):
+    options = []
+    for key, value in settings.items():
+        if value is True:
+            options.append(f"--{key}")
+        elif value is not False:
+            options.append(f"--{key}={value}")
+    return options
+
+
 ################
 # Entry points #
 ################
@@ -104,8 +193,9 @@ def main():
     # [positional: *]
     files: Option
 
-    # Name of the remote to sync with
+    # Name of the remote to sync with (repeat to sync with several remotes)
     # [alias: -r]
+    # [action: append]
     remote: Option = default(None)
 
     # Port to connect to
@@ -119,10 +209,22 @@ def main():
     # List the commands sy will run
     show_plan: Option & bool = default(False)
 
+    # Write the planned actions to this file as JSON ("-" for stdout)
+    json_plan: Option = default(None)
+
     # Verbose output
     # [alias: -v]
     verbose: Option & bool = default(False)
 
+    # Write transfer progress events to this file, as JSON lines
+    events: Option = default(None)
+
+    # Write transfer progress events to this file descriptor, as JSON lines
+    events_fd: Option & int = default(None)
+
+    # Finish an interrupted sync, without planning again
+    resume: Option & bool = default(False)
+
     # Prompt for changes (necessary to resolve conflicts)
     # [alias: -i]
     interactive: Option & bool = default(False)
@@ -144,6 +246,7 @@ def main():
 
     remotes = get_config("remotes.json")
     directories = get_config("directories.json")
+    settings = get_config("settings.json")
 
     if list:
         for path, dest in directories.items():
@@ -154,45 +257,126 @@ def main():
     if not files:
         files.append(".")
 
+    pass_fds = () if events_fd is None else (events_fd,)
+    tmpdir = tempfile.TemporaryDirectory(prefix="sy-")
+
     for filename in files:
         filename = _realpath(filename)
 
-        remote_name = _fill_remote(filename, remote, directories)
-        remote_config = _get_remote(remotes, remote_name)
-        remote_config["port"] = port
-
-        commands += plan_sync(
-            filename,
-            remote,
-            remote_config,
-            dry=dry_run,
-            verbose=verbose,
-            interactive=interactive,
-            resolve=resolve,
+        remote_names = _fill_remote(filename, remote, directories)
+        fan_out = (
+            len(remote_names) > 1
+            and os.path.isdir(filename)
+            and not (resume or interactive)
         )
+        listing = None
+        if fan_out:
+            # Scan the local directory once, for all the remotes
+            listing = os.path.join(tmpdir.name, f"listing-{len(commands)}")
+            commands.append(["sy-bsync", f"--scan-to={listing}", filename])
+
+        group = []
+        for remote_name in remote_names:
+            remote_config = _get_remote(remotes, remote_name)
+            remote_config["port"] = port
+
+            group += plan_sync(
+                filename,
+                remote_name,
+                remote_config,
+                dry=dry_run,
+                verbose=verbose,
+                interactive=interactive,
+                resolve=resolve,
+                profile=remote_name in remotes,
+                events=events,
+                events_fd=events_fd,
+                json_plan=json_plan,
+                settings=settings,
+                resume=resume,
+                listing=listing,
+            )
+
+        if fan_out:
+            commands.append(dict(zip(remote_names, group)))
+        else:
+            commands += group
 
     for command in commands:
+        if isinstance(command, dict):
+            for cmd in command.values():
+                if verbose or show_plan:
+                    print(" ".join(map(shlex.quote, cmd)))
+            if not show_plan:
+                _run_fan_out(command, pass_fds)
+            continue
         if verbose or show_plan:
             if isinstance(command, str):
                 print(command)
             else:
                 print(" ".join(map(shlex.quote, command)))
         if not show_plan:
-            subprocess.run(command)
+            subprocess.run(command, pass_fds=pass_fds)
 
     write_config("directories.json", directories, silent=True)
 
 
-def _fill_remote(path, remote_name, directories):
-    if remote_name is None:
+def _fill_remote(path, remote_names, directories):
+    if remote_names is None:
         if path not in directories:
             q("Please specify a destination")
         regdest = directories[path]
         assert regdest is not None
-        return regdest
+        return regdest if isinstance(regdest, list) else [regdest]
     else:
-        directories[path] = remote_name
-        return remote_name
+        directories[path] = remote_names[0] if len(remote_names) == 1 else remote_names
+        return remote_names
+
+
+def _run_fan_out(commands, pass_fds):
+    """Run the syncs of one directory with several remotes concurrently.
+
+    Their outputs are shown once each finishes. A sync that would change the
+    local directory exits with status 3 instead (the shared listing may be
+    stale by then): those run again one by one, afterwards, with a fresh scan.
+    """
+    procs = {}
+    outputs = {}
+
+    def collect(name, proc):
+        outputs[name] = proc.communicate()[0]
+
+    threads = []
+    for name, cmd in commands.items():
+        procs[name] = subprocess.Popen(
+            cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            pass_fds=pass_fds,
+        )
+        thread = threading.Thread(target=collect, args=(name, procs[name]))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    results = {}
+    for name, cmd in commands.items():
+        print(f"# OUTPUT OF {name}")
+        sys.stdout.buffer.write(outputs[name])
+        sys.stdout.flush()
+        results[name] = procs[name].returncode
+
+    for name, cmd in commands.items():
+        if results[name] == 3:
+            print(f"# SYNC WITH {name} (changes to the local directory)")
+            cmd = [arg for arg in cmd if not arg.startswith("--listing=")]
+            results[name] = subprocess.run(cmd, pass_fds=pass_fds).returncode
+
+    print("# RESULTS")
+    for name, code in results.items():
+        print(f"{name:30} {'ok' if code == 0 else f'failed (exit status {code})'}")
 
 
 def _check_dir(url, path, port):
@@ -216,6 +400,13 @@ def plan_sync(
     verbose=False,
     interactive=False,
     resolve="prompt",
+    profile=False,
+    events=None,
+    events_fd=None,
+    json_plan=None,
+    settings=None,
+    resume=False,
+    listing=None,
 ):
 
     for pfx, repl in _sort_paths(remote):
@@ -264,6 +455,27 @@ def plan_sync(
         if remote["type"] == "ssh" and remote["port"]:
             cmdopts.append(f"-p {remote['port']}")
 
+        if remote["type"] == "ssh" and profile:
+            # Auto-tune from (and store) the link profile of a named remote
+            cmdopts.append(f"--profile={remote_name}")
+
+        # Global settings first: for most settings the last value wins, all
+        # bandwidth limits apply
+        cmdopts += _settings_options(settings or {})
+        cmdopts += _settings_options(remote.get("settings", {}))
+
+        if events:
+            cmdopts.append(f"--events={_realpath(events)}")
+        if events_fd is not None:
+            cmdopts.append(f"--events-fd={events_fd}")
+        if json_plan:
+            plan_path = json_plan if json_plan == "-" else _realpath(json_plan)
+            cmdopts.append(f"--json-plan={plan_path}")
+        if resume:
+            cmdopts.append("--resume")
+        if listing:
+            cmdopts.append(f"--listing={listing}")
+
         cmd = ["sy-bsync", *cmdopts, path, dest]
         commands.append(cmd)
 
@@ -398,6 +610,66 @@ def config_add_path():
     write_config("remotes.json", cfg)
 
 
+def config_set():
+    """Set a transfer setting for a remote, overriding auto-tuning."""
+    # Name of the remote
+    # [positional]
+    name: Option
+
+    # Name of the setting (lanes, batch-size, compress, whole-file)
+    # [positional]
+    key: Option
+
+    # Value of the setting
+    # [positional: ?]
+    value: Option
+
+    # Remove the setting and go back to auto-tuning
+    # [alias: -u]
+    unset: Option & bool = default(False)
+
+    cfg = get_config("remotes.json")
+    remote = _check_remote(cfg, name, create=False)
+    settings = remote.setdefault("settings", {})
+
+    if unset:
+        settings.pop(key, None)
+    elif value is None:
+        q("Please give a value for the setting, or use --unset")
+    else:
+        settings[key] = _check_setting(key, value)
+
+    print(json.dumps(settings, indent=4))
+    write_config("remotes.json", cfg)
+
+
+def config_set_global():
+    """Set a transfer setting for all remotes."""
+    # Name of the setting (lanes, batch-size, compress, whole-file, bwlimit, ...)
+    # [positional]
+    key: Option
+
+    # Value of the setting
+    # [positional: ?]
+    value: Option
+
+    # Remove the setting
+    # [alias: -u]
+    unset: Option & bool = default(False)
+
+    settings = get_config("settings.json")
+
+    if unset:
+        settings.pop(key, None)
+    elif value is None:
+        q("Please give a value for the setting, or use --unset")
+    else:
+        settings[key] = _check_setting(key, value)
+
+    print(json.dumps(settings, indent=4))
+    write_config("settings.json", settings)
+
+
 def config_list_paths():
     """List paths for a remote"""
     # Name of the remote
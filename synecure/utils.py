@@ -1,7 +1,10 @@
+import contextlib
+import fcntl
 import json
 import os
 import re
 import subprocess
+import tempfile
 
 
 def get_config_path(name=None):
@@ -23,12 +26,32 @@ def write_config(name, cfg, silent=False):
     path = get_config_path(name)
     cdir = os.path.dirname(path)
     os.makedirs(cdir, exist_ok=True)
-    with open(path, "w") as f:
-        json.dump(cfg, f, indent=4)
+    # readers see the old or the new file, never a partial one
+    fd, tmp = tempfile.mkstemp(dir=cdir, prefix=os.path.basename(path) + ".")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(cfg, f, indent=4)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
     if not silent:
         print(f"Written config at: {path}")
 
 
+@contextlib.contextmanager
+def locked_config(name):
+    """Hold an exclusive lock on a config file, around a read-modify-write.
+
+    Concurrent bsync processes (fan-out) update the same files.
+    """
+    path = get_config_path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
 def edit_config(name):
     editor = os.getenv("EDITOR")
     if editor:
@@ -80,3 +103,62 @@ def quote(s):
     # use single quotes, and put single quotes into double quotes
     # the string $'b is then quoted as '$'"'"'b'
     return "'" + s.replace("'", "'\"'\"'") + "'"
+
+
+_size_units = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+_size_re = re.compile(r"(\d+(?:\.\d+)?)([KMGT]?)(?:i?B)?", re.IGNORECASE)
+
+
+def parse_size(s):
+    """Parse a size such as 512K, 20M or 1.5G into a number of bytes."""
+    m = _size_re.fullmatch(s.strip())
+    if m is None:
+        raise ValueError(f"Invalid size: '{s}'")
+    number, unit = m.groups()
+    return int(float(number) * _size_units[unit.upper()])
+
+
+def _parse_time(s):
+    hours, _, minutes = s.partition(":")
+    if not hours.isdigit() or not (minutes or "0").isdigit():
+        raise ValueError(f"Invalid time: '{s}'")
+    value = int(hours) * 60 + int(minutes or 0)
+    if value > 24 * 60:
+        raise ValueError(f"Invalid time: '{s}'")
+    return value
+
+
+def parse_bwlimit(spec):
+    """Parse a bandwidth limit, in bytes per second.
+
+    The limit is either a rate (e.g. 5M, 0 for no limit), or a comma-separated
+    list of time-of-day windows with a rate and an optional default rate,
+    e.g. ``08:00-18:00=2M,18:00-08:00=20M`` or ``09-17=1M,10M``.
+
+    Returns a list of (start, end, rate) with start and end in minutes since
+    midnight, or None for the default rate.
+    """
+    rules = []
+    for part in spec.split(","):
+        window, sep, rate = part.rpartition("=")
+        if sep:
+            start, dash, end = window.partition("-")
+            if not dash:
+                raise ValueError(f"Invalid time window: '{window}'")
+            rules.append((_parse_time(start), _parse_time(end), parse_size(rate)))
+        else:
+            rules.append((None, None, parse_size(rate)))
+    return rules
+
+
+def bwlimit_at(rules, minute):
+    """Rate in bytes per second of the first rule that applies at a given minute
+    of the day (0 means no limit)."""
+    for start, end, rate in rules:
+        if start is None:
+            return rate
+        if start <= end and start <= minute < end:
+            return rate
+        if start > end and (minute >= start or minute < end):
+            return rate
+    return 0
@@ -0,0 +1,165 @@
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# an rsync that is installed, but fails every transfer
+FAILING_RSYNC = """#!/bin/sh
+if [ "$1" = "--version" ]; then
+    echo "rsync  version 3.2.7  protocol version 31"
+    exit 0
+fi
+cat > /dev/null
+exit 1
+"""
+
+# the rsync of the tests: its invocations are logged as JSON lines to
+# $RSYNC_LOG, then the installed rsync runs (after $RSYNC_DELAY seconds for the
+# transfers). When rsync is not installed, it is a stand-in: with the ssh
+# stand-in of bench/fakessh, remote paths (host:path) are on this machine too.
+# It copies the files listed on its input (--files-from=- --from0), or lists
+# the differences between both trees for a dry run (-n).
+RSYNC = """#!%s
+import json, os, re, shutil, sys, time
+
+REAL = %r
+args = sys.argv[1:]
+if os.environ.get("RSYNC_LOG"):
+    with open(os.environ["RSYNC_LOG"], "a") as f:
+        f.write(json.dumps(args) + "\\n")
+if args != ["--version"]:
+    time.sleep(float(os.environ.get("RSYNC_DELAY", "0")))
+if REAL:
+    os.execv(REAL, [REAL] + args)
+if args == ["--version"]:
+    print("rsync  version 3.2.7  protocol version 31 (stand-in)")
+    sys.exit(0)
+src, dst = [re.sub("^[^/]*:", "", arg) for arg in args if not arg.startswith("-")][-2:]
+
+def state(path):
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+    link = os.readlink(path) if os.path.islink(path) else None
+    size = st.st_size if os.path.isfile(path) and link is None else 0
+    return (st.st_mode, size, int(st.st_mtime), link)
+
+if any(re.match("-[a-zA-Z]*n", arg) for arg in args):
+    paths = set()
+    for base in (src, dst):
+        for dirpath, dirnames, filenames in os.walk(base):
+            for name in dirnames + filenames:
+                path = os.path.relpath(os.path.join(dirpath, name), base)
+                if not path.startswith(".bsync-snap-"):
+                    paths.add(path)
+    print("./")
+    for path in sorted(paths):
+        if state(os.path.join(src, path)) != state(os.path.join(dst, path)):
+            print(path)
+    sys.exit(0)
+
+for path in sys.stdin.buffer.read().split(b"\\0"):
+    if not path:
+        continue
+    s = os.path.join(os.fsencode(src), path)
+    d = os.path.join(os.fsencode(dst), path)
+    os.makedirs(os.path.dirname(d), exist_ok=True)
+    if os.path.islink(s):
+        if os.path.lexists(d):
+            os.remove(d)
+        os.symlink(os.readlink(s), d)
+        st = os.lstat(s)
+        os.utime(d, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+    elif os.path.isdir(s):
+        os.makedirs(d, exist_ok=True)
+        shutil.copystat(s, d)
+    else:
+        tmp = d + b".stub-rsync"
+        shutil.copy2(s, tmp)
+        os.replace(tmp, d)
+    sys.stdout.buffer.write(b"rsync: " + path + b"\\n")
+    sys.stdout.flush()
+""" % (
+    sys.executable,
+    shutil.which("rsync"),
+)
+
+
+def write_tree(base, files):
+    for path, content in files.items():
+        path = os.path.join(str(base), path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+
+
+def read_tree(base):
+    """Contents of the files of a tree, without the bsync files."""
+    base = str(base)
+    tree = {}
+    for dirpath, dirnames, filenames in os.walk(base):
+        for name in filenames:
+            if name.startswith(".bsync-"):
+                continue
+            path = os.path.join(dirpath, name)
+            with open(path) as f:
+                tree[os.path.relpath(path, base)] = f.read()
+    return tree
+
+
+def write_script(path, text):
+    with open(str(path), "w") as f:
+        f.write(text)
+    os.chmod(str(path), 0o755)
+
+
+def install_rsync(bindir):
+    """Put the rsync of the tests in bindir."""
+    write_script(os.path.join(str(bindir), "rsync"), RSYNC)
+
+
+@pytest.fixture
+def env(tmp_path):
+    """Environment of a bsync run: a HOME of its own, and a bin directory first in PATH."""
+    home = tmp_path / "home"
+    bindir = tmp_path / "bin"
+    home.mkdir()
+    bindir.mkdir()
+    install_rsync(bindir)
+    return dict(
+        os.environ,
+        HOME=str(home),
+        PATH=str(bindir) + os.pathsep + os.environ.get("PATH", ""),
+        PYTHONPATH=ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""),
+    )
+
+
+def bsync(env, *args, check=True, cwd=None, **kwargs):
+    """Run bsync, with no standard input unless answers are given (input=...)."""
+    if "input" not in kwargs:
+        kwargs["stdin"] = subprocess.DEVNULL
+    proc = subprocess.run(
+        [sys.executable, "-c", "from synecure import bsync", *map(str, args)],
+        env=env,
+        cwd=cwd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+        timeout=120,
+        **kwargs
+    )
+    if check and proc.returncode != 0:
+        raise AssertionError(
+            "bsync %s failed:\n%s" % (" ".join(map(str, args)), proc.stdout)
+        )
+    return proc
+
+
+def journals(env):
+    path = os.path.join(env["HOME"], ".config", "synecure", "journals")
+    return os.listdir(path) if os.path.isdir(path) else []
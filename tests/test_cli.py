@@ -0,0 +1,48 @@
+import os
+
+from synecure.cli import plan_sync
+
+
+def remote(tmp_path):
+    return {
+        "type": "ssh",
+        "url": "otherhost",
+        "port": None,
+        "paths": {str(tmp_path): "a"},
+    }
+
+
+def test_plan_sync_json_plan(tmp_path):
+    path = str(tmp_path / "dir")
+    os.makedirs(path)
+    plan = str(tmp_path / "plan.json")
+    (cmd,) = plan_sync(path, "otherhost", remote(tmp_path), json_plan=plan)
+    assert cmd[0] == "sy-bsync"
+    assert f"--json-plan={plan}" in cmd
+    assert cmd[-2:] == [path, "otherhost:a/dir"]
+
+
+def test_plan_sync_json_plan_stdout(tmp_path):
+    path = str(tmp_path / "dir")
+    os.makedirs(path)
+    (cmd,) = plan_sync(path, "otherhost", remote(tmp_path), json_plan="-")
+    assert "--json-plan=-" in cmd
+    assert cmd[-2:] == [path, "otherhost:a/dir"]
+
+
+def test_plan_sync_settings(tmp_path):
+    path = str(tmp_path / "dir")
+    os.makedirs(path)
+    rem = dict(remote(tmp_path), settings={"lanes": 4, "stream": True})
+    (cmd,) = plan_sync(path, "otherhost", rem, settings={"compress": "no"}, resume=True)
+    assert cmd == [
+        "sy-bsync",
+        "-d",
+        "-y",
+        "--compress=no",
+        "--lanes=4",
+        "--stream",
+        "--resume",
+        path,
+        "otherhost:a/dir",
+    ]
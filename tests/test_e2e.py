@@ -0,0 +1,554 @@
+import json
+import os
+import subprocess
+import time
+
+import pytest
+
+from .conftest import (
+    FAILING_RSYNC,
+    ROOT,
+    bsync,
+    install_rsync,
+    journals,
+    read_tree,
+    write_script,
+    write_tree,
+)
+
+# syncs with a "remote" directory on this machine, through the ssh stand-in of
+# the benchmarks: rsync runs it too (or the rsync stand-in, see conftest.py)
+
+FAKESSH = os.path.join(ROOT, "bench", "fakessh")
+
+TREE = {
+    "notes.txt": "some notes\n",
+    "src/a.py": "print('a')\n",
+    "src/b.py": "print('b')\n",
+    "src/lib/c.py": "print('c')\n",
+    "docs/index.md": "# index\n",
+}
+
+
+@pytest.fixture
+def wan(env, tmp_path):
+    """Environment with the ssh stand-in first in PATH, without delays, logging to ssh.log."""
+    env = dict(env)
+    env["PATH"] = FAKESSH + os.pathsep + env["PATH"]
+    env["BENCH_RTT"] = "0"
+    env["BENCH_BANDWIDTH"] = "0"
+    env["BENCH_LOG"] = str(tmp_path / "ssh.log")
+    env["RSYNC_LOG"] = str(tmp_path / "rsync.log")
+    return env
+
+
+@pytest.fixture
+def dirs(tmp_path):
+    """A local and a remote tree, with the same name under different parents."""
+    local = tmp_path / "local" / "tree"
+    remote = tmp_path / "remote" / "tree"
+    local.mkdir(parents=True)
+    remote.mkdir(parents=True)
+    return local, remote
+
+
+def sync(env, local, remote, *args, **kwargs):
+    for log in (env["BENCH_LOG"], env["RSYNC_LOG"]):
+        if os.path.exists(log):
+            os.remove(log)
+    return bsync(env, "-y", *args, local, "bench@localhost:" + str(remote), **kwargs)
+
+
+def read_log(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def ssh_commands(env):
+    """Remote commands run by the last sync."""
+    entries = read_log(env["BENCH_LOG"])
+    return [" ".join(e["argv"]) for e in entries if e["kind"] == "command"]
+
+
+def transfers(env):
+    """Arguments of the rsync transfers of the last sync (not the remote ends)."""
+    return [
+        argv
+        for argv in read_log(env["RSYNC_LOG"])
+        if argv != ["--version"] and "--server" not in argv
+    ]
+
+
+# make sure a modification is seen even if it happens in the same second
+def edit(path, content):
+    st = os.stat(str(path))
+    with open(str(path), "w") as f:
+        f.write(content)
+    os.utime(str(path), (st.st_atime, st.st_mtime + 2))
+
+
+@pytest.fixture
+def synced(wan, dirs):
+    local, remote = dirs
+    write_tree(local, TREE)
+    sync(wan, local, remote)
+    return wan, local, remote
+
+
+def test_seed(wan, dirs):
+    local, remote = dirs
+    write_tree(local, TREE)
+    out = sync(wan, local, remote).stdout
+    assert "Empty destination" in out
+    assert read_tree(remote) == TREE
+
+
+def test_noop(synced):
+    env, local, remote = synced
+    out = sync(env, local, remote).stdout
+    assert "Identical directories" in out
+    assert transfers(env) == []
+
+
+def test_edit(synced):
+    env, local, remote = synced
+    edit(local / "src" / "a.py", "print('A')\n")
+    edit(remote / "docs" / "index.md", "# new index\n")
+    sync(env, local, remote)
+    tree = dict(TREE, **{"src/a.py": "print('A')\n", "docs/index.md": "# new index\n"})
+    assert read_tree(local) == tree
+    assert read_tree(remote) == tree
+
+
+def test_rename(synced):
+    env, local, remote = synced
+    os.rename(str(local / "src"), str(local / "source"))
+    sync(env, local, remote)
+    tree = {path.replace("src/", "source/"): content for path, content in TREE.items()}
+    assert read_tree(remote) == tree
+    # moved on the remote, not sent again
+    assert transfers(env) == []
+
+
+def test_resume(synced, tmp_path):
+    env, local, remote = synced
+    write_tree(local, {"new/d.py": "print('d')\n", "new/e.py": "print('e')\n"})
+    os.remove(str(local / "notes.txt"))
+    rsync = tmp_path / "bin" / "rsync"
+    write_script(rsync, FAILING_RSYNC)
+    assert sync(env, local, remote, check=False).returncode != 0
+    assert journals(env)
+
+    rsync.unlink()
+    install_rsync(tmp_path / "bin")
+    sync(env, local, remote, "--resume")
+    assert not journals(env)
+    assert read_tree(remote) == read_tree(local)
+    assert "Identical directories" in sync(env, local, remote).stdout
+
+
+def test_subtree(synced):
+    env, local, remote = synced
+    edit(local / "src" / "lib" / "c.py", "print('C')\n")
+    out = sync(env, local / "src", remote / "src").stdout
+    assert "Using history of parent root" in out
+    assert (remote / "src" / "lib" / "c.py").read_text() == "print('C')\n"
+    # the snapshot of the root has the slice updated
+    assert "Identical directories" in sync(env, local, remote).stdout
+
+
+def plan_actions(path):
+    with open(str(path)) as f:
+        return {action["path"]: action for action in json.load(f)["actions"]}
+
+
+def test_transfer_classes(synced, tmp_path):
+    env, local, remote = synced
+    write_tree(local, {"big.db": "x" * 300000, "photo.zip": "z" * 300000})
+    sync(env, local, remote)
+    write_tree(local, {"new.txt": "new"})
+    edit(local / "big.db", "y" * 300000)
+    edit(local / "photo.zip", "w" * 300000)
+
+    plan = tmp_path / "plan.json"
+    sync(env, local, remote, "--compress=yes", "--json-plan=" + str(plan))
+    actions = plan_actions(plan)
+    # a large modified file is sent as a delta, a new file whole,
+    # and compressed formats are not compressed again
+    assert actions["big.db"]["transfer"] == "delta-z"
+    assert actions["new.txt"]["transfer"] == "whole-z"
+    assert actions["photo.zip"]["transfer"] == "whole"
+    assert read_tree(remote) == read_tree(local)
+
+
+def test_link_profile(synced):
+    env, local, remote = synced
+    config = os.path.join(env["HOME"], ".config", "synecure", "remotes.json")
+    with open(config, "w") as f:
+        json.dump({"bench": {"hostname": "localhost", "paths": {}}}, f)
+
+    # a slow link with a long round trip
+    env = dict(env, BENCH_RTT="30", BENCH_BANDWIDTH="2000000")
+    out = sync(env, local, remote, "-v", "--profile=bench").stdout
+    assert "Profiling link" in out
+    assert "lanes=4" in out and "compress=yes" in out
+    with open(config) as f:
+        link = json.load(f)["bench"]["link"]
+    assert link["rtt"] >= 30 and link["bandwidth"] < 10e6
+
+    # measured once, then reused
+    out = sync(env, local, remote, "-v", "--profile=bench").stdout
+    assert "Profiling link" not in out
+    assert "lanes=4" in out
+
+
+def test_events(synced, tmp_path):
+    env, local, remote = synced
+    edit(local / "src" / "a.py", "print('A')\n")
+    write_tree(remote, {"docs/new.md": "new\n"})
+    events = tmp_path / "events.jsonl"
+    sync(env, local, remote, "--events=" + str(events))
+
+    with open(str(events)) as f:
+        lines = [json.loads(line) for line in f]
+    for direction, path in (("12", "src/a.py"), ("21", "docs/new.md")):
+        kinds = [e["event"] for e in lines if e["direction"] == direction]
+        assert kinds == ["start", "file", "end"]
+        [event] = [
+            e for e in lines if e["event"] == "file" and e["direction"] == direction
+        ]
+        assert event["path"] == path
+        assert event["files_done"] == event["files"] == 1
+
+
+def test_stream(synced, tmp_path):
+    env, local, remote = synced
+    edit(local / "src" / "a.py", "print('A')\n")
+    os.remove(str(local / "notes.txt"))
+    write_tree(local, {"src/new.py": "new\n"})
+    write_tree(remote, {"docs/other.md": "other\n"})
+    os.remove(str(remote / "src" / "lib" / "c.py"))
+
+    # the same plan as with the listings in memory
+    plans = []
+    for args in ((), ("--stream",)):
+        plan = tmp_path / "plan.json"
+        bsync(
+            env,
+            "-n",
+            *args,
+            "--json-plan=" + str(plan),
+            local,
+            "bench@localhost:" + str(remote)
+        )
+        plans.append(
+            sorted(json.dumps(a, sort_keys=True) for a in plan_actions(plan).values())
+        )
+    assert plans[0] == plans[1]
+    assert len(plans[0]) == 5
+
+    sync(env, local, remote, "--stream")
+    assert read_tree(local) == read_tree(remote)
+    assert "Identical directories" in sync(env, local, remote, "--stream").stdout
+
+
+def max_overlap(entries):
+    """Largest number of ssh commands running at the same time."""
+    edges = sorted(
+        [(e["start"], 1) for e in entries] + [(e["end"], -1) for e in entries]
+    )
+    running = peak = 0
+    for time, step in edges:
+        running += step
+        peak = max(peak, running)
+    return peak
+
+
+def test_commands_per_host(synced):
+    env, local, remote = synced
+    write_tree(local, {"d/f%d" % i: str(i) for i in range(16)})
+    sync(env, local, remote)
+    for i in range(16):
+        os.chmod(str(local / "d" / ("f%d" % i)), 0o600)
+
+    # permission changes, one command each, from 8 lanes
+    env = dict(env, BENCH_RTT="50")
+    sync(env, local, remote, "--lanes=8", "--batch-size=1")
+    assert os.stat(str(remote / "d" / "f0")).st_mode & 0o777 == 0o600
+    # the commands run concurrently, at most host_concurrency (4) at a time
+    commands = [e for e in read_log(env["BENCH_LOG"]) if e["kind"] == "command"]
+    assert 1 < max_overlap(commands) <= 4
+
+
+def test_walkers(synced):
+    env, local, remote = synced
+    write_tree(
+        remote,
+        {"w%d/sub %d/f%d" % (i % 5, i % 3, i): str(i) for i in range(30)},
+    )
+    os.symlink("../notes.txt", str(remote / "w0" / "link"))
+    sync(env, local, remote, "--walkers=4")
+    assert any("xargs -0 -P 4" in cmd for cmd in ssh_commands(env))
+    assert read_tree(local) == read_tree(remote)
+    assert os.readlink(str(local / "w0" / "link")) == "../notes.txt"
+    assert "Identical directories" in sync(env, local, remote, "--walkers=4").stdout
+
+
+def test_lanes_and_bandwidth_limit(synced):
+    env, local, remote = synced
+    write_tree(local, {"a.txt": "a", "b.txt": "b", "big.iso": "i" * 200000})
+    sync(env, local, remote, "--lanes=2", "--bwlimit=3M", "--background-size=100K")
+    assert read_tree(remote) == read_tree(local)
+
+    # two lanes and a background one for the large file, sharing the limit
+    runs = transfers(env)
+    assert len(runs) == 3
+    assert all("--bwlimit=1024" in argv for argv in runs)
+    assert sum("--partial-dir=.bsync-partial" in argv for argv in runs) == 1
+
+
+def test_hard_links_and_sparse_files(synced, tmp_path):
+    env, local, remote = synced
+    write_tree(local, {"h/one": "shared content\n"})
+    os.link(str(local / "h" / "one"), str(local / "h" / "two"))
+    with open(str(local / "disk.img"), "wb") as f:
+        f.truncate(4 << 20)
+        f.write(b"boot")
+
+    plan = tmp_path / "plan.json"
+    out = sync(env, local, remote, "--json-plan=" + str(plan)).stdout
+    actions = plan_actions(plan)
+    # one transfer for the group, then a link
+    assert {actions["h/one"]["action"], actions["h/two"]["action"]} == {"copy", "link"}
+    assert actions["disk.img"]["transfer"] == "whole-sparse"
+    assert "not written (sparse files)" in out
+
+    assert (
+        os.stat(str(remote / "h" / "one")).st_ino
+        == os.stat(str(remote / "h" / "two")).st_ino
+    )
+    assert read_tree(remote) == read_tree(local)
+    assert "Identical directories" in sync(env, local, remote).stdout
+
+
+def test_bulk_tar_stream(synced, tmp_path):
+    env, local, remote = synced
+    write_tree(local, {"many/f%d.txt" % i: str(i) for i in range(10)})
+    os.utime(str(local / "many" / "f0.txt"), (1500000000, 1500000000))
+    write_tree(remote, {"back/g%d.txt" % i: str(i) for i in range(10)})
+
+    plan = tmp_path / "plan.json"
+    sync(env, local, remote, "--bulk-files=5", "--json-plan=" + str(plan))
+    transfer = {
+        a["transfer"] for a in plan_actions(plan).values() if a["action"] == "copy"
+    }
+    assert transfer == {"tar"}
+    assert transfers(env) == []
+    assert read_tree(remote) == read_tree(local)
+    assert os.stat(str(remote / "many" / "f0.txt")).st_mtime == 1500000000
+
+
+def test_seed_with_tar(wan, dirs):
+    local, remote = dirs
+    write_tree(local, TREE)
+    sync(wan, local, remote)
+    # seeding: every small file goes in the tar stream
+    assert transfers(wan) == []
+    assert read_tree(remote) == TREE
+
+
+def test_remote_to_remote(wan, tmp_path):
+    one = tmp_path / "one" / "tree"
+    two = tmp_path / "two" / "tree"
+    write_tree(one, TREE)
+    two.mkdir(parents=True)
+    args = (
+        "-y",
+        "--no-seed",
+        "bench@localhost:" + str(one),
+        "other@localhost:" + str(two),
+    )
+    bsync(wan, *args)
+    assert read_tree(two) == TREE
+
+    edit(one / "src" / "a.py", "print('A')\n")
+    write_tree(two, {"docs/more.md": "more\n"})
+    os.remove(wan["BENCH_LOG"])
+    bsync(wan, *args)
+    assert read_tree(one) == read_tree(two)
+    # rsync runs on the source host, not on this one
+    assert any("@localhost rsync -a " in cmd for cmd in ssh_commands(wan))
+    assert "Identical directories" in bsync(wan, *args).stdout
+
+
+def test_verify(synced):
+    env, local, remote = synced
+    edit(local / "src" / "a.py", "print('A')\n")
+    out = sync(env, local, remote, "-c", "-v").stdout
+    assert "Verifying 5 paths (4 sampled)" in out
+
+    # same size and date: only the hashes tell the copies apart
+    path = remote / "src" / "b.py"
+    st = os.stat(str(path))
+    path.write_text("print('B')\n")
+    os.utime(str(path), ns=(st.st_atime_ns, st.st_mtime_ns))
+    sync(env, local, remote, "-c")
+    sync(env, local, remote, "-c", "--verify-sample=0", "--verify-hash")
+    proc = sync(env, local, remote, "-c", "--verify-hash", check=False)
+    assert proc.returncode != 0
+    assert "verification differences:\nsrc/b.py" in proc.stdout
+
+
+def test_resource_policy(synced):
+    env, local, remote = synced
+    write_tree(local, {"tmp/%d" % i: "%d\n" % i for i in range(30)})
+    sync(env, local, remote)
+    edit(local / "src" / "a.py", "print('A')\n")
+    for name in os.listdir(str(remote / "tmp")):
+        os.remove(str(remote / "tmp" / name))
+    args = ("--nice=10", "--ionice=idle", "--max-scan-threads=1", "--ops-limit=10")
+    start = time.monotonic()
+    sync(env, local, remote, *args)
+    # the 30 local removals run at 10 per second, after a burst of a second
+    assert time.monotonic() - start > 1.5
+    assert read_tree(local) == read_tree(remote)
+    assert read_tree(local)["src/a.py"] == "print('A')\n"
+
+    prefix = "renice 10 $$ >/dev/null 2>&1; ionice -c 3 -p $$ >/dev/null 2>&1; "
+    commands = ssh_commands(env)
+    assert commands and all(prefix in cmd for cmd in commands)
+    argvs = transfers(env)
+    assert argvs and all("--rsync-path=" + prefix + "rsync" in argv for argv in argvs)
+
+
+def test_chunked_transfer(synced):
+    env, local, remote = synced
+    data = os.urandom(3 << 20)
+    (local / "big.bin").write_bytes(data)
+    (remote / "src" / "big.bin").write_bytes(data[::-1])
+    out = sync(env, local, remote, "-v", "--chunked-size=1M").stdout
+    assert "Sending 1/1 chunks of big.bin" in out
+    assert "Sending 1/1 chunks of src/big.bin" in out
+    assert transfers(env) == []
+    assert (remote / "big.bin").read_bytes() == data
+    assert (local / "src" / "big.bin").read_bytes() == data[::-1]
+
+    # over an existing copy, whose chunks are compared first
+    edit(local / "big.bin", "new content\n" * (1 << 18))
+    out = sync(env, local, remote, "-v", "--chunked-size=1M").stdout
+    assert "Sending 1/1 chunks of big.bin" in out
+    assert (remote / "big.bin").read_bytes() == (local / "big.bin").read_bytes()
+    assert not os.path.exists(str(remote / ".bsync-partial"))
+    assert "Identical directories" in sync(env, local, remote).stdout
+
+
+def test_dedup(synced, tmp_path):
+    env, local, remote = synced
+    data = os.urandom(100000)
+    model = os.urandom(300000)
+    write_tree(local, {"data/a.bin": "", "lib/model.bin": ""})
+    (local / "data" / "a.bin").write_bytes(data)
+    (local / "lib" / "model.bin").write_bytes(model)
+    sync(env, local, remote)
+
+    # a copy of a destination file, and a file close to one with the same name
+    write_tree(local, {"copy/a.bin": "", "other/model.bin": ""})
+    (local / "copy" / "a.bin").write_bytes(data)
+    (local / "other" / "model.bin").write_bytes(model[:1000] + b"x" + model[1001:])
+    plan = tmp_path / "plan.json"
+    sync(env, local, remote, "--json-plan=" + str(plan))
+    actions = plan_actions(plan)
+    assert actions["copy/a.bin"]["action"] == "clone"
+    assert actions["copy/a.bin"]["source"] == "data/a.bin"
+    assert actions["other/model.bin"]["basis"] == "lib/model.bin"
+    assert actions["other/model.bin"]["transfer"] == "delta"
+    assert any(".bsync-basis" in cmd for cmd in ssh_commands(env))
+    assert len(transfers(env)) == 1
+    for path in ("copy/a.bin", "other/model.bin"):
+        assert (remote / path).read_bytes() == (local / path).read_bytes()
+
+    write_tree(local, {"copy2/a.bin": ""})
+    (local / "copy2" / "a.bin").write_bytes(data)
+    sync(env, local, remote, "--no-dedup", "--json-plan=" + str(plan))
+    assert plan_actions(plan)["copy2/a.bin"]["action"] == "copy"
+    assert (remote / "copy2" / "a.bin").read_bytes() == data
+
+
+def test_pipelined_dedup(synced, tmp_path):
+    env, local, remote = synced
+    old = os.urandom(100000)
+    new = os.urandom(110000)
+    write_tree(local, {"data/p.bin": ""})
+    (local / "data" / "p.bin").write_bytes(old)
+    sync(env, local, remote)
+
+    # copied, then edited: the sync of the original is sent while planning, and
+    # still running when the destination files are hashed
+    write_tree(local, {"new/n.bin": ""})
+    (local / "new" / "n.bin").write_bytes(old)
+    st = os.stat(str(local / "data" / "p.bin"))
+    (local / "data" / "p.bin").write_bytes(new)
+    os.utime(str(local / "data" / "p.bin"), (st.st_atime, st.st_mtime + 2))
+    plan = tmp_path / "plan.json"
+    env = dict(env, RSYNC_DELAY="1")
+    sync(env, local, remote, "--pipeline", "--json-plan=" + str(plan))
+    actions = plan_actions(plan)
+    assert actions["data/p.bin"]["pipelined"]
+    assert actions["new/n.bin"]["action"] == "copy"
+    assert (remote / "new" / "n.bin").read_bytes() == old
+    assert (remote / "data" / "p.bin").read_bytes() == new
+
+
+def git(env, path, *args):
+    args = ("-c", "user.name=test", "-c", "user.email=test@localhost") + args
+    subprocess.run(["git", "-C", str(path), *args], env=env, check=True)
+
+
+def test_git_scan(synced):
+    env, local, remote = synced
+    git(env, local, "init", "-q")
+    git(env, local, "add", ".")
+    git(env, local, "commit", "-q", "-m", "first")
+    sync(env, local, remote, "--git-scan")
+
+    # a commit, a modified file and an untracked one
+    edit(local / "docs" / "index.md", "# new index\n")
+    git(env, local, "commit", "-q", "-a", "-m", "second")
+    edit(local / "src" / "a.py", "print('A')\n")
+    write_tree(local, {"src/new.py": "print('new')\n"})
+    out = sync(env, local, remote, "-v", "--git-scan").stdout
+    # the 3 files and their parents, and .git
+    assert "git: checking 5 paths and 1 directories in " + str(local) in out
+    for path in ("docs/index.md", "src/a.py", "src/new.py"):
+        assert (remote / path).read_text() == (local / path).read_text()
+    assert "Identical directories" in sync(env, local, remote).stdout
+
+
+def touch(path, seconds):
+    st = os.stat(str(path))
+    os.utime(str(path), (st.st_atime, st.st_mtime + seconds))
+
+
+def test_meta_only(synced, tmp_path):
+    env, local, remote = synced
+    plan = tmp_path / "plan.json"
+    os.chmod(str(local / "src" / "a.py"), 0o700)
+    sync(env, local, remote, "--json-plan=" + str(plan))
+    assert plan_actions(plan)["src/a.py"]["transfer"] == "meta"
+    assert transfers(env) == []
+    assert os.stat(str(remote / "src" / "a.py")).st_mode & 0o777 == 0o700
+
+    # the same content with another date: sent, unless hashes are computed
+    touch(local / "notes.txt", 10)
+    sync(env, local, remote, "--json-plan=" + str(plan))
+    assert plan_actions(plan)["notes.txt"]["transfer"] == "whole"
+    touch(local / "docs" / "index.md", 10)
+    edit(local / "src" / "b.py", "print('B')\n")
+    sync(env, local, remote, "--meta-only=hash", "--json-plan=" + str(plan))
+    actions = plan_actions(plan)
+    assert actions["docs/index.md"]["transfer"] == "meta"
+    assert actions["src/b.py"]["transfer"] == "whole"
+    assert read_tree(remote) == read_tree(local)
+    assert "Identical directories" in sync(env, local, remote).stdout
@@ -0,0 +1,59 @@
+import os
+import resource
+
+from .conftest import FAILING_RSYNC, bsync, read_tree, write_script, write_tree
+
+
+def test_native_copier_metadata(tmp_path, env):
+    dir1 = tmp_path / "dir1"
+    dir2 = tmp_path / "dir2"
+    write_tree(dir1, {"a/x": "x", "run.sh": "echo", "big": "b" * 100000})
+    os.chmod(str(dir1 / "a" / "x"), 0o640)
+    os.chmod(str(dir1 / "run.sh"), 0o755)
+    os.utime(str(dir1 / "big"), (1500000000, 1500000000))
+    os.symlink("a/x", str(dir1 / "link"))
+    dir2.mkdir()
+    # every file is copied without rsync
+    write_script(tmp_path / "bin" / "rsync", FAILING_RSYNC)
+
+    bsync(env, "-y", "--copier=native", dir1, dir2)
+    assert read_tree(dir2) == read_tree(dir1)
+    for path in ("a/x", "run.sh", "big", "link"):
+        st1 = os.lstat(str(dir1 / path))
+        st2 = os.lstat(str(dir2 / path))
+        assert st2.st_mode == st1.st_mode, path
+        assert st2.st_mtime == st1.st_mtime, path
+    assert os.readlink(str(dir2 / "link")) == "a/x"
+
+
+def test_rsync_is_the_default_copier(tmp_path, env):
+    dir1 = tmp_path / "dir1"
+    dir2 = tmp_path / "dir2"
+    write_tree(dir1, {"x": "x"})
+    dir2.mkdir()
+    write_script(tmp_path / "bin" / "rsync", FAILING_RSYNC)
+
+    proc = bsync(env, "-y", dir1, dir2, check=False)
+    assert proc.returncode != 0
+    assert "Error in rsync process" in proc.stdout
+
+
+def test_local_actions_with_few_descriptors(tmp_path, env):
+    dir1 = tmp_path / "dir1"
+    dir2 = tmp_path / "dir2"
+    write_tree(dir1, {"%s%d/f" % (d, i): str(i) for i in range(300) for d in "de"})
+    dir2.mkdir()
+    write_script(tmp_path / "bin" / "rsync", FAILING_RSYNC)
+    bsync(env, "-y", "--copier=native", dir1, dir2)
+
+    # a move in each of 300 directories, and a removal in 300 others
+    for i in range(300):
+        os.rename(str(dir1 / ("d%d" % i) / "f"), str(dir1 / ("d%d" % i) / "g"))
+        os.remove(str(dir1 / ("e%d" % i) / "f"))
+
+    def limit():
+        resource.setrlimit(resource.RLIMIT_NOFILE, (64, 64))
+
+    proc = bsync(env, "-y", "--copier=native", dir1, dir2, preexec_fn=limit)
+    assert "mv:300 rm:300" in proc.stdout
+    assert read_tree(dir2) == read_tree(dir1)
@@ -0,0 +1,100 @@
+import json
+import os
+
+import pytest
+
+from .conftest import (
+    FAILING_RSYNC,
+    bsync,
+    journals,
+    read_tree,
+    write_script,
+    write_tree,
+)
+
+
+@pytest.mark.parametrize("scanner", ["find", "native"])
+def test_resume_after_failed_transfer(tmp_path, env, scanner):
+    dir1 = tmp_path / "dir1"
+    dir2 = tmp_path / "dir2"
+    write_tree(dir1, {"a/x": "x", "a/y": "y", "b": "b"})
+    write_tree(dir2, {"c": "c"})
+    write_script(tmp_path / "bin" / "rsync", FAILING_RSYNC)
+
+    proc = bsync(
+        env, "-y", "--copier=rsync", "--scanner=" + scanner, dir1, dir2, check=False
+    )
+    assert proc.returncode != 0
+    assert len(journals(env)) == 1
+
+    # the native copier does not need rsync
+    proc = bsync(env, "--resume", "--copier=native", "--scanner=" + scanner, dir1, dir2)
+    assert "Done!" in proc.stdout
+    assert journals(env) == []
+    assert (
+        read_tree(dir1)
+        == read_tree(dir2)
+        == {"a/x": "x", "a/y": "y", "b": "b", "c": "c"}
+    )
+
+    # the snapshots were made: nothing left to do
+    proc = bsync(env, "-y", "--copier=native", "--scanner=" + scanner, dir1, dir2)
+    assert "Identical directories" in proc.stdout
+
+
+def test_resume_without_journal(tmp_path, env):
+    write_script(tmp_path / "bin" / "rsync", FAILING_RSYNC)
+    (tmp_path / "dir1").mkdir()
+    (tmp_path / "dir2").mkdir()
+    proc = bsync(env, "--resume", tmp_path / "dir1", tmp_path / "dir2", check=False)
+    assert proc.returncode != 0
+    assert "Nothing to resume" in proc.stdout
+
+
+def test_resume_pipelined(tmp_path, env):
+    dir1 = tmp_path / "dir1"
+    dir2 = tmp_path / "dir2"
+    write_tree(dir1, {"a/x": "x", "b": "b"})
+    dir2.mkdir()
+    write_script(tmp_path / "bin" / "rsync", FAILING_RSYNC)
+    bsync(env, "-y", "--copier=native", dir1, dir2)
+
+    # modified and new files are sent while planning, and fail
+    write_tree(dir1, {"a/x": "x2", "a/y": "y", "b": "b2"})
+    for path in ("a/x", "b"):
+        os.utime(str(dir1 / path), (0, os.stat(str(dir1 / path)).st_mtime + 2))
+    proc = bsync(env, "-y", "--copier=rsync", "--pipeline", dir1, dir2, check=False)
+    assert proc.returncode != 0
+    [journal] = journals(env)
+    path = os.path.join(env["HOME"], ".config", "synecure", "journals", journal)
+    with open(path) as f:
+        assert any("dispatched" in json.loads(line) for line in f)
+
+    bsync(env, "--resume", "--copier=native", dir1, dir2)
+    assert journals(env) == []
+    assert read_tree(dir1) == read_tree(dir2) == {"a/x": "x2", "a/y": "y", "b": "b2"}
+
+
+@pytest.mark.parametrize("answer", ["identical", "no"])
+def test_stale_journal_discarded(tmp_path, env, answer):
+    dir1 = tmp_path / "dir1"
+    dir2 = tmp_path / "dir2"
+    write_tree(dir1, {"a": "a"})
+    dir2.mkdir()
+    write_script(tmp_path / "bin" / "rsync", FAILING_RSYNC)
+    bsync(env, "-y", "--copier=native", dir1, dir2)
+
+    write_tree(dir1, {"b": "b"})
+    assert bsync(env, "-y", dir1, dir2, check=False).returncode != 0
+    assert journals(env)
+
+    # planned again, and nothing applied: the old plan must not be resumed later
+    if answer == "identical":
+        os.remove(str(dir1 / "b"))
+        proc = bsync(env, dir1, dir2)
+        assert "Identical directories" in proc.stdout
+    else:
+        proc = bsync(env, dir1, dir2, input="n\n")
+        assert "Leaving files in place" in proc.stdout
+    assert "Planning again" in proc.stdout
+    assert journals(env) == []
@@ -0,0 +1,26 @@
+import json
+import subprocess
+import sys
+
+# read-modify-write of a shared config file, as bsync does for remotes.json
+INCREMENT = """
+import sys
+from synecure.utils import get_config, locked_config, write_config
+
+key = sys.argv[1]
+for i in range(200):
+    with locked_config("counters.json"):
+        cfg = get_config("counters.json")
+        cfg[key] = cfg.get(key, 0) + 1
+        write_config("counters.json", cfg, silent=True)
+"""
+
+
+def test_concurrent_config_writers(env):
+    procs = [
+        subprocess.Popen([sys.executable, "-c", INCREMENT, key], env=env)
+        for key in ("a", "b", "a")
+    ]
+    assert [proc.wait(timeout=120) for proc in procs] == [0, 0, 0]
+    with open(env["HOME"] + "/.config/synecure/counters.json") as f:
+        assert json.load(f) == {"a": 400, "b": 200}